@@ -37,8 +37,6 @@ import os
 from . import blend_props
 from . import gui
 from . import operators
-from . import mdl_import
-from . import mdl_export
 
 
 def register():
@@ -56,13 +54,13 @@ def unregister():
 
 
 def menu_import(self, context):
-    self.layout.operator(BorealisImport.bl_idname, text="Nwn Mdl(.mdl)").filepath = "*.mdl"
+    self.layout.operator(operators.BorealisImport.bl_idname, text="Nwn Mdl(.mdl)").filepath = "*.mdl"
 
 
 def menu_export(self, context):
     import os
     default_path = os.path.splitext(bpy.data.filepath)[0] + ".mdl"
-    self.layout.operator(mdl_export.BorealisExport.bl_idname, text="Nwn Mdl(.mdl)").filepath = default_path
+    self.layout.operator(operators.BorealisExport.bl_idname, text="Nwn Mdl(.mdl)").filepath = default_path
 
 
 if __name__ == "__main__":
@@ -21,13 +21,14 @@ Contains custom blender properties for keeping track of Neverwinter specific dat
 
 @author: Erik Ylipää
 '''
+import json
+import os
+
 import bpy
 import mathutils
 from mathutils import Color
 
 from . import basic_props
-from . import props_classes
-from . import node_props
 
 
 def register():
@@ -81,69 +82,97 @@ def remove_walkmesh_materials(ob):
             ob.data.materials.pop(index)
 
 
+SCHEMA_VERSION = 1
+""" Version of the cached Blender property schema, increased when the format
+    of the schema changes """
+
+SCHEMA_SOURCES = ["node_props.py", "props_classes.py"]
+""" The modules the schema is built from, a change to any of them invalidates
+    the cached schema """
+
+SCHEMA_CACHE = "blender_schema.json"
+""" The name of the schema cache in the Blender user configuration
+    directory """
+
+blender_schemas = None
+""" The loaded schema cache, in the form {"version": ..., "sources": ...,
+    "schemas": {node types: schema}} """
+
+
+def get_schema_sources():
+    """ Returns the size and modification time of the schema sources """
+    directory = os.path.dirname(__file__)
+    sources = []
+    for name in SCHEMA_SOURCES:
+        stat = os.stat(os.path.join(directory, name))
+        sources.append([name, stat.st_size, stat.st_mtime_ns])
+    return sources
+
+
+def get_schema_cache_path():
+    """ Returns the path of the schema cache, or None if there is no user
+        configuration directory. The add-on directory itself is often read
+        only, for system and bundled add-ons """
+    try:
+        directory = bpy.utils.user_resource('CONFIG', path="borealis", create=True)
+    except OSError:
+        return None
+    if not directory:
+        return None
+    return os.path.join(directory, SCHEMA_CACHE)
+
+
+def get_blender_schema(node_types):
+    """ Returns the Blender property schema for `node_types`, see
+        node_props.NodeProperties.get_blender_schema.
+
+            The schemas are cached in a json file in the Blender user
+            configuration directory, so the node property definitions only
+            are imported and walked when they have changed.
+    """
+    global blender_schemas
+    sources = get_schema_sources()
+    cache_path = get_schema_cache_path()
+
+    if blender_schemas is None:
+        blender_schemas = {}
+        if cache_path is not None:
+            try:
+                with open(cache_path) as cache_file:
+                    blender_schemas = json.load(cache_file)
+            except (OSError, ValueError):
+                pass
+
+    if (blender_schemas.get("version") != SCHEMA_VERSION or
+            blender_schemas.get("sources") != sources):
+        blender_schemas = {"version": SCHEMA_VERSION, "sources": sources,
+                           "schemas": {}}
+
+    key = ",".join(node_types)
+    if key not in blender_schemas["schemas"]:
+        from . import node_props
+        schema = node_props.GeometryNodeProperties.get_blender_schema(node_types)
+        blender_schemas["schemas"][key] = schema
+        if cache_path is not None:
+            try:
+                with open(cache_path, "w") as cache_file:
+                    json.dump(blender_schemas, cache_file)
+            except OSError:
+                pass
+
+    return blender_schemas["schemas"][key]
+
+
 def add_properties(data_path, node_types, classname="BorealisNodeProps"):
     #We create a dynamic class to use for node properties
     attribute_dict = {"bl_idname": classname,
-                      "bl_label": "Neverwinter Nights Node properties",
-                      "properties": []}
-    props = []
-    for node_type in node_types:
-        props.extend(node_props.GeometryNodeProperties.get_node_properties(node_type))
-    props = set(props)
-
-    #we build the attribute dictionary by using the definitions from borealis_mdl_definitions
-    for prop in props:
-        if  prop.blender_ignore:
-            continue
-        kwargs = {}
-        kwargs["name"] = prop.name
-        if prop.get_default_value():
-            kwargs["default"] = prop.get_default_value()
-
-        if isinstance(prop, props_classes.NumberProperty):
-            if prop.max:
-                kwargs["max"] = prop.max
-            if prop.min:
-                kwargs["min"] = prop.min
-
-        if isinstance(prop, props_classes.VectorProperty):
-            if prop.size:
-                kwargs["size"] = prop.size
-
-        ##The order of the cases are important since some properties are subtypes of other
-        if isinstance(prop, props_classes.ColorProperty):
-            kwargs["subtype"] = 'COLOR'
-            attribute_dict[prop.name] = bpy.props.FloatVectorProperty(**kwargs)
-            attribute_dict["properties"].append(prop)
-
-        elif isinstance(prop, props_classes.StringProperty):
-            attribute_dict[prop.name] = bpy.props.StringProperty(**kwargs)
-            attribute_dict["properties"].append(prop)
-
-        elif isinstance(prop, props_classes.FloatVectorProperty):
-            attribute_dict[prop.name] = bpy.props.FloatVectorProperty(**kwargs)
-            attribute_dict["properties"].append(prop)
-
-        elif isinstance(prop, props_classes.BooleanProperty):
-            attribute_dict[prop.name] = bpy.props.BoolProperty(**kwargs)
-            attribute_dict["properties"].append(prop)
-
-        elif isinstance(prop, props_classes.EnumProperty):
-            items = prop.get_blender_items()
-            kwargs["items"] = items
-            attribute_dict[prop.name] = bpy.props.EnumProperty(**kwargs)
-            attribute_dict["properties"].append(prop)
-
-        elif isinstance(prop, props_classes.IntProperty):
-            attribute_dict[prop.name] = bpy.props.IntProperty(**kwargs)
-            attribute_dict["properties"].append(prop)
-
-        elif isinstance(prop, props_classes.FloatProperty):
-            attribute_dict[prop.name] = bpy.props.FloatProperty(**kwargs)
-            attribute_dict["properties"].append(prop)
-
-        if prop.name not in attribute_dict:
-            print("Failed to add property %s of type %s" % (prop.name, prop.__class__))
+                      "bl_label": "Neverwinter Nights Node properties"}
+
+    for name, blender_type, kwargs in get_blender_schema(node_types):
+        if "items" in kwargs:
+            #json turns the enum item tuples into lists
+            kwargs = dict(kwargs, items=[tuple(item) for item in kwargs["items"]])
+        attribute_dict[name] = getattr(bpy.props, blender_type)(**kwargs)
 
     #we now create a dynamic class and register it so it will be usable by others
     node_props_class = type(classname, (bpy.types.PropertyGroup,), attribute_dict)
@@ -240,6 +269,10 @@ class Animation(bpy.types.PropertyGroup):
     events = bpy.props.CollectionProperty(type=AnimationEvent)
     event_index = bpy.props.IntProperty(name="Current event")
     animroot = bpy.props.StringProperty(name="Animation root")
+    use_actions = bpy.props.BoolProperty(name="Separate actions", default=False,
+                                         description="The keys of the animation "
+                                         "are in separate actions, in the NLA "
+                                         "strips named after the animation")
 
     #We save away the frames so we can recreate the markers if they are removed
     saved_start_frame = bpy.props.IntProperty(name="Original Start frame", default=1)
@@ -31,8 +31,13 @@ module.
 @author: Erik Ylipää
 '''
 
-import copy
+import importlib
+import mmap
 import os
+import re
+from collections import namedtuple
+from collections.abc import Mapping, MutableSequence
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     from . import basic_props
@@ -41,33 +46,360 @@ except ValueError:
     import basic_props
     import node_props
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 TAB_WIDTH = 2
 """ The spaces to use for every level of indentation when outputting data"""
 
 
-def compare(file1, file2):
-    """ Compares two Neverwinter Nights ascii models """
+def import_tool(name):
+    """ Imports the sibling module `name` on first use. Reading and writing
+        ascii models doesn't need the modules for compiled models, diffs,
+        fingerprints, welding and key reduction, so the importer, the
+        exporter and the load_many workers don't pay for importing them """
+    if __package__:
+        return importlib.import_module("." + name, __package__)
+    return importlib.import_module(name)
+
+
+def compare(file1, file2, cache=None, **kwargs):
+    """ Compares two Neverwinter Nights ascii models, loading them through
+        the mdl_cache.ModelCache `cache` if one is given.
+
+            Prints and returns the mdl_diff.ModelDiff of the models. Keyword
+            arguments are passed to mdl_diff.diff_models.
+    """
 
     print("Comparing file: %s with %s" % (os.path.basename(file1), os.path.basename(file2)))
-    mdl1 = Model()
-    mdl2 = Model()
-
-    mdl1.from_file(file1, True)
-    mdl2.from_file(file2, True)
-
-    #compare the geometry nodes
-    for node1 in mdl1.geometry.nodes:
-        for node2 in mdl2.geometry.nodes:
-            if node1.name == node2.name:
-                if node1.type != node2.type:
-                    print("Differing node types; node %s\tmdl1: %s\tmdl2: %s" %
-                           (node1.name, node1.type, node2, type))
-                for name, prop in node1.properties.items():
-                    if node2[name] != node1[name]:
-                        print("Property %s differs\tmdl1: %s\tmdl2: %s" %
-                              (name, str(node2[name]), str(node1[name])))
-                break
+    if cache is not None:
+        mdl1 = cache.load(file1)
+        mdl2 = cache.load(file2)
+    else:
+        mdl1 = Model()
+        mdl2 = Model()
+
+        mdl1.from_file(file1, True)
+        mdl2.from_file(file2, True)
+
+    diff = import_tool("mdl_diff").diff_models(mdl1, mdl2, **kwargs)
+    if diff:
+        print(diff)
+    return diff
+
+
+LoadResult = namedtuple("LoadResult", ["filename", "model", "error"])
+""" The result of loading one file with load_many. `model` is the Model, or
+    its summary, and `error` the exception raised while loading it """
+
+
+def load_model(filename, summary=False, cache=None, **kwargs):
+    """ Loads a Model from the ascii or compiled model `filename`, keyword
+        arguments are passed to Model.from_file.
+
+            If `summary` is True, the summary of the model is returned instead
+            of the model. Ascii models are then loaded lazily, so their nodes
+            and animations are never parsed. Otherwise the model is loaded
+            through the mdl_cache.ModelCache `cache` if one is given.
+    """
+    if cache is not None and not summary:
+        return cache.load(filename, **kwargs)
+
+    ascii = not import_tool("mdl_binary").is_binary(filename)
+    if summary and ascii:
+        kwargs["lazy"] = True
+
+    model = Model()
+    model.from_file(filename, ascii=ascii, **kwargs)
+    if summary:
+        return model.summary()
+    return model
+
+
+def load_many(filenames, workers=None, summary=False, **kwargs):
+    """ Loads many models in parallel worker processes.
+
+            Returns a list of LoadResult in the same order as `filenames`.
+            A file which fails to load gets a result with the exception as
+            error and None as model, the other files are still loaded.
+            `workers` is the number of processes, by default the number of
+            processors. With one worker the models are loaded in this process.
+            `summary` and other keyword arguments are passed to load_model.
+    """
+    filenames = list(filenames)
+
+    if workers == 1:
+        results = []
+        for filename in filenames:
+            try:
+                model = load_model(filename, summary, **kwargs)
+            except Exception as error:
+                results.append(LoadResult(filename, None, error))
+            else:
+                results.append(LoadResult(filename, model, None))
+        return results
+
+    results = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(load_model, filename, summary, **kwargs)
+                   for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                model = future.result()
+            except Exception as error:
+                results.append(LoadResult(filename, None, error))
+            else:
+                results.append(LoadResult(filename, model, None))
+    return results
+
+
+def write_lines(fileobj, lines, chunk_lines=4096):
+    """ Writes the lines joined by newlines to the file object `fileobj`,
+        the same as writing "\\n".join(lines) but without joining all lines
+        into one string. `chunk_lines` lines are joined for every write """
+    separator = ""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_lines:
+            fileobj.write(separator + "\n".join(chunk))
+            separator = "\n"
+            chunk = []
+    if chunk:
+        fileobj.write(separator + "\n".join(chunk))
+
+
+class LineStream(object):
+    """ A cursor over the tokenized lines of an ascii mdl file.
+
+            Lines are read lazily from any iterable of strings, usually an open
+            file object. Every line is stripped of comments and split into a
+            list of tokens; empty lines are kept as empty lists.
+            Iterating the stream consumes the lines, so nested readers sharing
+            the same stream continue where the previous reader stopped.
+
+            If `use_arrays` is True, numeric matrix properties read from the
+            stream are stored as numpy arrays instead of lists of lists.
+    """
+
+    def __init__(self, lines, use_arrays=False):
+        self.lines = iter(lines)
+        self.use_arrays = use_arrays
+        self.line_number = 0
+        self.peeked = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.peeked is not None:
+            line = self.peeked
+            self.peeked = None
+            return line
+        return self.tokenize(next(self.lines))
+
+    def peek(self):
+        """ Returns the next line without consuming it, or None at the end of
+            the stream """
+        if self.peeked is None:
+            try:
+                self.peeked = self.tokenize(next(self.lines))
+            except StopIteration:
+                return None
+        return self.peeked
+
+    def skip_until(self, token):
+        """ Consumes lines up to and including the next line starting with
+            `token`, without tokenizing the lines in between """
+        if self.peeked is not None:
+            line = self.peeked
+            self.peeked = None
+            if line and line[0] == token:
+                return
+
+        for line in self.lines:
+            self.line_number += 1
+            if line.lstrip().startswith(token) and line.split()[0] == token:
+                return
+
+    def tokenize(self, line):
+        self.line_number += 1
+        comment_index = line.find('#')
+        if comment_index >= 0:
+            line = line[0:comment_index]
+        return line.split()
+
+
+BLOCK_PATTERN = re.compile(rb"^[ \t]*(beginmodelgeom|node|endnode|newanim|doneanim)\b[^\r\n]*",
+                           re.MULTILINE)
+""" Matches the lines which start or end a block in an ascii mdl file """
+
+
+def scan_blocks(data):
+    """ Scans the ascii model in the buffer `data` for its blocks, without
+        tokenizing anything but the lines starting or ending a block.
+
+            Returns a tuple (header_end, geometry_name, nodes, animations)
+            where `header_end` is the offset of the beginmodelgeom line, nodes
+            is a list of (type, name, start, end) and animations a list of
+            (name, model name, start, end). The start and end offsets delimit
+            the body of the block, excluding the line which starts it.
+    """
+    header_end = len(data)
+    geometry_name = ""
+    nodes = []
+    animations = []
+    in_geometry = False
+    block = None
+
+    for match in BLOCK_PATTERN.finditer(data):
+        tokens = match.group().split(b"#", 1)[0].decode("latin-1").split()
+        keyword = tokens[0]
+
+        if keyword == "beginmodelgeom":
+            header_end = match.start()
+            geometry_name = tokens[1]
+            in_geometry = True
+
+        elif keyword == "newanim":
+            in_geometry = False
+            block = [tokens[1], tokens[2], match.end()]
+
+        elif keyword == "doneanim" and block:
+            animations.append(tuple(block + [match.end()]))
+            block = None
+
+        elif keyword == "node" and in_geometry:
+            block = [tokens[1], tokens[2], match.end()]
+
+        elif keyword == "endnode" and in_geometry and block:
+            nodes.append(tuple(block + [match.end()]))
+            block = None
+
+    return header_end, geometry_name, nodes, animations
+
+
+def read_block(data, start, end, use_arrays, block_class, *args):
+    """ Creates a `block_class` instance from `args` and reads it from the
+        bytes between `start` and `end` in `data` """
+    block = block_class(*args)
+    lines = data[start:end].decode("latin-1").splitlines()
+    block.from_file(LineStream(lines, use_arrays))
+    return block
+
+
+class BlockLoader(object):
+    """ A loader of a LazySequence, reads a block with read_block when it is
+        called.
+
+            `data` is usually the memory mapped model file. A pickled loader
+            only holds a copy of the bytes of its block, so a lazily loaded
+            model can be pickled without parsing the blocks or copying the
+            whole file.
+    """
+    __slots__ = ("data", "start", "end", "use_arrays", "block_class", "args")
+
+    def __init__(self, data, start, end, use_arrays, block_class, *args):
+        self.data = data
+        self.start = start
+        self.end = end
+        self.use_arrays = use_arrays
+        self.block_class = block_class
+        self.args = args
+
+    def __call__(self):
+        return read_block(self.data, self.start, self.end, self.use_arrays,
+                          self.block_class, *self.args)
+
+    def __reduce__(self):
+        return (BlockLoader, (bytes(self.data[self.start:self.end]), 0,
+                              self.end - self.start, self.use_arrays,
+                              self.block_class) + self.args)
+
+
+class LazySequence(MutableSequence):
+    """ A list of named items which are created the first time they are
+        accessed.
+
+            Every item is given as a name and a loader, a callable returning
+            the item. The names of the items can be listed without loading
+            them. Items added to the sequence are stored as they are.
+    """
+
+    def __init__(self, names, loaders):
+        self.item_names = list(names)
+        self.loaders = list(loaders)
+        self.items = [None] * len(self.loaders)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        item = self.items[index]
+        if item is None:
+            item = self.loaders[index]()
+            self.items[index] = item
+            self.loaders[index] = None
+        return item
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self.item_names[index] = [item.name for item in value]
+            self.loaders[index] = [None] * len(value)
+            self.items[index] = value
+        else:
+            self.item_names[index] = value.name
+            self.loaders[index] = None
+            self.items[index] = value
+
+    def __delitem__(self, index):
+        del self.item_names[index]
+        del self.loaders[index]
+        del self.items[index]
+
+    def insert(self, index, value):
+        self.item_names.insert(index, value.name)
+        self.loaders.insert(index, None)
+        self.items.insert(index, value)
+
+    def names(self):
+        """ Returns the names of all items, without loading them """
+        return [name if item is None else item.name
+                for name, item in zip(self.item_names, self.items)]
+
+    def __repr__(self):
+        return "LazySequence(%r)" % self.names()
+
+
+def wants_animation(load_animations, name):
+    """ Tells if the animation `name` should be loaded, given the
+        `load_animations` option of Model.from_file """
+    if isinstance(load_animations, bool):
+        return load_animations
+    return name in load_animations
+
+
+def item_names(items):
+    """ Returns the names of the items in the list or LazySequence `items` """
+    if isinstance(items, LazySequence):
+        return items.names()
+    return [item.name for item in items]
+
+
+def find_named(items, name):
+    """ Returns the first item in the list or LazySequence `items` with the
+        name `name`, or None """
+    names = item_names(items)
+    if name in names:
+        return items[names.index(name)]
+    return None
 
 
 class Model(object):
@@ -96,95 +428,198 @@ class Model(object):
         self.animations.append(animation)
         return animation
 
-    def from_file(self, filename, ascii=True):
-        """ Loads a model from a ascii mdl file.
+    def from_file(self, filename, ascii=True, use_arrays=False, lazy=False,
+                  load_animations=True):
+        """ Loads a model from a ascii mdl file, or from a compiled model if
+            `ascii` is False.
+
+                If `use_arrays` is True, verts, faces, keys and other numeric
+                matrices are parsed in bulk and stored as numpy arrays.
+
+                If `lazy` is True, the ascii file is memory mapped and only
+                scanned for its blocks. Geometry nodes and animations are
+                parsed the first time they are accessed.
+
+                `load_animations` is True to load all animations, False to
+                load none of them or a collection of the names of the
+                animations to load. The other animations are skipped without
+                being tokenized.
         """
+        if use_arrays and numpy is None:
+            raise ImportError("Array mode requires numpy")
+
         if ascii:
             try:
-                model_file = open(filename)
+                model_file = open(filename, "rb" if lazy else "r")
 
             except:
                 pass
 
             else:
-                model_data = model_file.readlines()
-                model_file.close()
-
-                #remove comments, keeping empty lines
-                tmp_data = []
-
-                for line in model_data:
-                    comment_index = line.find('#')
-                    if comment_index >= 0:
-                        line = line[0:comment_index]
-
-                    tmp_data.append(line)
-
-                model_data = tmp_data
-                #done removing comments
+                with model_file:
+                    if lazy:
+                        self.from_mapped_file(model_file, use_arrays,
+                                              load_animations)
+                    else:
+                        self.from_stream(LineStream(model_file, use_arrays),
+                                         load_animations)
 
-                #tokenizes and removes newlines
-                model_data = [line.rstrip().split() for line in model_data]
+        else:
+            import_tool("mdl_binary").read_model(self, filename, use_arrays,
+                                                 load_animations)
+
+    def from_mapped_file(self, model_file, use_arrays=False,
+                         load_animations=True):
+        """ Reads the header of the model from the binary file object
+            `model_file` and sets up the geometry nodes and animations to be
+            read from the mapped file on demand """
+        try:
+            data = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            return
+
+        header_end, geometry_name, nodes, animations = scan_blocks(data)
+        animations = [animation for animation in animations
+                      if wants_animation(load_animations, animation[0])]
+
+        header_lines = data[:header_end].decode("latin-1").splitlines()
+        self.from_stream(LineStream(header_lines, use_arrays))
+
+        self.geometry.name = geometry_name
+        self.geometry.nodes = LazySequence(
+            [name for node_type, name, start, end in nodes],
+            [BlockLoader(data, start, end, use_arrays, Node, name, node_type)
+             for node_type, name, start, end in nodes])
+        self.animations = LazySequence(
+            [name for name, model_name, start, end in animations],
+            [BlockLoader(data, start, end, use_arrays, Animation, name,
+                         model_name)
+             for name, model_name, start, end in animations])
+
+    def weld_vertices(self, distance=None):
+        """ Merges the vertices closer than `distance` in all mesh nodes, see
+            mdl_mesh.weld_node. The distance defaults to
+            mdl_mesh.DEFAULT_WELD_DISTANCE. Returns the number of removed
+            vertices """
+        mdl_mesh = import_tool("mdl_mesh")
+        if distance is None:
+            distance = mdl_mesh.DEFAULT_WELD_DISTANCE
+        return mdl_mesh.weld_model(self, distance)
+
+    def reduce_keys(self, position_tolerance=None, angle_tolerance=None):
+        """ Removes the position and orientation keys of all animations which
+            are reproduced by interpolation within the tolerances, see
+            mdl_keys.reduce_animation. The tolerances default to the ones of
+            mdl_keys. Returns the number of removed keys """
+        mdl_keys = import_tool("mdl_keys")
+        if position_tolerance is None:
+            position_tolerance = mdl_keys.DEFAULT_POSITION_TOLERANCE
+        if angle_tolerance is None:
+            angle_tolerance = mdl_keys.DEFAULT_ANGLE_TOLERANCE
+        return mdl_keys.reduce_model(self, position_tolerance, angle_tolerance)
+
+    def fingerprint(self):
+        """ Returns a hash of the canonical content of the model, see the
+            mdl_fingerprint module """
+        return import_tool("mdl_fingerprint").fingerprint_model(self)
+
+    def summary(self):
+        """ Returns a dictionary with the header values of the model and the
+            names of its nodes and animations. Nodes and animations of a
+            lazily loaded model aren't parsed """
+        return {"name": self.name,
+                "supermodel": self.supermodel,
+                "classification": self.classification,
+                "setanimationscale": self.setanimationscale,
+                "nodes": item_names(self.geometry.nodes),
+                "animations": item_names(self.animations)}
+
+    def get_animation(self, name):
+        """ Returns the animation called `name`, or None if there is no such
+            animation. Other animations of a lazily loaded model aren't
+            parsed """
+        return find_named(self.animations, name)
+
+    def from_stream(self, model_data, load_animations=True):
+        """ Reads the model from the LineStream `model_data`.
+
+                Stops when it reaches a line with the token 'donemodel' or
+                when the stream is exhausted. Animations not selected by
+                `load_animations` are skipped, see from_file.
+        """
+        for current_line in model_data:
+            if "donemodel" in current_line:
+                break
 
-                self.model_data = model_data
+            if not current_line:  # skip empty lines
+                continue
 
-                line_count = 0
+            first_token = current_line[0].lower()
 
-                while model_data:
-                    current_line = model_data.pop(0)
-                    line_count += 1
+            if first_token == 'newmodel':
+                self.name = current_line[1]
 
-                    if "donemodel" in current_line:
-                        break
+            elif first_token == 'setsupermodel':
+                self.supermodel = current_line[2]
 
-                    if not current_line:  # skip empty lines
-                        continue
+            elif first_token == 'classification':
+                self.classification = str(current_line[1]).lower()
 
-                    first_token = current_line[0].lower()
+            elif first_token == 'setanimationscale':
+                self.setanimationscale = current_line[1]
 
-                    if first_token == 'newmodel':
-                        self.name = current_line[1]
+            elif first_token == 'beginmodelgeom':
+                geom_name = current_line[1]
+                self.geometry.name = geom_name
+                self.geometry.from_file(model_data)
 
-                    elif first_token == 'setsupermodel':
-                        self.supermodel = current_line[2]
+            elif first_token == 'newanim':
+                anim_name = current_line[1]
+                model_name = current_line[2]
 
-                    elif first_token == 'classification':
-                        self.classification = str(current_line[1]).lower()
+                if not wants_animation(load_animations, anim_name):
+                    model_data.skip_until("doneanim")
+                    continue
 
-                    elif first_token == 'setanimationscale':
-                        self.setanimationscale = current_line[1]
+                new_anim = Animation(anim_name, model_name)
+                new_anim.from_file(model_data)
+                self.animations.append(new_anim)
 
-                    elif first_token == 'beginmodelgeom':
-                        geom_name = current_line[1]
-                        self.geometry.name = geom_name
-                        self.geometry.from_file(model_data)
+    def write_binary(self, path):
+        """ Compiles the model and writes it to `path` in the binary format
+            read by the game """
+        import_tool("mdl_binary").write_model(self, path)
 
-                    elif first_token == 'newanim':
-                        anim_name = current_line[1]
-                        model_name = current_line[2]
+    def output_model(self):
+        yield "newmodel %s" % self.name
+        yield "setsupermodel %s %s" % (self.name, self.supermodel)
+        yield "classification %s" % self.classification
+        yield "setanimationscale %s" % self.setanimationscale
 
-                        new_anim = Animation(anim_name, model_name)
-                        new_anim.from_file(model_data)
-                        self.animations.append(new_anim)
+        for line in self.geometry.output_geometry():
+            yield line
 
+        if self.animations:
+            for animation in self.animations:
+                for line in animation.output_animation():
+                    yield line
         else:
-            print("Binary mdl-files not supported")
-
-    def __str__(self):
-        out_string = ""
-
-        out_string += "newmodel %s\n" % self.name
-        out_string += "setsupermodel %s %s\n" % (self.name, self.supermodel)
-        out_string += "classification %s\n" % self.classification
-        out_string += "setanimationscale %s\n" % self.setanimationscale
+            # A model without animations has an empty line before donemodel
+            yield ""
 
-        out_string += str(self.geometry) + "\n"
+        yield "donemodel %s" % self.name
 
-        out_string += "\n".join([str(animation) for animation in self.animations])
+    def write(self, fileobj):
+        """ Writes the model in ascii format to the file object `fileobj`.
 
-        out_string += "\ndonemodel %s\n" % self.name
+                The output is the same as str(model), but is written in
+                chunks instead of being built as one string.
+        """
+        write_lines(fileobj, self.output_model())
+        fileobj.write("\n")
 
-        return out_string
+    def __str__(self):
+        return "\n".join([line for line in self.output_model()]) + "\n"
 
 
 class Geometry:
@@ -195,21 +630,18 @@ class Geometry:
         self.nodes = []
 
     def from_file(self, model_data):
-        """ Read the geometry from the list of lists `model_data`.
+        """ Read the geometry from the LineStream `model_data`.
 
                 Creates nodes as they are encountered and stops when it reaches
                 a line with the tolen 'endmodelgeom'
 
         """
 
-        while model_data:
-            current_line = model_data.pop(0)
-
+        for current_line in model_data:
             if "endmodelgeom" in current_line:
                 break
 
             if not current_line:  # skip empty lines
-                current_line = model_data.pop(0)
                 continue
 
             if current_line[0] == "node":
@@ -220,6 +652,11 @@ class Geometry:
                 node.from_file(model_data)
                 self.nodes.append(node)
 
+    def get_node(self, name):
+        """ Returns the node called `name`, or None if there is no such node.
+            Other nodes of a lazily loaded model aren't parsed """
+        return find_named(self.nodes, name)
+
     def new_node(self, node_type, name):
         """ Create and return a new geometry node """
         node = Node(name, node_type)
@@ -229,40 +666,146 @@ class Geometry:
     def output_geometry(self):
         yield "beginmodelgeom %s" % self.name
         for node in self.nodes:
-            yield str(node)
+            for line in node.output_node():
+                yield line
         yield "endmodelgeom %s" % self.name
 
+    def write(self, fileobj):
+        """ Writes the geometry to the file object `fileobj`, the output is
+            the same as str(geometry) """
+        write_lines(fileobj, self.output_geometry())
+
     def __str__(self):
         return "\n".join([line for line in self.output_geometry()])
 
 
+class NodeSchema(object):
+    """ The properties of a node type, shared by all nodes of the type.
+
+            The property objects of the schema never hold values, the nodes
+            store the values of their written properties themselves.
+    """
+
+    schemas = {}
+    """ Compiled schemas by properties class and node type """
+
+    def __init__(self, properties_class, node_type):
+        self.node_type = node_type
+        self.props = tuple(properties_class.get_node_properties(node_type))
+        """ The properties in output order """
+        self.props_dict = dict((prop.name, prop) for prop in self.props)
+        self.dispatch = properties_class.get_dispatch_table(node_type)
+        """ Parse functions by token, see NodeProperties.get_dispatch_table """
+
+    @classmethod
+    def get(cls, properties_class, node_type):
+        """ Returns the schema of `node_type`, compiling it on first use """
+        key = (properties_class, node_type)
+        if key not in cls.schemas:
+            cls.schemas[key] = NodeSchema(properties_class, node_type)
+        return cls.schemas[key]
+
+
+class BoundProperty(object):
+    """ A property of a node schema bound to the value in one node.
+
+            Gives the interface of a property holding its own value, reading
+            and writing the value stored in the node. Other attributes are
+            taken from the schema property.
+    """
+    __slots__ = ("node", "prop")
+
+    def __init__(self, node, prop):
+        self.node = node
+        self.prop = prop
+
+    def __getattr__(self, attribute):
+        return getattr(self.prop, attribute)
+
+    @property
+    def value(self):
+        return self.node.values.get(self.prop.name)
+
+    @value.setter
+    def value(self, value):
+        self.node.values[self.prop.name] = value
+
+    @property
+    def value_written(self):
+        return self.prop.name in self.node.values
+
+    def read_value(self, current_line, model_data):
+        self.value = self.prop.parse_value(current_line, model_data)
+
+    def update_value(self, value):
+        self.value = self.prop.convert_value(value)
+
+    def get_rows(self):
+        return self.prop.value_rows(self.value)
+
+    def output_values(self):
+        return self.prop.format_value(self.value)
+
+    def __str__(self):
+        return "\n".join(line for line in self.output_values())
+
+
+class PropertyTable(Mapping):
+    """ A read-only mapping of the property names of a node to
+        BoundProperty objects, in output order """
+    __slots__ = ("node",)
+
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, name):
+        return BoundProperty(self.node, self.node.schema.props_dict[name])
+
+    def __contains__(self, name):
+        return name in self.node.schema.props_dict
+
+    def __iter__(self):
+        return (prop.name for prop in self.node.schema.props)
+
+    def __len__(self):
+        return len(self.node.schema.props)
+
+
 class Node:
-    """ The base class for all nodes """
+    """ The base class for all nodes.
+
+            A node only stores the values of its written properties, in the
+            dictionary `values`. The properties themselves are shared by all
+            nodes of a type through the NodeSchema.
+    """
+    __slots__ = ("name", "type", "schema", "values")
+
+    properties_class = node_props.GeometryNodeProperties
 
     def __init__(self, name, type):
         self.name = name
         self.type = type
-        props = node_props.GeometryNodeProperties.get_node_properties(self.type)
-        self.properties = {}
+        self.schema = NodeSchema.get(self.properties_class, type)
+        self.values = {}
 
-        for prop in props:
-            self.properties[prop.name] = copy.copy(prop)
+    @property
+    def properties(self):
+        return PropertyTable(self)
 
     def __getitem__(self, key):
-        if key in self.properties:
-            return self.properties[key].value
+        if key in self.schema.props_dict:
+            return self.values.get(key)
         else:
             raise KeyError
 
     def __setitem__(self, key, value):
-        if key in self.properties:
-            prop = self.properties[key]
-            prop.update_value(value)
+        if key in self.schema.props_dict:
+            self.values[key] = self.schema.props_dict[key].convert_value(value)
         else:
             raise KeyError
 
     def __iter__(self):
-        return self.properties.__iter__()
+        return iter(self.properties)
 
     def keys(self):
         return self.properties.keys()
@@ -271,38 +814,54 @@ class Node:
         return self.properties.items()
 
     def from_file(self, model_data):
-        while model_data:
-            current_line = model_data.pop(0)
-
-            if "endnode" in current_line:
-                break
+        dispatch = self.schema.dispatch
+        values = self.values
 
+        for current_line in model_data:
             if not current_line:  # skip empty lines
                 continue
 
-            if current_line[0] == "setfillumcolor":
-                current_line[0] = "selfillumcolor"
+            entry = dispatch.get(current_line[0])
+            if entry is not None:
+                name, parse = entry
+                values[name] = parse(current_line, model_data)
+
+            elif "endnode" in current_line:
+                break
+
+    def __getstate__(self):
+        # Only the written values are pickled, the schema is looked up again
+        # when unpickling
+        return {"name": self.name, "type": self.type, "values": self.values}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], state["type"])
+        self.values.update(state["values"])
 
-            if current_line[0] in self.properties:
-                self.properties[current_line[0]].read_value(current_line, model_data)
+    def fingerprint(self):
+        """ Returns a hash of the canonical content of the node """
+        return import_tool("mdl_fingerprint").fingerprint_node(self)
 
     def get_prop_value(self, property):
-        if property not in self.properties:
+        if property not in self.schema.props_dict:
             return None
-        #print("get_prop_value: %s, value: %s" % (property, self.properties[property].value))
-        return self.properties[property].value
+        return self.values.get(property)
 
     def output_node(self):
-        # We get the properties list from the GeometryNodeProperties to
-        # produce the output in the correct order
-        props = node_props.GeometryNodeProperties.get_node_properties(self.type)
+        # The schema lists the properties in the correct output order
+        values = self.values
         yield "node %s %s" % (self.type, self.name)
-        for property in props:
-            if property.name in self.properties:
-                if self.properties[property.name].value_written:
-                    yield str(self.properties[property.name])
+        for prop in self.schema.props:
+            if prop.name in values:
+                for line in prop.format_value(values[prop.name]):
+                    yield line
         yield "endnode"
 
+    def write(self, fileobj):
+        """ Writes the node to the file object `fileobj`, the output is the
+            same as str(node) """
+        write_lines(fileobj, self.output_node())
+
     def __str__(self):
         return "\n".join([line for line in self.output_node()])
 
@@ -325,14 +884,11 @@ class Animation:
         return animation_node
 
     def from_file(self, model_data):
-        while model_data:
-            current_line = model_data.pop(0)
-
+        for current_line in model_data:
             if "doneanim" in current_line:
                 break
 
             if not current_line:  # skip empty lines
-                current_line = model_data.pop(0)
                 continue
 
             if current_line[0] == "length":
@@ -355,6 +911,10 @@ class Animation:
                 node.from_file(model_data)
                 self.nodes.append(node)
 
+    def fingerprint(self):
+        """ Returns a hash of the canonical content of the animation """
+        return import_tool("mdl_fingerprint").fingerprint_animation(self)
+
     def output_animation(self):
         yield "newanim %s %s" % (self.name, self.mdl_name)
         yield " " * TAB_WIDTH + "length %s" % str(self.length)
@@ -363,34 +923,23 @@ class Animation:
         for time, event in self.events:
             yield " " * TAB_WIDTH + "event %.9g %s" % (time, event)
         for node in self.nodes:
-            yield str(node)
+            for line in node.output_node():
+                yield line
         yield "doneanim %s %s" % (self.name, self.mdl_name)
 
+    def write(self, fileobj):
+        """ Writes the animation to the file object `fileobj`, the output is
+            the same as str(animation) """
+        write_lines(fileobj, self.output_animation())
+
     def __str__(self):
         return "\n".join([line for line in self.output_animation()])
 
 
 class AnimationNode(Node):
-    def __init__(self, name, node_type):
-
-        self.name = name
-        self.type = node_type
-        props = node_props.AnimationNodeProperties.get_node_properties(self.type)
-        self.properties = {}
+    __slots__ = ()
 
-        for prop in props:
-            self.properties[prop.name] = copy.copy(prop)
-
-    def output_node(self):
-        # We get the properties list from the GeometryNodeProperties to
-        # produce the output in the correct order
-        props = node_props.AnimationNodeProperties.get_node_properties(self.type)
-        yield "node %s %s" % (self.type, self.name)
-        for property in props:
-            if property.name in self.properties:
-                if self.properties[property.name].value_written:
-                    yield str(self.properties[property.name])
-        yield "endnode"
+    properties_class = node_props.AnimationNodeProperties
 
 
 if __name__ == "__main__":
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+'''
+Contains spatial queries over the AABB trees of walkmesh nodes.
+
+The queries take many points, rays or boxes at once and traverse the tree for
+all of them together, level by level, with numpy. They work on the AABBTree
+values read from models as well as the trees built by the exporter.
+
+The queries require numpy, creating an AABBQuery without it raises an
+ImportError.
+
+@author: Erik Ylipää
+'''
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EPSILON = 1e-6
+""" Tolerance of the point and ray tests, in model units """
+
+
+class AABBQuery(object):
+    """ Spatial queries over the faces of an AABB tree.
+
+            `tree` is the value of an AABBTree property, `verts` and `faces`
+            the verts and faces of the same node. The leaves of the tree
+            refer to the rows of `faces`.
+    """
+
+    def __init__(self, tree, verts, faces):
+        if numpy is None:
+            raise ImportError("Spatial queries require numpy")
+        self.lows, self.highs, self.left, self.right, self.face = tree_arrays(tree)
+        verts = numpy.asarray(verts, dtype=float).reshape(-1, 3)
+        corners = numpy.asarray(faces).reshape(len(faces), -1)[:, :3].astype(int)
+        self.triangles = verts[corners]
+
+    @classmethod
+    def from_node(cls, node):
+        """ Returns the query of the aabb tree of a model node """
+        return cls(node["aabb"], node["verts"], node["faces"])
+
+    def candidates(self, count, box_test):
+        """ Traverses the tree for `count` queries at once, returns the pairs
+            of query and face indices of the leaves reached.
+
+                `box_test(queries, nodes)` returns a boolean array telling
+                which of the query and node pairs should be visited.
+        """
+        queries = numpy.arange(count)
+        nodes = numpy.zeros(count, dtype=int)
+        found_queries = []
+        found_faces = []
+        if not len(self.face):
+            queries = queries[:0]
+
+        while len(queries):
+            hit = box_test(queries, nodes)
+            queries = queries[hit]
+            nodes = nodes[hit]
+
+            leaf = self.face[nodes] >= 0
+            found_queries.append(queries[leaf])
+            found_faces.append(self.face[nodes[leaf]])
+
+            queries = queries[~leaf]
+            nodes = nodes[~leaf]
+            queries = numpy.concatenate((queries, queries))
+            nodes = numpy.concatenate((self.left[nodes], self.right[nodes]))
+            has_child = nodes >= 0
+            queries = queries[has_child]
+            nodes = nodes[has_child]
+
+        if not found_queries:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+        return numpy.concatenate(found_queries), numpy.concatenate(found_faces)
+
+    def locate_points(self, points, epsilon=EPSILON):
+        """ Finds the faces below or above `points` when looking along the z
+            axis, like the game does when placing things on the walkmesh.
+
+                `points` are rows of (x, y) or (x, y, z). Returns the arrays
+                (faces, heights) with the face index and the height of the
+                face at every point, or -1 and nan where there is no face. If
+                several faces are found the one closest to the z coordinate
+                of the point is used, or the highest if there is none.
+        """
+        points = numpy.asarray(points, dtype=float)
+        count = len(points)
+        xy = points[:, :2]
+
+        def box_test(queries, nodes):
+            return (numpy.all(self.lows[nodes, :2] - epsilon <= xy[queries], axis=1) &
+                    numpy.all(xy[queries] <= self.highs[nodes, :2] + epsilon, axis=1))
+
+        queries, faces = self.candidates(count, box_test)
+        inside, heights = project_to_triangles(xy[queries], self.triangles[faces], epsilon)
+        queries = queries[inside]
+        faces = faces[inside]
+        heights = heights[inside]
+
+        if points.shape[1] > 2:
+            scores = -numpy.abs(heights - points[queries, 2])
+        else:
+            scores = heights
+        return pick_best(count, queries, faces, scores, heights,
+                         missing_value=numpy.nan)
+
+    def raycast(self, origins, directions, max_distance=math.inf):
+        """ Finds the first face hit by every ray.
+
+                Returns the arrays (faces, distances) where the distances are
+                in units of the length of the direction, or -1 and inf where
+                the ray misses or hits nothing within `max_distance`.
+        """
+        origins = numpy.asarray(origins, dtype=float).reshape(-1, 3)
+        directions = numpy.asarray(directions, dtype=float).reshape(-1, 3)
+        count = len(origins)
+        with numpy.errstate(divide="ignore"):
+            inverse = 1.0 / directions
+
+        def box_test(queries, nodes):
+            with numpy.errstate(invalid="ignore"):
+                near = (self.lows[nodes] - origins[queries]) * inverse[queries]
+                far = (self.highs[nodes] - origins[queries]) * inverse[queries]
+            entry = numpy.fmax.reduce(numpy.fmin(near, far), axis=1)
+            leave = numpy.fmin.reduce(numpy.fmax(near, far), axis=1)
+            return ((leave >= numpy.maximum(entry, 0) - EPSILON) &
+                    (entry <= max_distance))
+
+        queries, faces = self.candidates(count, box_test)
+        distances = intersect_triangles(origins[queries], directions[queries],
+                                        self.triangles[faces])
+        #Missed faces are at inf, which is within the default max_distance
+        hit = numpy.isfinite(distances) & (distances <= max_distance)
+        queries = queries[hit]
+        faces = faces[hit]
+        distances = distances[hit]
+        return pick_best(count, queries, faces, -distances, distances,
+                         missing_value=numpy.inf)
+
+    def intersect_segments(self, starts, ends):
+        """ Finds the first face crossed by every segment from `starts` to
+            `ends`, returns the arrays (faces, fractions) where the fractions
+            tell how far along the segment the face was hit """
+        starts = numpy.asarray(starts, dtype=float).reshape(-1, 3)
+        ends = numpy.asarray(ends, dtype=float).reshape(-1, 3)
+        return self.raycast(starts, ends - starts, max_distance=1.0)
+
+    def nearest_faces(self, points):
+        """ Finds the face closest to every point.
+
+                Returns the arrays (faces, distances, closest) with the index
+                of the nearest face, the distance to it and the closest point
+                on it.
+        """
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        count = len(points)
+        best_faces = numpy.full(count, -1, dtype=int)
+        best_distances = numpy.full(count, numpy.inf)
+        best_points = numpy.full((count, 3), numpy.nan)
+        if not len(self.face) or not count:
+            return best_faces, best_distances, best_points
+
+        def update(queries, faces):
+            closest = closest_points(points[queries], self.triangles[faces])
+            distances = numpy.sqrt(((closest - points[queries]) ** 2).sum(axis=1))
+            #Only the nearest candidate of every query is kept
+            order = numpy.lexsort((distances, queries))
+            queries = queries[order]
+            first = numpy.ones(len(queries), dtype=bool)
+            first[1:] = queries[1:] != queries[:-1]
+            better = first.copy()
+            better[first] = distances[order][first] < best_distances[queries[first]]
+            winners = order[better]
+            best_queries = queries[better]
+            best_faces[best_queries] = faces[winners]
+            best_distances[best_queries] = distances[winners]
+            best_points[best_queries] = closest[winners]
+
+        #A first bound is found by descending to the closest child
+        queries = numpy.arange(count)
+        nodes = numpy.zeros(count, dtype=int)
+        while True:
+            inner = self.face[nodes] < 0
+            if not inner.any():
+                break
+            left = self.left[nodes[inner]]
+            right = self.right[nodes[inner]]
+            left_distances = numpy.where(left >= 0, box_distances(
+                points[inner], self.lows[left], self.highs[left]), numpy.inf)
+            right_distances = numpy.where(right >= 0, box_distances(
+                points[inner], self.lows[right], self.highs[right]), numpy.inf)
+            nodes[inner] = numpy.where(left_distances <= right_distances, left, right)
+        update(queries, self.face[nodes])
+
+        def box_test(queries, nodes):
+            return (box_distances(points[queries], self.lows[nodes], self.highs[nodes]) <=
+                    best_distances[queries])
+
+        queries, faces = self.candidates(count, box_test)
+        if len(queries):
+            update(queries, faces)
+        return best_faces, best_distances, best_points
+
+    def overlapping_faces(self, lows, highs):
+        """ Finds the faces whose bounding boxes overlap the boxes with the
+            corners `lows` and `highs`.
+
+                Returns the arrays (boxes, faces) of all overlapping pairs,
+                sorted by box and face.
+        """
+        lows = numpy.asarray(lows, dtype=float).reshape(-1, 3)
+        highs = numpy.asarray(highs, dtype=float).reshape(-1, 3)
+
+        def box_test(queries, nodes):
+            return (numpy.all(self.lows[nodes] <= highs[queries], axis=1) &
+                    numpy.all(lows[queries] <= self.highs[nodes], axis=1))
+
+        queries, faces = self.candidates(len(lows), box_test)
+        triangles = self.triangles[faces]
+        overlap = (numpy.all(triangles.min(axis=1) <= highs[queries], axis=1) &
+                   numpy.all(lows[queries] <= triangles.max(axis=1), axis=1))
+        queries = queries[overlap]
+        faces = faces[overlap]
+        order = numpy.lexsort((faces, queries))
+        return queries[order], faces[order]
+
+
+def tree_arrays(tree):
+    """ Returns the nodes of an AABBTree value as the arrays (lows, highs,
+        left, right, face). Missing children and the faces of inner nodes
+        are -1 """
+    if hasattr(tree, "bounds"):
+        # The columns of flat trees are copied, a view would lock the arrays
+        # of the tree against resizing
+        bounds = numpy.array(tree.bounds, dtype=float).reshape(-1, 6)
+        return (bounds[:, :3], bounds[:, 3:],
+                numpy.array(tree.left, dtype=int),
+                numpy.array(tree.right, dtype=int),
+                numpy.array(tree.face, dtype=int))
+
+    lows = []
+    highs = []
+    left = []
+    right = []
+    face = []
+    node_stack = [(tree, -1, False)] if tree else []
+    while node_stack:
+        tree_node, parent, is_right = node_stack.pop()
+        index = len(face)
+        if parent >= 0:
+            (right if is_right else left)[parent] = index
+        lows.append(tree_node["co1"])
+        highs.append(tree_node["co2"])
+        left.append(-1)
+        right.append(-1)
+        face.append(tree_node["index"])
+        if tree_node["right"]:
+            node_stack.append((tree_node["right"], index, True))
+        if tree_node["left"]:
+            node_stack.append((tree_node["left"], index, False))
+
+    return (numpy.array(lows, dtype=float).reshape(-1, 3),
+            numpy.array(highs, dtype=float).reshape(-1, 3),
+            numpy.array(left, dtype=int), numpy.array(right, dtype=int),
+            numpy.array(face, dtype=int))
+
+
+def pick_best(count, queries, faces, scores, values, missing_value):
+    """ Returns the arrays (faces, values) with the face and value of the
+        highest scoring candidate of every query """
+    best_faces = numpy.full(count, -1, dtype=int)
+    best_values = numpy.full(count, missing_value, dtype=float)
+    if len(queries):
+        order = numpy.lexsort((-scores, queries))
+        queries = queries[order]
+        first = numpy.ones(len(queries), dtype=bool)
+        first[1:] = queries[1:] != queries[:-1]
+        best_faces[queries[first]] = faces[order][first]
+        best_values[queries[first]] = values[order][first]
+    return best_faces, best_values
+
+
+def project_to_triangles(xy, triangles, epsilon=EPSILON):
+    """ Projects points along the z axis onto triangles. Returns the arrays
+        (inside, heights), faces seen edge on from above are never hit """
+    a = triangles[:, 0]
+    ab = triangles[:, 1] - a
+    ac = triangles[:, 2] - a
+    ap = xy - a[:, :2]
+    denominator = ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        v = (ap[:, 0] * ac[:, 1] - ap[:, 1] * ac[:, 0]) / denominator
+        w = (ab[:, 0] * ap[:, 1] - ab[:, 1] * ap[:, 0]) / denominator
+    tolerance = epsilon / numpy.maximum(numpy.sqrt(numpy.abs(denominator)), epsilon)
+    inside = ((numpy.abs(denominator) > epsilon * epsilon) &
+              (v >= -tolerance) & (w >= -tolerance) & (v + w <= 1 + tolerance))
+    heights = a[:, 2] + v * ab[:, 2] + w * ac[:, 2]
+    return inside, heights
+
+
+def intersect_triangles(origins, directions, triangles):
+    """ Returns the ray distances to the triangles with the Möller-Trumbore
+        test, inf where the ray misses """
+    a = triangles[:, 0]
+    ab = triangles[:, 1] - a
+    ac = triangles[:, 2] - a
+    p = numpy.cross(directions, ac)
+    determinant = (ab * p).sum(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1.0 / determinant
+        t = origins - a
+        u = (t * p).sum(axis=1) * inverse
+        q = numpy.cross(t, ab)
+        v = (directions * q).sum(axis=1) * inverse
+        distances = (ac * q).sum(axis=1) * inverse
+    hit = ((numpy.abs(determinant) > EPSILON * EPSILON) &
+           (u >= -EPSILON) & (v >= -EPSILON) & (u + v <= 1 + EPSILON) &
+           (distances >= 0))
+    return numpy.where(hit, distances, numpy.inf)
+
+
+def closest_points(points, triangles):
+    """ Returns the closest point on each triangle to each point """
+    a = triangles[:, 0]
+    b = triangles[:, 1]
+    c = triangles[:, 2]
+    ab = b - a
+    ac = c - a
+    bc = c - b
+
+    def dot(x, y):
+        return (x * y).sum(axis=1)
+
+    ap = points - a
+    bp = points - b
+    cp = points - c
+    d1 = dot(ab, ap)
+    d2 = dot(ac, ap)
+    d3 = dot(ab, bp)
+    d4 = dot(ac, bp)
+    d5 = dot(ab, cp)
+    d6 = dot(ac, cp)
+    vc = d1 * d4 - d3 * d2
+    vb = d5 * d2 - d1 * d6
+    va = d3 * d6 - d5 * d4
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        on_ab = a + ab * (d1 / (d1 - d3))[:, None]
+        on_ac = a + ac * (d2 / (d2 - d6))[:, None]
+        on_bc = b + bc * ((d4 - d3) / ((d4 - d3) + (d5 - d6)))[:, None]
+        denominator = 1.0 / (va + vb + vc)
+        inside = (a + ab * (vb * denominator)[:, None] +
+                  ac * (vc * denominator)[:, None])
+
+    #The Voronoi regions of the triangle, tested in order
+    conditions = [(d1 <= 0) & (d2 <= 0),
+                  (d3 >= 0) & (d4 <= d3),
+                  (vc <= 0) & (d1 >= 0) & (d3 <= 0),
+                  (d6 >= 0) & (d5 <= d6),
+                  (vb <= 0) & (d2 >= 0) & (d6 <= 0),
+                  (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)]
+    choices = [a, b, on_ab, c, on_ac, on_bc]
+    region = numpy.select(conditions, list(range(len(conditions))), len(conditions))
+    closest = inside.copy()
+    for index, choice in enumerate(choices):
+        selected = region == index
+        closest[selected] = choice[selected]
+    return closest
+
+
+def box_distances(points, lows, highs):
+    """ Returns the distances from points to boxes, 0 inside the boxes """
+    offsets = numpy.maximum(numpy.maximum(lows - points, points - highs), 0)
+    return numpy.sqrt((offsets ** 2).sum(axis=1))
@@ -0,0 +1,1297 @@
+# -*- coding: utf-8 -*-
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+'''
+Contains functions for reading and writing compiled (binary) Neverwinter Nights
+models.
+
+A compiled model is a dump of the structures the game uses in memory. The file
+starts with a 12 byte header, followed by the model data (headers, node trees,
+face lists, controllers) and the raw data (vertex arrays). Offsets in the model
+data are relative to the end of the file header, offsets into the raw data are
+relative to the start of the raw data.
+
+The reader fills an `mdl.Model` through its normal methods, so the result is
+the same as when reading the ascii version of the model. The writer compiles an
+`mdl.Model` to the same layout, computing the face planes, adjacency, normals
+and bounding boxes the game expects.
+
+The layouts follow the published descriptions of the format. The reader and
+the writer are only tested against each other, not against models compiled by
+the game or nwnmdlcomp, so the controller tables and AABB entries in
+particular may differ from what the original compiler produces.
+
+@author: Erik Ylipää
+'''
+
+import math
+import struct
+
+try:
+    from . import props_classes
+except ValueError:
+    import props_classes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FILE_HEADER = struct.Struct("<III")
+""" zero, offset of the raw data, size of the raw data """
+
+GEOMETRY_HEADER = struct.Struct("<8x64sII28xB3x")
+""" name, root node offset, node count, geometry type """
+
+MODEL_HEADER = struct.Struct("<2xBB4xII4x4x24x4xf64s")
+""" classification, fog, animation offsets, animation count, animation scale
+    and supermodel name """
+
+ANIMATION_HEADER = struct.Struct("<ff64sII4x")
+""" length, transtime, animroot, event offset, event count """
+
+EVENT = struct.Struct("<f32s")
+
+NODE_HEADER = struct.Struct("<24xII32s4xIII4xII4xII4xI")
+""" inherit color, part number, name, parent offset, child offsets, child
+    count, controller key offset, key count, controller data offset, data count
+    and node flags """
+
+CONTROLLER_KEY = struct.Struct("<ihhhBx")
+""" controller type, rows, time offset, data offset, columns """
+
+MESH_HEADER = struct.Struct("<8xII4x40x3f3f3ff4I4x64s64s64s64sI64xIHH4I4xI24x1xB2x8x")
+""" face offset, face count, diffuse, ambient, specular, shininess, shadow,
+    beaming, render, transparency hint, four textures, tile fade, vertex
+    offset, vertex count, texture count, four texture vertex offsets, vertex
+    color offset and rotate texture """
+
+FACE = struct.Struct("<16xI6x3h")
+""" surface id and vertex indices """
+
+DANGLY_HEADER = struct.Struct("<II4xfff")
+""" constraint offset, constraint count, displacement, tightness, period """
+
+SKIN_HEADER = struct.Struct("<12xII44x17h2x")
+""" weight offset, bone reference offset, bone part numbers """
+
+AABB_HEADER = struct.Struct("<I")
+
+AABB_ENTRY = struct.Struct("<6fIIiI")
+""" bounding box, left child offset, right child offset, face index, plane """
+
+LIGHT_HEADER = struct.Struct("<f60x7I")
+""" flare radius, priority, ambient only, dynamic, affect dynamic, shadow,
+    lens flares, fading light """
+
+REFERENCE_HEADER = struct.Struct("<64sI")
+
+EMITTER_HEADER = struct.Struct("<3f3I32s32s32s64s16sIIH2xI")
+""" dead space, blast radius, blast length, x grid, y grid, spawn type,
+    update, render, blend, texture, chunk name, two sided texture, loop,
+    render order and emitter flags """
+
+
+# Complete layouts of the structures, used when compiling. The reader skips
+# the fields it doesn't need.
+
+MODEL_LAYOUT = struct.Struct("<2xBB4x3II3f3fff64s")
+""" classification, fog, animation array, supermodel pointer, bounding box,
+    radius, animation scale and supermodel name """
+
+NODE_LAYOUT = struct.Struct("<24xII32s12I")
+""" inherit color, part number, name, geometry header offset, parent offset,
+    child array, controller key array, controller data array and flags """
+
+MESH_LAYOUT = struct.Struct("<8x3I3f3ff3f3f3f3ff5I64s64s64s64sI12I2iB3xIIHH4III6IBB2xfI")
+
+FACE_LAYOUT = struct.Struct("<4fI3h3h")
+""" plane normal, plane distance, surface id, adjacent faces, vertices """
+
+SKIN_LAYOUT = struct.Struct("<3IIIII3I3I3I17h2x")
+
+AABB_ENTRY_LAYOUT = struct.Struct("<6fIIiI")
+""" bounding box, left child offset, right child offset, face index and the
+    plane the children are split along """
+
+AABB_PLANE_AXES = {1: 0, 2: 1, 4: 2}
+""" The split axes of the plane flags of AABB entries """
+
+
+NO_OFFSET = 0xFFFFFFFF
+
+NODE_HEADER_FLAG = 0x001
+NODE_LIGHT_FLAG = 0x002
+NODE_EMITTER_FLAG = 0x004
+NODE_REFERENCE_FLAG = 0x010
+NODE_MESH_FLAG = 0x020
+NODE_SKIN_FLAG = 0x040
+NODE_DANGLY_FLAG = 0x100
+NODE_AABB_FLAG = 0x200
+
+NODE_TYPES = {0x001: "dummy",
+              0x003: "light",
+              0x005: "emitter",
+              0x009: "dummy",  # camera
+              0x011: "reference",
+              0x021: "trimesh",
+              0x061: "skin",
+              0x0A1: "trimesh",  # animmesh
+              0x121: "danglymesh",
+              0x221: "aabb"}
+""" Node types by node flags. Types not supported by Borealis are mapped to the
+    closest supported type """
+
+ANIMATION_NODE_TYPES = ["dummy", "trimesh", "danglymesh", "skin", "emitter", "light"]
+
+NODE_FLAGS = dict((node_type, flags) for flags, node_type in
+                  sorted(NODE_TYPES.items(), reverse=True))
+""" Node flags by node type """
+
+CLASSIFICATIONS = {0x01: "effect",
+                   0x02: "tile",
+                   0x04: "character",
+                   0x08: "door",
+                   0x10: "item",
+                   0x20: "gui"}
+
+EMITTER_FLAGS = [(0x0001, "p2p"),
+                 (0x0002, "p2p_sel"),
+                 (0x0004, "affectedbywind"),
+                 (0x0008, "m_istinted"),
+                 (0x0010, "bounce"),
+                 (0x0020, "random"),
+                 (0x0040, "inherit"),
+                 (0x0080, "inheritvel"),
+                 (0x0100, "inherit_local"),
+                 (0x0200, "splat"),
+                 (0x0400, "inherit_part")]
+
+POSITION_CONTROLLER = 8
+ORIENTATION_CONTROLLER = 20
+BEZIER_FLAG = 0x10
+
+MAX_SKIN_BONES = 17
+
+GEOMETRY_MODEL = 2
+GEOMETRY_ANIMATION = 5
+TRIANGLE_MODE = 3
+
+GEOMETRY_CONTROLLERS = {"common": {8: "position",
+                                   20: "orientation",
+                                   36: "scale"},
+                        "mesh": {100: "selfillumcolor",
+                                 128: "alpha"},
+                        "light": {76: "color",
+                                  88: "radius",
+                                  140: "multiplier"},
+                        "emitter": {80: "alphaend",
+                                    84: "alphastart",
+                                    88: "birthrate",
+                                    92: "bounce_co",
+                                    96: "colorend",
+                                    108: "colorstart",
+                                    120: "combinetime",
+                                    124: "drag",
+                                    128: "fps",
+                                    132: "frameend",
+                                    136: "framestart",
+                                    140: "grav",
+                                    144: "lifeexp",
+                                    148: "mass",
+                                    152: "p2p_bezier2",
+                                    156: "p2p_bezier3",
+                                    160: "particlerot",
+                                    164: "randvel",
+                                    168: "sizestart",
+                                    172: "sizeend",
+                                    176: "sizestart_y",
+                                    180: "sizeend_y",
+                                    184: "spread",
+                                    188: "threshold",
+                                    192: "velocity",
+                                    196: "xsize",
+                                    200: "ysize",
+                                    204: "blurlength",
+                                    208: "lightningdelay",
+                                    212: "lightningradius",
+                                    216: "lightningscale"}}
+""" Names of the geometry node properties set by controllers, by controller
+    type. The controller types are only unique within a kind of node """
+
+ANIMATION_CONTROLLERS = {"common": {8: "positionkey",
+                                    20: "orientationkey"},
+                         "mesh": {},
+                         "light": {},
+                         "emitter": {80: "alphaEndkey",
+                                     84: "alphaStartkey",
+                                     88: "birthratekey",
+                                     96: "colorEndkey",
+                                     108: "colorStartkey",
+                                     128: "fpskey",
+                                     132: "frameEndkey",
+                                     136: "frameStartkey",
+                                     144: "lifeExpkey",
+                                     148: "masskey",
+                                     164: "randvelkey",
+                                     168: "sizeStartkey",
+                                     172: "sizeEndkey",
+                                     184: "spreadkey",
+                                     192: "velocitykey",
+                                     196: "xsizekey",
+                                     200: "ysizekey"}}
+""" Names of the animation node keys set by controllers, by controller type """
+
+
+def is_binary(filename):
+    """ Returns True if the file is a compiled model """
+    with open(filename, "rb") as model_file:
+        magic = model_file.read(4)
+    return magic == b"\0\0\0\0"
+
+
+def read_model(model, filename, use_arrays=False, load_animations=True):
+    """ Reads the compiled model `filename` into the mdl.Model `model`.
+
+            If `use_arrays` is True, vertex, face and key data are stored as
+            numpy arrays. Vertex arrays are then views into the file buffer.
+            `load_animations` selects the animations to read, like in
+            mdl.Model.from_file.
+    """
+    with open(filename, "rb") as model_file:
+        model_file.seek(0, 2)
+        buffer = bytearray(model_file.tell())
+        model_file.seek(0)
+        model_file.readinto(buffer)
+
+    BinaryModelReader(buffer, use_arrays, load_animations).read_model(model)
+
+
+def decode_string(data):
+    """ Decodes a zero terminated fixed length string """
+    return data.split(b"\0", 1)[0].decode("latin-1")
+
+
+def quaternion_to_axis_angle(x, y, z, w):
+    """ Converts a quaternion to the axis-angle form used in ascii models.
+        The quaternion doesn't have to be of unit length, the axis is always
+        normalized """
+    norm = math.sqrt(x * x + y * y + z * z)
+    if norm == 0:
+        return [0.0, 0.0, 0.0, 0.0]
+    return [x / norm, y / norm, z / norm, 2 * math.atan2(norm, w)]
+
+
+def quaternions_to_axis_angles(quaternions):
+    """ Converts an (N, 4) array of quaternions to an (N, 4) array of
+        axis-angles, computed in double precision like
+        quaternion_to_axis_angle """
+    quaternions = numpy.asarray(quaternions, dtype=numpy.float64)
+    norm = numpy.sqrt((quaternions[:, :3] ** 2).sum(axis=1))
+    identity = norm == 0
+    axis_angles = numpy.empty(quaternions.shape, dtype=numpy.float64)
+    axis_angles[:, :3] = quaternions[:, :3] / numpy.where(identity, 1.0, norm)[:, numpy.newaxis]
+    axis_angles[:, 3] = 2 * numpy.arctan2(norm, quaternions[:, 3])
+    axis_angles[identity] = 0.0
+    return axis_angles
+
+
+class BinaryModelReader(object):
+    """ Reads the structures of a compiled model from a buffer """
+
+    def __init__(self, buffer, use_arrays=False, load_animations=True):
+        if use_arrays and numpy is None:
+            raise ImportError("Array mode requires numpy")
+
+        self.buffer = buffer
+        self.use_arrays = use_arrays
+        self.load_animations = load_animations
+
+        zero, raw_offset, raw_size = FILE_HEADER.unpack_from(buffer, 0)
+        if zero != 0:
+            raise ValueError("Not a compiled model")
+        self.model_start = FILE_HEADER.size
+        self.raw_start = FILE_HEADER.size + raw_offset
+
+        #Names of the geometry nodes by part number, used for skin weights
+        self.part_names = {}
+        self.skin_nodes = []
+
+    def unpack(self, structure, offset):
+        return structure.unpack_from(self.buffer, self.model_start + offset)
+
+    def values(self, type_code, start, count):
+        """ Returns `count` values of `type_code` starting at the absolute
+            offset `start`, as an array view or a list """
+        if self.use_arrays:
+            return numpy.frombuffer(self.buffer, "<" + type_code, count, start)
+        return list(struct.unpack_from("<%d%s" % (count, type_code), self.buffer, start))
+
+    def model_values(self, type_code, offset, count):
+        return self.values(type_code, self.model_start + offset, count)
+
+    def raw_values(self, type_code, offset, count):
+        return self.values(type_code, self.raw_start + offset, count)
+
+    def rows(self, values, columns):
+        if self.use_arrays:
+            return values.reshape(-1, columns)
+        return [values[i:i + columns] for i in range(0, len(values), columns)]
+
+    def read_model(self, model):
+        name, root_offset, node_count, geometry_type = self.unpack(GEOMETRY_HEADER, 0)
+        (classification, fog, animation_offsets, animation_count,
+         animation_scale, supermodel) = self.unpack(MODEL_HEADER, GEOMETRY_HEADER.size)
+
+        model.name = decode_string(name)
+        model.geometry.name = model.name
+        model.supermodel = decode_string(supermodel) or "NULL"
+        model.classification = CLASSIFICATIONS.get(classification, "")
+        model.setanimationscale = animation_scale
+
+        self.read_node_tree(model.geometry.new_node, root_offset, False)
+        for node in self.skin_nodes:
+            self.read_skin_weights(*node)
+
+        for animation_offset in self.model_values("I", animation_offsets, animation_count):
+            if self.load_animations is True:
+                self.read_animation(model, animation_offset)
+            elif self.load_animations:
+                name = self.unpack(GEOMETRY_HEADER, animation_offset)[0]
+                if decode_string(name) in self.load_animations:
+                    self.read_animation(model, animation_offset)
+
+    def read_animation(self, model, offset):
+        name, root_offset, node_count, geometry_type = self.unpack(GEOMETRY_HEADER, offset)
+        (length, transtime, animroot,
+         event_offset, event_count) = self.unpack(ANIMATION_HEADER, offset + GEOMETRY_HEADER.size)
+
+        animation = model.new_animation(decode_string(name))
+        animation.length = length
+        animation.transtime = transtime
+        animation.animroot = decode_string(animroot)
+
+        for i in range(event_count):
+            time, event = self.unpack(EVENT, event_offset + i * EVENT.size)
+            animation.events.append((time, decode_string(event)))
+
+        self.read_node_tree(animation.new_node, root_offset, True)
+
+    def read_node_tree(self, new_node, root_offset, animation):
+        """ Reads the node tree depth first, in the order the nodes are
+            written in ascii models """
+        node_stack = [(root_offset, "NULL")]
+        while node_stack:
+            offset, parent = node_stack.pop()
+            node, children = self.read_node(new_node, offset, parent, animation)
+            node_stack.extend((child, node.name) for child in reversed(children))
+
+    def read_node(self, new_node, offset, parent, animation):
+        (inherit_color, part_number, name, parent_offset,
+         child_offsets, child_count, key_offset, key_count,
+         data_offset, data_count, flags) = self.unpack(NODE_HEADER, offset)
+
+        node_type = NODE_TYPES.get(flags, "dummy")
+        if animation and node_type not in ANIMATION_NODE_TYPES:
+            node_type = "dummy"
+
+        node = new_node(node_type, decode_string(name))
+        node['parent'] = parent
+
+        if flags & NODE_EMITTER_FLAG:
+            kind = "emitter"
+        elif flags & NODE_LIGHT_FLAG:
+            kind = "light"
+        elif flags & NODE_MESH_FLAG:
+            kind = "mesh"
+        else:
+            kind = "common"
+
+        if key_count:
+            controller_data = self.model_values("f", data_offset, data_count)
+            for i in range(key_count):
+                self.read_controller(node, kind, animation, controller_data,
+                                     *self.unpack(CONTROLLER_KEY, key_offset + i * CONTROLLER_KEY.size))
+
+        if not animation:
+            self.part_names[part_number] = node.name
+            if "inheritcolor" in node.properties:
+                node['inheritcolor'] = inherit_color
+            self.read_node_data(node, flags, offset + NODE_HEADER.size)
+
+        return node, self.model_values("I", child_offsets, child_count)
+
+    def read_controller(self, node, kind, animation, controller_data,
+                        controller_type, rows, time_offset, data_offset, columns):
+        if animation:
+            names = ANIMATION_CONTROLLERS
+        else:
+            names = GEOMETRY_CONTROLLERS
+        name = names[kind].get(controller_type, names["common"].get(controller_type))
+        if name not in node.properties:
+            return
+
+        stride = columns & ~BEZIER_FLAG
+        value_columns = stride
+        if columns & BEZIER_FLAG:
+            # Bezier keys store the value followed by two control points
+            stride *= 3
+
+        values = controller_data[data_offset:data_offset + rows * stride]
+        times = controller_data[time_offset:time_offset + rows]
+        orientation = controller_type == ORIENTATION_CONTROLLER
+
+        if self.use_arrays:
+            # The conversions are done in double precision, like in list mode
+            values = values.reshape(rows, stride)[:, :value_columns].astype(numpy.float64)
+            times = numpy.asarray(times, dtype=numpy.float64)
+            if orientation:
+                values = quaternions_to_axis_angles(values)
+            values = values.tolist()
+            if animation:
+                node[name] = numpy.column_stack((times, values))
+            elif value_columns == 1:
+                node[name] = values[0][0]
+            else:
+                node[name] = values[0]
+        else:
+            values = [values[i:i + value_columns] for i in range(0, len(values), stride)]
+            if orientation:
+                values = [quaternion_to_axis_angle(*row) for row in values]
+            if animation:
+                node[name] = [[time] + list(row) for time, row in zip(times, values)]
+            elif value_columns == 1:
+                node[name] = values[0][0]
+            else:
+                node[name] = values[0]
+
+    def read_node_data(self, node, flags, offset):
+        """ Reads the type specific headers following the node header """
+        if flags & NODE_LIGHT_FLAG:
+            self.read_light(node, offset)
+        if flags & NODE_EMITTER_FLAG:
+            self.read_emitter(node, offset)
+        if flags & NODE_REFERENCE_FLAG:
+            ref_model, reattachable = self.unpack(REFERENCE_HEADER, offset)
+            node['refModel'] = decode_string(ref_model)
+            node['reattachable'] = reattachable
+        if flags & NODE_MESH_FLAG:
+            vertex_count = self.read_mesh(node, offset)
+            offset += MESH_HEADER.size
+            if flags & NODE_SKIN_FLAG:
+                self.read_skin(node, offset, vertex_count)
+            if flags & NODE_DANGLY_FLAG:
+                self.read_dangly(node, offset)
+            if flags & NODE_AABB_FLAG:
+                self.read_aabb(node, offset)
+
+    def read_light(self, node, offset):
+        (flare_radius, priority, ambient_only, dynamic, affect_dynamic,
+         shadow, lens_flares, fading_light) = self.unpack(LIGHT_HEADER, offset)
+        node['flareradius'] = flare_radius
+        node['lightpriority'] = priority
+        node['ambientonly'] = ambient_only
+        node['isdynamic'] = dynamic
+        node['affectdynamic'] = affect_dynamic
+        node['shadow'] = shadow
+        node['lensflares'] = lens_flares
+        node['fadinglight'] = fading_light
+
+    def read_emitter(self, node, offset):
+        (dead_space, blast_radius, blast_length, x_grid, y_grid, spawn_type,
+         update, render, blend, texture, chunk_name, two_sided_texture, loop,
+         render_order, emitter_flags) = self.unpack(EMITTER_HEADER, offset)
+        node['deadspace'] = dead_space
+        node['blastradius'] = blast_radius
+        node['blastlength'] = blast_length
+        node['xgrid'] = x_grid
+        node['ygrid'] = y_grid
+        node['spawntype'] = spawn_type
+        for name, value in [("update", update), ("render", render), ("blend", blend)]:
+            try:
+                node[name] = decode_string(value)
+            except ValueError:
+                print("Unknown %s style for emitter %s" % (name, node.name))
+        node['texture'] = decode_string(texture) or "NULL"
+        node['twosidedtex'] = two_sided_texture
+        node['loop'] = loop
+        node['renderorder'] = render_order
+        for flag, name in EMITTER_FLAGS:
+            if name == "affectedbywind":
+                node[name] = str(bool(emitter_flags & flag)).lower()
+            else:
+                node[name] = bool(emitter_flags & flag)
+
+    def read_mesh(self, node, offset):
+        """ Reads the mesh header and the vertex and face arrays, returns the
+            number of vertices """
+        (face_offset, face_count, diffuse_r, diffuse_g, diffuse_b,
+         ambient_r, ambient_g, ambient_b, specular_r, specular_g, specular_b,
+         shininess, shadow, beaming, render, transparency_hint,
+         texture0, texture1, texture2, texture3, tile_fade,
+         vertex_offset, vertex_count, texture_count,
+         tvert_offset0, tvert_offset1, tvert_offset2, tvert_offset3,
+         color_offset, rotate_texture) = self.unpack(MESH_HEADER, offset)
+
+        node['ambient'] = [ambient_r, ambient_g, ambient_b]
+        node['diffuse'] = [diffuse_r, diffuse_g, diffuse_b]
+        node['specular'] = [specular_r, specular_g, specular_b]
+        node['shininess'] = shininess
+        node['shadow'] = shadow
+        node['bitmap'] = decode_string(texture0) or "NULL"
+        node['transparencyhint'] = transparency_hint
+        if node.type != "aabb":
+            node['beaming'] = beaming
+            node['render'] = render
+            node['rotatetexture'] = rotate_texture
+            node['tilefade'] = tile_fade
+
+        if vertex_count and vertex_offset != NO_OFFSET:
+            verts = self.raw_values("f", vertex_offset, vertex_count * 3)
+            node['verts'] = self.rows(verts, 3)
+
+        # Compiled models have one texture vertex per vertex
+        if texture_count and vertex_count and tvert_offset0 != NO_OFFSET:
+            tverts = self.rows(self.raw_values("f", tvert_offset0, vertex_count * 2), 2)
+            if self.use_arrays:
+                node['tverts'] = numpy.column_stack((tverts, numpy.zeros(vertex_count)))
+            else:
+                node['tverts'] = [uv + [0.0] for uv in tverts]
+
+        if vertex_count and color_offset != NO_OFFSET and "colors" in node.properties:
+            colors = self.rows(self.raw_values("B", color_offset, vertex_count * 4), 4)
+            if self.use_arrays:
+                node['colors'] = colors[:, :3] / 255.0
+            else:
+                node['colors'] = [[r / 255.0, g / 255.0, b / 255.0] for r, g, b, a in colors]
+
+        self.read_faces(node, face_offset, face_count)
+        return vertex_count
+
+    def read_faces(self, node, face_offset, face_count):
+        if not face_count:
+            return
+        if self.use_arrays:
+            face_type = numpy.dtype([("plane", "<f4", 4),
+                                     ("surface", "<u4"),
+                                     ("adjacent", "<i2", 3),
+                                     ("verts", "<i2", 3)])
+            face_data = numpy.frombuffer(self.buffer, face_type, face_count,
+                                         self.model_start + face_offset)
+            faces = numpy.empty((face_count, 8), dtype=int)
+            faces[:, 0:3] = face_data["verts"]
+            faces[:, 3] = 1
+            faces[:, 4:7] = face_data["verts"]
+            faces[:, 7] = face_data["surface"]
+        else:
+            faces = []
+            for i in range(face_count):
+                surface, v1, v2, v3 = self.unpack(FACE, face_offset + i * FACE.size)
+                # Compiled faces use the same indices for vertices and
+                # texture vertices, and have no smoothing groups
+                faces.append([v1, v2, v3, 1, v1, v2, v3, surface])
+        node['faces'] = faces
+
+    def read_dangly(self, node, offset):
+        (constraint_offset, constraint_count,
+         displacement, tightness, period) = self.unpack(DANGLY_HEADER, offset)
+        node['displacement'] = displacement
+        node['tightness'] = tightness
+        node['period'] = period
+        if not constraint_count:
+            return
+        constraints = self.model_values("f", constraint_offset, constraint_count)
+        if self.use_arrays:
+            node['constraints'] = constraints.reshape(-1, 1)
+        else:
+            node['constraints'] = [[constraint] for constraint in constraints]
+
+    def read_skin(self, node, offset, vertex_count):
+        header = self.unpack(SKIN_HEADER, offset)
+        # The bones are referred to by part number, and all nodes have to be
+        # read before the weights can be resolved
+        self.skin_nodes.append((node, vertex_count, header[0], header[1], header[2:]))
+
+    def read_skin_weights(self, node, vertex_count, weight_offset, bone_offset, part_numbers):
+        weights = struct.unpack_from("<%df" % (vertex_count * 4), self.buffer,
+                                     self.raw_start + weight_offset)
+        bones = struct.unpack_from("<%dh" % (vertex_count * 4), self.buffer,
+                                   self.raw_start + bone_offset)
+        rows = []
+        for i in range(0, vertex_count * 4, 4):
+            row = []
+            for bone, weight in zip(bones[i:i + 4], weights[i:i + 4]):
+                if bone < 0 or weight <= 0:
+                    continue
+                bone_name = self.part_names.get(part_numbers[bone])
+                if bone_name is None:
+                    continue
+                row.append(bone_name)
+                row.append("%.9g" % weight)
+            rows.append(row)
+        node['weights'] = rows
+
+    def read_aabb(self, node, offset):
+        root_offset, = self.unpack(AABB_HEADER, offset)
+        if not root_offset:
+            return
+
+        # The entries are added depth first, left child first
+        tree = props_classes.FlatAABBTree()
+        node_stack = [(root_offset, -1, False)]
+        while node_stack:
+            entry_offset, parent, is_right = node_stack.pop()
+            x1, y1, z1, x2, y2, z2, left, right, index, plane = self.unpack(AABB_ENTRY, entry_offset)
+            tree_node = tree.add_node((x1, y1, z1), (x2, y2, z2), index,
+                                      parent, is_right,
+                                      AABB_PLANE_AXES.get(plane, -1))
+            if right:
+                node_stack.append((right, tree_node, True))
+            if left:
+                node_stack.append((left, tree_node, False))
+        node['aabb'] = tree
+
+
+def write_model(model, filename):
+    """ Compiles the mdl.Model `model` and writes it to `filename` """
+    data = BinaryModelWriter(model).compile()
+    with open(filename, "wb") as model_file:
+        model_file.write(data)
+
+
+def encode_string(string, size):
+    """ Encodes a string for a zero terminated fixed length field """
+    return str(string).encode("latin-1")[:size - 1]
+
+
+def axis_angle_to_quaternion(x, y, z, angle):
+    """ Converts an ascii model axis-angle to a quaternion (x, y, z, w) """
+    length = math.sqrt(x * x + y * y + z * z)
+    if length < 1e-6:
+        return [0.0, 0.0, 0.0, 1.0]
+    sin_half = math.sin(angle / 2) / length
+    return [x * sin_half, y * sin_half, z * sin_half, math.cos(angle / 2)]
+
+
+def quaternion_multiply(q1, q2):
+    x1, y1, z1, w1 = q1
+    x2, y2, z2, w2 = q2
+    return [w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+            w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+            w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+            w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2]
+
+
+def quaternion_rotate(q, vector):
+    conjugate = [-q[0], -q[1], -q[2], q[3]]
+    x, y, z, w = quaternion_multiply(quaternion_multiply(q, list(vector) + [0.0]), conjugate)
+    return [x, y, z]
+
+
+def subtract(v1, v2):
+    return [a - b for a, b in zip(v1, v2)]
+
+
+def cross(v1, v2):
+    return [v1[1] * v2[2] - v1[2] * v2[1],
+            v1[2] * v2[0] - v1[0] * v2[2],
+            v1[0] * v2[1] - v1[1] * v2[0]]
+
+
+def normalize(vector):
+    length = math.sqrt(sum(comp * comp for comp in vector))
+    if length < 1e-12:
+        return [0.0, 0.0, 0.0]
+    return [comp / length for comp in vector]
+
+
+class BinaryModelWriter(object):
+    """ Compiles a model to the layout read by BinaryModelReader.
+
+            The model data and the raw data are built in separate buffers,
+            which are joined when the compilation is done.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.data = bytearray()
+        self.raw = bytearray()
+
+        #Part numbers and model space rest transforms of the geometry nodes
+        self.part_numbers = {}
+        self.transforms = {}
+
+    def allocate(self, size):
+        """ Reserves `size` bytes of model data, returns the offset """
+        offset = len(self.data)
+        self.data.extend(bytes(size))
+        return offset
+
+    def add_values(self, type_code, values):
+        """ Appends values to the model data, returns the offset """
+        offset = len(self.data)
+        self.data.extend(struct.pack("<%d%s" % (len(values), type_code), *values))
+        return offset
+
+    def add_raw_values(self, type_code, values):
+        """ Appends values to the raw data, returns the offset """
+        offset = len(self.raw)
+        self.raw.extend(struct.pack("<%d%s" % (len(values), type_code), *values))
+        return offset
+
+    def compile(self):
+        """ Compiles the model, returns the contents of the binary file """
+        model = self.model
+        nodes = model.geometry.nodes
+        for part_number, node in enumerate(nodes):
+            self.part_numbers[node.name] = part_number
+        self.build_transforms(nodes)
+
+        model_offset = self.allocate(GEOMETRY_HEADER.size + MODEL_LAYOUT.size)
+        root_offset = self.write_node_tree(nodes, model_offset, False)
+
+        animation_offsets = [self.write_animation(animation) for animation in model.animations]
+        animation_array = self.add_values("I", animation_offsets)
+
+        classification = 0
+        for flag, name in CLASSIFICATIONS.items():
+            if name == str(model.classification).lower():
+                classification = flag
+        supermodel = model.supermodel
+        if supermodel == "NULL":
+            supermodel = ""
+
+        bounds_min, bounds_max = self.model_bounds(nodes)
+        radius = math.sqrt(sum(max(a * a, b * b) for a, b in zip(bounds_min, bounds_max)))
+
+        GEOMETRY_HEADER.pack_into(self.data, model_offset,
+                                  encode_string(model.name, 64), root_offset,
+                                  len(nodes), GEOMETRY_MODEL)
+        MODEL_LAYOUT.pack_into(self.data, model_offset + GEOMETRY_HEADER.size,
+                               classification, 1,
+                               animation_array, len(animation_offsets), len(animation_offsets),
+                               0, *(bounds_min + bounds_max
+                                    + [radius, float(model.setanimationscale),
+                                       encode_string(supermodel, 64)]))
+
+        header = FILE_HEADER.pack(0, len(self.data), len(self.raw))
+        return header + bytes(self.data) + bytes(self.raw)
+
+    def build_transforms(self, nodes):
+        """ Calculates the rest pose of all geometry nodes in model space as
+            (quaternion, position) tuples. Parents have to come before their
+            children, like they do in ascii models """
+        for node in nodes:
+            position = node.get_prop_value("position") or [0.0, 0.0, 0.0]
+            orientation = node.get_prop_value("orientation") or [0.0, 0.0, 0.0, 0.0]
+            rotation = axis_angle_to_quaternion(*orientation)
+            parent = node.get_prop_value("parent")
+            if parent in self.transforms:
+                parent_rotation, parent_position = self.transforms[parent]
+                position = [a + b for a, b in zip(parent_position,
+                                                  quaternion_rotate(parent_rotation, position))]
+                rotation = quaternion_multiply(parent_rotation, rotation)
+            self.transforms[node.name] = (rotation, list(position))
+
+    def model_bounds(self, nodes):
+        """ Returns the bounding box of all mesh vertices in model space """
+        points = []
+        for node in nodes:
+            if "verts" not in node.properties or not node.properties["verts"].value_written:
+                continue
+            rotation, position = self.transforms[node.name]
+            for vert in node.properties["verts"].get_rows():
+                points.append([a + b for a, b in zip(position, quaternion_rotate(rotation, vert))])
+        if not points:
+            return [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]
+        return ([min(point[i] for point in points) for i in range(3)],
+                [max(point[i] for point in points) for i in range(3)])
+
+    def write_animation(self, animation):
+        """ Writes an animation and its node tree, returns the offset """
+        offset = self.allocate(GEOMETRY_HEADER.size + ANIMATION_HEADER.size)
+
+        event_offset = len(self.data)
+        for time, event in animation.events:
+            self.data.extend(EVENT.pack(float(time), encode_string(event, 32)))
+
+        root_offset = self.write_node_tree(animation.nodes, offset, True)
+
+        GEOMETRY_HEADER.pack_into(self.data, offset,
+                                  encode_string(animation.name, 64), root_offset,
+                                  len(animation.nodes), GEOMETRY_ANIMATION)
+        ANIMATION_HEADER.pack_into(self.data, offset + GEOMETRY_HEADER.size,
+                                   float(animation.length), float(animation.transtime),
+                                   encode_string(animation.animroot, 64),
+                                   event_offset, len(animation.events))
+        # The event array allocation size, skipped by ANIMATION_HEADER
+        struct.pack_into("<I", self.data, offset + GEOMETRY_HEADER.size + 80,
+                         len(animation.events))
+        return offset
+
+    def write_node_tree(self, nodes, geometry_offset, animation):
+        """ Writes the nodes linked to their parents, returns the offset of the
+            root node """
+        names = set(node.name for node in nodes)
+        children = {}
+        roots = []
+        for node in nodes:
+            parent = node.get_prop_value("parent")
+            if parent in names:
+                children.setdefault(parent, []).append(node)
+            else:
+                roots.append(node)
+        if len(roots) != 1:
+            raise ValueError("Expected a single root node, found %d" % len(roots))
+
+        # All nodes are allocated first, so the offsets of parents and
+        # children are known when the headers are written
+        node_flags = {}
+        node_offsets = {}
+        for node in nodes:
+            flags = NODE_FLAGS[node.type]
+            node_flags[node.name] = flags
+            # Animation nodes keep the flags of their type, but have no type
+            # specific data
+            if animation:
+                size = NODE_LAYOUT.size
+            else:
+                size = NODE_LAYOUT.size + self.node_data_size(flags)
+            node_offsets[node.name] = self.allocate(size)
+
+        for node in nodes:
+            offset = node_offsets[node.name]
+            flags = node_flags[node.name]
+            child_offsets = [node_offsets[child.name] for child in children.get(node.name, [])]
+            child_array = self.add_values("I", child_offsets)
+            key_offset, key_count, data_offset, data_count = self.write_controllers(node, animation)
+
+            inherit_color = 0
+            if "inheritcolor" in node.properties and node.get_prop_value("inheritcolor"):
+                inherit_color = 1
+
+            NODE_LAYOUT.pack_into(self.data, offset,
+                                  inherit_color,
+                                  self.part_numbers.get(node.name, -1) & 0xFFFFFFFF,
+                                  encode_string(node.name, 32),
+                                  geometry_offset,
+                                  node_offsets.get(node.get_prop_value("parent"), 0),
+                                  child_array, len(child_offsets), len(child_offsets),
+                                  key_offset, key_count, key_count,
+                                  data_offset, data_count, data_count,
+                                  flags)
+
+            if not animation:
+                self.write_node_data(node, flags, offset + NODE_LAYOUT.size)
+
+        return node_offsets[roots[0].name]
+
+    def node_data_size(self, flags):
+        size = 0
+        if flags & NODE_LIGHT_FLAG:
+            size += LIGHT_HEADER.size
+        if flags & NODE_EMITTER_FLAG:
+            size += EMITTER_HEADER.size
+        if flags & NODE_REFERENCE_FLAG:
+            size += REFERENCE_HEADER.size
+        if flags & NODE_MESH_FLAG:
+            size += MESH_LAYOUT.size
+        if flags & NODE_SKIN_FLAG:
+            size += SKIN_LAYOUT.size
+        if flags & NODE_DANGLY_FLAG:
+            size += DANGLY_HEADER.size
+        if flags & NODE_AABB_FLAG:
+            size += AABB_HEADER.size
+        return size
+
+    def write_controllers(self, node, animation):
+        """ Writes the controller keys and data of a node, returns the offsets
+            and sizes of both arrays """
+        if node.type == "emitter":
+            kind = "emitter"
+        elif node.type == "light":
+            kind = "light"
+        elif node.type in ["trimesh", "danglymesh", "skin", "aabb"]:
+            kind = "mesh"
+        else:
+            kind = "common"
+
+        if animation:
+            names = ANIMATION_CONTROLLERS
+        else:
+            names = GEOMETRY_CONTROLLERS
+        controller_types = dict(names["common"])
+        controller_types.update(names[kind])
+
+        keys = []
+        controller_data = []
+        for controller_type, name in sorted(controller_types.items()):
+            if name not in node.properties or not node.properties[name].value_written:
+                continue
+            prop = node.properties[name]
+            if animation:
+                rows = prop.get_rows()
+                times = [row[0] for row in rows]
+                values = [list(row[1:]) for row in rows]
+            elif isinstance(prop.value, (list, tuple)):
+                times = [0.0]
+                values = [list(prop.value)]
+            else:
+                times = [0.0]
+                values = [[prop.value]]
+            if not values:
+                continue
+            if controller_type == ORIENTATION_CONTROLLER:
+                values = [axis_angle_to_quaternion(*row) for row in values]
+
+            time_offset = len(controller_data)
+            controller_data.extend(float(time) for time in times)
+            data_offset = len(controller_data)
+            for row in values:
+                controller_data.extend(float(val) for val in row)
+            keys.append((controller_type, len(values), time_offset, data_offset, len(values[0])))
+
+        key_offset = len(self.data)
+        for key in keys:
+            self.data.extend(CONTROLLER_KEY.pack(*key))
+        data_offset = self.add_values("f", controller_data)
+        return key_offset, len(keys), data_offset, len(controller_data)
+
+    def write_node_data(self, node, flags, offset):
+        """ Writes the type specific headers following the node header """
+        if flags & NODE_LIGHT_FLAG:
+            self.write_light(node, offset)
+            offset += LIGHT_HEADER.size
+        if flags & NODE_EMITTER_FLAG:
+            self.write_emitter(node, offset)
+            offset += EMITTER_HEADER.size
+        if flags & NODE_REFERENCE_FLAG:
+            REFERENCE_HEADER.pack_into(self.data, offset,
+                                       encode_string(node.get_prop_value("refModel") or "", 64),
+                                       int(bool(node.get_prop_value("reattachable"))))
+            offset += REFERENCE_HEADER.size
+        if flags & NODE_MESH_FLAG:
+            vertex_map = self.write_mesh(node, offset)
+            offset += MESH_LAYOUT.size
+            if flags & NODE_SKIN_FLAG:
+                self.write_skin(node, offset, vertex_map)
+                offset += SKIN_LAYOUT.size
+            if flags & NODE_DANGLY_FLAG:
+                self.write_dangly(node, offset, vertex_map)
+                offset += DANGLY_HEADER.size
+            if flags & NODE_AABB_FLAG:
+                self.write_aabb(node, offset)
+
+    def write_light(self, node, offset):
+        def flag(name):
+            return int(bool(node.get_prop_value(name)))
+
+        LIGHT_HEADER.pack_into(self.data, offset,
+                               float(node.get_prop_value("flareradius") or 0),
+                               int(node.get_prop_value("lightpriority") or 0),
+                               flag("ambientonly"), flag("isdynamic"),
+                               flag("affectdynamic"), flag("shadow"),
+                               flag("lensflares"), flag("fadinglight"))
+
+    def write_emitter(self, node, offset):
+        def value(name, default=0):
+            if not node.properties[name].value_written:
+                return default
+            return node.properties[name].value
+
+        def enum_output(name, default=0):
+            prop = node.properties[name]
+            if not prop.value_written:
+                return default
+            return prop.enums.get(prop.value, prop.value)
+
+        emitter_flags = 0
+        for flag, name in EMITTER_FLAGS:
+            flag_value = value(name, False)
+            if name == "affectedbywind":
+                flag_value = flag_value == "true"
+            if flag_value:
+                emitter_flags |= flag
+
+        texture = value("texture", "")
+        if texture == "NULL":
+            texture = ""
+
+        EMITTER_HEADER.pack_into(self.data, offset,
+                                 float(value("deadspace")),
+                                 float(value("blastradius")),
+                                 float(value("blastlength")),
+                                 int(value("xgrid")), int(value("ygrid")),
+                                 int(enum_output("spawntype")),
+                                 encode_string(enum_output("update", ""), 32),
+                                 encode_string(enum_output("render", ""), 32),
+                                 encode_string(enum_output("blend", ""), 32),
+                                 encode_string(texture, 64), b"",
+                                 int(bool(value("twosidedtex"))),
+                                 int(bool(value("loop"))),
+                                 int(value("renderorder")), emitter_flags)
+
+    def write_mesh(self, node, offset):
+        """ Writes the mesh header, the faces and the vertex arrays. Returns a
+            list with the (vertex, texture vertex) pair of every compiled
+            vertex """
+        def value(name, default):
+            if name not in node.properties or not node.properties[name].value_written:
+                return default
+            return node.properties[name].value
+
+        verts = node.properties["verts"].get_rows() or []
+        tverts = node.properties["tverts"].get_rows() or []
+        faces = node.properties["faces"].get_rows() or []
+        colors = None
+        if "colors" in node.properties:
+            colors = node.properties["colors"].get_rows()
+
+        # Compiled meshes have a single texture vertex per vertex, vertices
+        # used with several texture vertices are split
+        vertex_map = []
+        vertex_indices = {}
+        compiled_faces = []
+        for face in faces:
+            corners = []
+            for vert, tvert in zip(face[0:3], face[4:7]):
+                if not tverts:
+                    tvert = 0
+                key = (int(vert), int(tvert))
+                if key not in vertex_indices:
+                    vertex_indices[key] = len(vertex_map)
+                    vertex_map.append(key)
+                corners.append(vertex_indices[key])
+            compiled_faces.append((corners, int(face[7])))
+        # Vertices not used by any face are kept as well
+        used_verts = set(vert for vert, tvert in vertex_map)
+        for vert in range(len(verts)):
+            if vert not in used_verts:
+                vertex_map.append((vert, 0))
+
+        positions = [list(verts[vert]) for vert, tvert in vertex_map]
+        vertex_count = len(positions)
+        if vertex_count > 0xFFFF:
+            raise ValueError("Node %s has more than %d vertices" % (node.name, 0xFFFF))
+
+        # Face planes, vertex normals and the faces sharing every edge
+        normals = [[0.0, 0.0, 0.0] for i in range(vertex_count)]
+        planes = []
+        edge_faces = {}
+        for index, (corners, surface) in enumerate(compiled_faces):
+            v1, v2, v3 = [positions[corner] for corner in corners]
+            face_normal = cross(subtract(v2, v1), subtract(v3, v1))
+            for corner in corners:
+                normals[corner] = [a + b for a, b in zip(normals[corner], face_normal)]
+            face_normal = normalize(face_normal)
+            planes.append(face_normal + [-sum(a * b for a, b in zip(face_normal, v1))])
+            for i in range(3):
+                edge = tuple(sorted((vertex_map[corners[i]][0], vertex_map[corners[i - 2]][0])))
+                edge_faces.setdefault(edge, []).append(index)
+
+        face_offset = len(self.data)
+        for index, (corners, surface) in enumerate(compiled_faces):
+            adjacent = []
+            for i in range(3):
+                edge = tuple(sorted((vertex_map[corners[i]][0], vertex_map[corners[i - 2]][0])))
+                others = [other for other in edge_faces[edge] if other != index]
+                adjacent.append(others[0] if others else -1)
+            self.data.extend(FACE_LAYOUT.pack(*(planes[index] + [surface] + adjacent + corners)))
+
+        if positions:
+            bounds_min = [min(vert[i] for vert in positions) for i in range(3)]
+            bounds_max = [max(vert[i] for vert in positions) for i in range(3)]
+            average = [sum(vert[i] for vert in positions) / vertex_count for i in range(3)]
+        else:
+            bounds_min = bounds_max = average = [0.0, 0.0, 0.0]
+        radius = max([math.sqrt(sum((a - b) ** 2 for a, b in zip(vert, average)))
+                      for vert in positions] or [0.0])
+
+        vertex_offset = self.add_raw_values("f", [comp for vert in positions for comp in vert])
+        normal_offset = self.add_raw_values("f", [comp for normal in normals
+                                                  for comp in normalize(normal)])
+        texture_count = 0
+        tvert_offset = NO_OFFSET
+        if tverts:
+            texture_count = 1
+            tvert_offset = self.add_raw_values("f", [comp for vert, tvert in vertex_map
+                                                     for comp in list(tverts[tvert])[:2]])
+        color_offset = NO_OFFSET
+        if colors:
+            color_offset = self.add_raw_values("B", [int(round(min(max(comp, 0.0), 1.0) * 255))
+                                                     for vert, tvert in vertex_map
+                                                     for comp in list(colors[vert])[:3] + [1.0]])
+
+        # The triangle list used when rendering the mesh
+        index_offset = self.add_raw_values("H", [corner for corners, surface in compiled_faces
+                                                 for corner in corners])
+        index_count_array = self.add_values("I", [len(compiled_faces) * 3])
+        index_offset_array = self.add_values("I", [index_offset])
+
+        bitmap = value("bitmap", "")
+        if bitmap == "NULL":
+            bitmap = ""
+        tile_fade = 0
+        if "tilefade" in node.properties and node.properties["tilefade"].value_written:
+            prop = node.properties["tilefade"]
+            tile_fade = int(prop.enums[prop.value])
+
+        MESH_LAYOUT.pack_into(self.data, offset,
+                              face_offset, len(compiled_faces), len(compiled_faces),
+                              *(bounds_min + bounds_max + [radius] + average
+                                + list(value("diffuse", [0.8, 0.8, 0.8]))
+                                + list(value("ambient", [0.2, 0.2, 0.2]))
+                                + list(value("specular", [0.0, 0.0, 0.0]))
+                                + [float(value("shininess", 26)),
+                                   int(bool(value("shadow", True))),
+                                   int(bool(value("beaming", False))),
+                                   int(bool(value("render", True))),
+                                   int(bool(value("transparencyhint", False))),
+                                   0,
+                                   encode_string(bitmap, 64), b"", b"", b"",
+                                   tile_fade,
+                                   0, 0, 0,
+                                   0, 0, 0,
+                                   index_count_array, 1, 1,
+                                   index_offset_array, 1, 1,
+                                   -1, -1,
+                                   TRIANGLE_MODE,
+                                   0,
+                                   vertex_offset, vertex_count, texture_count,
+                                   tvert_offset, NO_OFFSET, NO_OFFSET, NO_OFFSET,
+                                   normal_offset, color_offset,
+                                   0, 0, 0, 0, 0, 0,
+                                   0, int(bool(value("rotatetexture", False))),
+                                   0.0, 0]))
+        return vertex_map
+
+    def write_dangly(self, node, offset, vertex_map):
+        constraints = node.properties["constraints"].get_rows() or []
+        compiled = [float(constraints[vert][0]) if vert < len(constraints) else 0.0
+                    for vert, tvert in vertex_map]
+        constraint_offset = self.add_values("f", compiled)
+        DANGLY_HEADER.pack_into(self.data, offset, constraint_offset, len(compiled),
+                                float(node.get_prop_value("displacement") or 0),
+                                float(node.get_prop_value("tightness") or 0),
+                                float(node.get_prop_value("period") or 0))
+        # The constraint array allocation size, skipped by DANGLY_HEADER
+        struct.pack_into("<I", self.data, offset + 8, len(compiled))
+
+    def write_skin(self, node, offset, vertex_map):
+        weights = node.properties["weights"].get_rows() or []
+        bones = []
+        for row in weights:
+            for bone in row[0::2]:
+                if bone not in bones:
+                    bones.append(bone)
+        if len(bones) > MAX_SKIN_BONES:
+            raise ValueError("Skin %s uses %d bones, at most %d are allowed" %
+                             (node.name, len(bones), MAX_SKIN_BONES))
+
+        vertex_weights = []
+        vertex_bones = []
+        for vert, tvert in vertex_map:
+            row = []
+            if vert < len(weights):
+                row = weights[vert]
+            pairs = list(zip(row[0::2], row[1::2]))[:4]
+            for bone, weight in pairs:
+                vertex_weights.append(float(weight))
+                vertex_bones.append(bones.index(bone))
+            for i in range(4 - len(pairs)):
+                vertex_weights.append(0.0)
+                vertex_bones.append(-1)
+
+        weight_offset = self.add_raw_values("f", vertex_weights)
+        bone_offset = self.add_raw_values("h", vertex_bones)
+
+        # Maps the part number of every node to its bone index in this skin
+        node_to_bone = [-1] * len(self.part_numbers)
+        for index, bone in enumerate(bones):
+            if bone in self.part_numbers:
+                node_to_bone[self.part_numbers[bone]] = index
+        node_to_bone_offset = self.add_values("h", node_to_bone)
+
+        # The inverse rest transforms take vertices from skin space to the
+        # space of every bone
+        identity = ([0.0, 0.0, 0.0, 1.0], [0.0, 0.0, 0.0])
+        skin_rotation, skin_position = self.transforms.get(node.name, identity)
+        qbones = []
+        tbones = []
+        for bone in bones:
+            bone_rotation, bone_position = self.transforms.get(bone, identity)
+            inverse = [-bone_rotation[0], -bone_rotation[1], -bone_rotation[2], bone_rotation[3]]
+            qbones.extend(quaternion_multiply(inverse, skin_rotation))
+            tbones.extend(quaternion_rotate(inverse, subtract(skin_position, bone_position)))
+        qbone_offset = self.add_values("f", qbones)
+        tbone_offset = self.add_values("f", tbones)
+        constant_offset = self.add_values("I", list(range(len(bones))))
+
+        part_numbers = [self.part_numbers.get(bone, -1) for bone in bones]
+        part_numbers += [-1] * (MAX_SKIN_BONES - len(part_numbers))
+        SKIN_LAYOUT.pack_into(self.data, offset,
+                              0, 0, 0,
+                              weight_offset, bone_offset,
+                              node_to_bone_offset, len(node_to_bone),
+                              qbone_offset, len(bones), len(bones),
+                              tbone_offset, len(bones), len(bones),
+                              constant_offset, len(bones), len(bones),
+                              *part_numbers)
+
+    def write_aabb(self, node, offset):
+        tree = node.get_prop_value("aabb")
+        # A walkmesh without faces has no entries
+        if tree is None or not tree.node_count():
+            AABB_HEADER.pack_into(self.data, offset, 0)
+            return
+
+        # Entries are written depth first, the parent entry gets the offset
+        # of a child when the child is written
+        bounds = tree.bounds
+        node_stack = [(0, None)]
+        while node_stack:
+            tree_node, link_offset = node_stack.pop()
+            entry_offset = self.allocate(AABB_ENTRY_LAYOUT.size)
+            if link_offset is None:
+                AABB_HEADER.pack_into(self.data, offset, entry_offset)
+            else:
+                struct.pack_into("<I", self.data, link_offset, entry_offset)
+
+            co1 = bounds[tree_node * 6:tree_node * 6 + 3].tolist()
+            co2 = bounds[tree_node * 6 + 3:tree_node * 6 + 6].tolist()
+            index = tree.face[tree_node]
+            plane = 0
+            if index == -1:
+                # The plane is the axis the node was split along. Trees read
+                # from ascii models don't record it, for them the longest axis
+                # of the box is used
+                axis = tree.axis[tree_node]
+                if axis == -1:
+                    extents = subtract(co2, co1)
+                    axis = extents.index(max(extents))
+                plane = 1 << axis
+            AABB_ENTRY_LAYOUT.pack_into(self.data, entry_offset,
+                                        *(co1 + co2 + [0, 0, index, plane]))
+
+            if tree.right[tree_node] != -1:
+                node_stack.append((tree.right[tree_node], entry_offset + 28))
+            if tree.left[tree_node] != -1:
+                node_stack.append((tree.left[tree_node], entry_offset + 24))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+'''
+Contains a persistent on-disk cache of parsed models.
+
+Parsed models are pickled to a cache directory, keyed by the path, size and
+modification time of the model file, or by a hash of its content. Loading an
+unchanged model from the cache skips the tokenizing and conversion of values.
+The cache directory is kept below a maximum size by removing the least
+recently used entries.
+
+@author: Erik Ylipää
+'''
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+try:
+    from . import mdl
+    from . import mdl_binary
+except ValueError:
+    import mdl
+    import mdl_binary
+
+CACHE_VERSION = 3
+""" Part of every cache key, increased when the pickled form of the models
+    changes """
+
+CACHE_EXTENSION = ".mdlcache"
+
+
+class ModelCache(object):
+    """ A directory of pickled models, used in front of Model.from_file.
+
+            Entries are keyed by the absolute path, size and modification time
+            of the model file. If `use_hash` is True the entries are instead
+            keyed by a hash of the content, so copies and touched files are
+            found as well. When the entries take up more than `max_size`
+            bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024, use_hash=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.use_hash = use_hash
+
+    def key(self, filename, options):
+        """ Returns the cache key of the model file `filename` loaded with
+            the keyword arguments `options` """
+        if self.use_hash:
+            file_hash = hashlib.sha1()
+            with open(filename, "rb") as model_file:
+                for chunk in iter(lambda: model_file.read(1024 * 1024), b""):
+                    file_hash.update(chunk)
+            source = file_hash.hexdigest()
+        else:
+            stat = os.stat(filename)
+            source = "%s:%d:%d" % (os.path.abspath(filename), stat.st_size,
+                                   stat.st_mtime_ns)
+
+        load_animations = options.get("load_animations", True)
+        if not isinstance(load_animations, bool):
+            load_animations = sorted(load_animations)
+        key = "%d:%s:%s:%s" % (CACHE_VERSION, source,
+                               bool(options.get("use_arrays", False)),
+                               load_animations)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + CACHE_EXTENSION)
+
+    def load(self, filename, **kwargs):
+        """ Returns the Model of the ascii or compiled model `filename`,
+            from the cache if possible.
+
+                The keyword arguments are passed to Model.from_file when the
+                model has to be parsed. Lazy loading doesn't apply to cached
+                models, they are always parsed completely.
+        """
+        kwargs.pop("lazy", None)
+        kwargs.pop("ascii", None)
+        path = self.entry_path(self.key(filename, kwargs))
+
+        try:
+            with open(path, "rb") as entry_file:
+                model = pickle.load(entry_file)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # Entries which can't be read, like truncated files or entries
+            # pickled by another version of the add-on, are parsed again
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        else:
+            # The modification time of an entry is its last use
+            os.utime(path)
+            return model
+
+        model = mdl.Model()
+        model.from_file(filename, ascii=not mdl_binary.is_binary(filename),
+                        **kwargs)
+        self.store(path, model)
+        return model
+
+    def store(self, path, model):
+        """ Writes an entry atomically and evicts old entries if the cache
+            is full """
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as entry_file:
+                pickle.dump(model, entry_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+        self.evict()
+
+    def entries(self):
+        """ Returns a list of (last use, size, path) of all entries """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache is within
+            its maximum size """
+        entries = self.entries()
+        total_size = sum(size for last_use, size, path in entries)
+
+        for last_use, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """ Removes all entries """
+        if not os.path.isdir(self.directory):
+            return
+        for last_use, size, path in self.entries():
+            os.remove(path)
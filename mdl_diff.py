@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+'''
+Contains a structural diff of Neverwinter Nights models.
+
+Nodes and animations are matched by name, and the written properties of
+matched nodes are compared value by value. Numbers are compared with a
+tolerance, which can be set per property name or type. Matrices such as verts, faces and
+keys are compared as arrays when numpy is available.
+
+The result is a `ModelDiff`, which lists the added, removed and changed nodes,
+animations and properties.
+
+@author: Erik Ylipää
+'''
+
+from collections.abc import Mapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_TOLERANCE = 1e-6
+""" The largest difference between two numbers which are considered equal """
+
+MAX_REPORTED_ROWS = 10
+""" The number of differing rows of a matrix listed in the text report """
+
+
+def diff_models(model1, model2, tolerance=DEFAULT_TOLERANCE, tolerances=None):
+    """ Compares the mdl.Model objects `model1` and `model2` and returns a
+        ModelDiff.
+
+            `tolerance` is the tolerance for numbers. `tolerances` is a
+            dictionary overriding it, keyed by property name or by property
+            type, given as a props_classes class like FloatMatrixProperty or
+            its name. Names take precedence over types, and more derived
+            types over their base classes. The animation fields "length",
+            "transtime" and "event" can be keyed by name as well.
+    """
+    if tolerances is None:
+        tolerances = {}
+    diff = ModelDiff(model1.name, model2.name)
+    for field in ["name", "supermodel", "classification", "setanimationscale"]:
+        value1 = getattr(model1, field)
+        value2 = getattr(model2, field)
+        if not values_equal(value1, value2, 0):
+            diff.header[field] = (value1, value2)
+
+    diff_named(model1.geometry.nodes, model2.geometry.nodes,
+               diff.added_nodes, diff.removed_nodes, diff.changed_nodes,
+               lambda node1, node2: diff_nodes(node1, node2, tolerance, tolerances))
+
+    diff_named(model1.animations, model2.animations,
+               diff.added_animations, diff.removed_animations,
+               diff.changed_animations,
+               lambda anim1, anim2: diff_animations(anim1, anim2, tolerance, tolerances))
+    return diff
+
+
+def diff_named(items1, items2, added, removed, changed, diff_items):
+    """ Matches the named items of two lists by name. Names only in
+        `items2` are appended to `added`, names only in `items1` to
+        `removed` and the non-empty diffs of matched items are stored in
+        the dictionary `changed` """
+    index1 = index_by_name(items1)
+    index2 = index_by_name(items2)
+
+    for name, item1 in index1.items():
+        if name not in index2:
+            removed.append(name)
+            continue
+        item_diff = diff_items(item1, index2[name])
+        if item_diff:
+            changed[name] = item_diff
+
+    for name in index2:
+        if name not in index1:
+            added.append(name)
+
+
+def index_by_name(items):
+    """ Returns a dictionary of the items by name, in order. Only the first
+        item with a name is indexed """
+    index = {}
+    for item in items:
+        if item.name not in index:
+            index[item.name] = item
+    return index
+
+
+def diff_nodes(node1, node2, tolerance=DEFAULT_TOLERANCE, tolerances=None):
+    """ Compares the written properties of two nodes, returns a NodeDiff.
+        See diff_models for the tolerances """
+    if tolerances is None:
+        tolerances = {}
+    diff = NodeDiff(node1.name)
+    if node1.type != node2.type:
+        diff.types = (node1.type, node2.type)
+
+    properties1 = node1.properties
+    properties2 = node2.properties
+    for name in properties1:
+        prop1 = properties1[name]
+        written2 = name in properties2 and properties2[name].value_written
+        if not prop1.value_written:
+            if written2:
+                diff.added_properties.append(name)
+            continue
+        if not written2:
+            diff.removed_properties.append(name)
+            continue
+
+        property_diff = diff_values(prop1.value, properties2[name].value,
+                                    property_tolerance(prop1.prop, tolerance,
+                                                       tolerances))
+        if property_diff:
+            diff.changed_properties[name] = property_diff
+
+    for name in properties2:
+        if name not in properties1 and properties2[name].value_written:
+            diff.added_properties.append(name)
+    return diff
+
+
+def diff_animations(animation1, animation2, tolerance=DEFAULT_TOLERANCE,
+                    tolerances=None):
+    """ Compares two animations and their nodes, returns an AnimationDiff.
+        See diff_models for the tolerances """
+    if tolerances is None:
+        tolerances = {}
+    diff = AnimationDiff(animation1.name)
+    for field in ["length", "transtime"]:
+        value1 = getattr(animation1, field)
+        value2 = getattr(animation2, field)
+        if not values_equal(value1, value2, tolerances.get(field, tolerance)):
+            diff.header[field] = (value1, value2)
+    if animation1.animroot != animation2.animroot:
+        diff.header["animroot"] = (animation1.animroot, animation2.animroot)
+    if not values_equal(animation1.events, animation2.events,
+                        tolerances.get("event", tolerance)):
+        diff.header["events"] = (animation1.events, animation2.events)
+
+    diff_named(animation1.nodes, animation2.nodes,
+               diff.added_nodes, diff.removed_nodes, diff.changed_nodes,
+               lambda node1, node2: diff_nodes(node1, node2, tolerance, tolerances))
+    return diff
+
+
+def property_tolerance(prop, tolerance, tolerances):
+    """ Returns the tolerance of a property, looked up in `tolerances` by
+        the name of the property and then by its type """
+    if prop.name in tolerances:
+        return tolerances[prop.name]
+    for cls in type(prop).__mro__:
+        if cls in tolerances:
+            return tolerances[cls]
+        if cls.__name__ in tolerances:
+            return tolerances[cls.__name__]
+    return tolerance
+
+
+def diff_values(value1, value2, tolerance):
+    """ Compares two property values, returns None if they are equal and
+        otherwise a PropertyDiff """
+    if isinstance(value1, Mapping) or isinstance(value2, Mapping):
+        # AABB trees are compared as their list of nodes
+        value1 = flatten_tree(value1)
+        value2 = flatten_tree(value2)
+
+    rows1 = as_matrix(value1)
+    rows2 = as_matrix(value2)
+    if rows1 is None or rows2 is None:
+        if values_equal(value1, value2, tolerance):
+            return None
+        return PropertyDiff(value1, value2)
+
+    if len(rows1) != len(rows2):
+        return PropertyDiff(value1, value2, shapes=(len(rows1), len(rows2)))
+
+    rows = differing_rows(rows1, rows2, tolerance)
+    if not rows:
+        return None
+    return PropertyDiff(value1, value2, rows=rows)
+
+
+def as_matrix(value):
+    """ Returns the matrix `value` as something indexable by row, or None if
+        the value isn't a matrix """
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value if value.ndim == 2 else None
+    if (isinstance(value, (list, tuple)) and value and
+            all(isinstance(row, (list, tuple)) for row in value)):
+        return value
+    return None
+
+
+def differing_rows(rows1, rows2, tolerance):
+    """ Returns the indices of the rows which differ between two matrices
+        with the same number of rows """
+    if numpy is not None:
+        array1 = numeric_array(rows1)
+        array2 = numeric_array(rows2)
+        if (array1 is not None and array2 is not None and
+                array1.shape == array2.shape):
+            if not array1.size:
+                return []
+            different = numpy.abs(array1 - array2) > tolerance
+            return numpy.flatnonzero(different.any(axis=1)).tolist()
+
+    return [index for index, (row1, row2) in enumerate(zip(rows1, rows2))
+            if not values_equal(row1, row2, tolerance)]
+
+
+def numeric_array(rows):
+    """ Returns the matrix `rows` as a 2D float array, or None if it is ragged
+        or has values which aren't numbers """
+    if isinstance(rows, numpy.ndarray):
+        if rows.dtype.kind in "biuf":
+            return rows.astype(float, copy=False)
+        return None
+    try:
+        array = numpy.array(rows, dtype=float)
+    except (ValueError, TypeError):
+        return None
+    return array if array.ndim == 2 else None
+
+
+def values_equal(value1, value2, tolerance):
+    """ Compares two values recursively, numbers are equal if they differ by
+        at most `tolerance` """
+    if numpy is not None:
+        if isinstance(value1, numpy.ndarray):
+            value1 = value1.tolist()
+        if isinstance(value2, numpy.ndarray):
+            value2 = value2.tolist()
+
+    if isinstance(value1, (list, tuple)) and isinstance(value2, (list, tuple)):
+        return (len(value1) == len(value2) and
+                all(values_equal(item1, item2, tolerance)
+                    for item1, item2 in zip(value1, value2)))
+
+    number1 = as_number(value1)
+    number2 = as_number(value2)
+    if number1 is not None and number2 is not None:
+        return abs(number1 - number2) <= tolerance
+    return value1 == value2
+
+
+def as_number(value):
+    """ Returns `value` as a float if it is a number or a numeric string,
+        otherwise None. Booleans are compared as they are """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def row_values(matrix, index):
+    """ Returns a row of a matrix as a list of python values """
+    row = matrix[index]
+    if numpy is not None and isinstance(row, numpy.ndarray):
+        return row.tolist()
+    return list(row)
+
+
+def flatten_tree(tree):
+    """ Returns the nodes of an AABB tree as rows of bounding box
+        coordinates and face index, depth first """
+    if not isinstance(tree, Mapping):
+        return tree
+    if hasattr(tree, "rows"):
+        return tree.rows()
+    rows = []
+    node_stack = [tree]
+    while node_stack:
+        node = node_stack.pop()
+        rows.append(list(node["co1"]) + list(node["co2"]) + [node["index"]])
+        if node["right"]:
+            node_stack.append(node["right"])
+        if node["left"]:
+            node_stack.append(node["left"])
+    return rows
+
+
+class PropertyDiff(object):
+    """ The difference of a property between two nodes.
+
+            For matrices, `shapes` holds the row counts if they differ and
+            `rows` the indices of the differing rows otherwise.
+    """
+
+    def __init__(self, value1, value2, shapes=None, rows=None):
+        self.value1 = value1
+        self.value2 = value2
+        self.shapes = shapes
+        self.rows = rows
+
+    def output_lines(self):
+        if self.shapes:
+            yield "row count %d -> %d" % self.shapes
+        elif self.rows is not None:
+            rows = self.rows[:MAX_REPORTED_ROWS]
+            yield "%d rows differ" % len(self.rows)
+            for row in rows:
+                yield "  row %d: %s -> %s" % (row, row_values(self.value1, row),
+                                              row_values(self.value2, row))
+            if len(self.rows) > len(rows):
+                yield "  ..."
+        else:
+            yield "%s -> %s" % (self.value1, self.value2)
+
+
+class NodeDiff(object):
+    """ The differences between two nodes with the same name """
+
+    def __init__(self, name):
+        self.name = name
+        self.types = None
+        """ The node types (type1, type2), if they differ """
+        self.added_properties = []
+        self.removed_properties = []
+        self.changed_properties = {}
+        """ PropertyDiff objects by property name """
+
+    def __bool__(self):
+        return bool(self.types or self.added_properties or
+                    self.removed_properties or self.changed_properties)
+
+    def output_lines(self):
+        yield "node %s" % self.name
+        if self.types:
+            yield "  type %s -> %s" % self.types
+        for name in self.added_properties:
+            yield "  + %s" % name
+        for name in self.removed_properties:
+            yield "  - %s" % name
+        for name, property_diff in self.changed_properties.items():
+            lines = property_diff.output_lines()
+            yield "  ~ %s: %s" % (name, next(lines))
+            for line in lines:
+                yield "    " + line
+
+
+class AnimationDiff(object):
+    """ The differences between two animations with the same name """
+
+    def __init__(self, name):
+        self.name = name
+        self.header = {}
+        """ Differing animation values (value1, value2) by name """
+        self.added_nodes = []
+        self.removed_nodes = []
+        self.changed_nodes = {}
+        """ NodeDiff objects by node name """
+
+    def __bool__(self):
+        return bool(self.header or self.added_nodes or self.removed_nodes or
+                    self.changed_nodes)
+
+    def output_lines(self):
+        yield "animation %s" % self.name
+        for field, (value1, value2) in self.header.items():
+            yield "  %s %s -> %s" % (field, value1, value2)
+        for name in self.added_nodes:
+            yield "  + node %s" % name
+        for name in self.removed_nodes:
+            yield "  - node %s" % name
+        for node_diff in self.changed_nodes.values():
+            for line in node_diff.output_lines():
+                yield "  " + line
+
+
+class ModelDiff(object):
+    """ The differences between two models. A ModelDiff is false if the
+        models are equal """
+
+    def __init__(self, name1, name2):
+        self.names = (name1, name2)
+        self.header = {}
+        """ Differing model values (value1, value2) by name """
+        self.added_nodes = []
+        self.removed_nodes = []
+        self.changed_nodes = {}
+        """ NodeDiff objects by node name """
+        self.added_animations = []
+        self.removed_animations = []
+        self.changed_animations = {}
+        """ AnimationDiff objects by animation name """
+
+    def __bool__(self):
+        return bool(self.header or self.added_nodes or self.removed_nodes or
+                    self.changed_nodes or self.added_animations or
+                    self.removed_animations or self.changed_animations)
+
+    def output_lines(self):
+        for field, (value1, value2) in self.header.items():
+            yield "%s %s -> %s" % (field, value1, value2)
+        for name in self.added_nodes:
+            yield "+ node %s" % name
+        for name in self.removed_nodes:
+            yield "- node %s" % name
+        for node_diff in self.changed_nodes.values():
+            for line in node_diff.output_lines():
+                yield line
+        for name in self.added_animations:
+            yield "+ animation %s" % name
+        for name in self.removed_animations:
+            yield "- animation %s" % name
+        for animation_diff in self.changed_animations.values():
+            for line in animation_diff.output_lines():
+                yield line
+
+    def __str__(self):
+        return "\n".join(self.output_lines())
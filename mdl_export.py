@@ -29,74 +29,28 @@ GUI.
 @author: Erik Ylipää
 '''
 
+import bisect
 import os
 
 import bpy
-from bpy.props import CollectionProperty, StringProperty, BoolProperty
-from bpy_extras.io_utils import ExportHelper
 import mathutils
-from mathutils import Vector
 
 from . import basic_props
 from . import node_props
 from . import blend_props
 from . import mdl
+from . import mdl_mesh
 
-
-class BorealisExport(bpy.types.Operator, ExportHelper):
-    """ Exports a Blender Object hierarchy to a Neverwinter Nights mdl model.
-
-            This class is the Blender Operator which initiates the export.
-
-    """
-
-    bl_idname = "export_mesh.nwn_mdl"
-    bl_label = "Export NWN .mdl"
-
-    filepath = bpy.props.StringProperty(name="File Path",
-                          description="File path used for exporting "
-                                      "the NWN model",
-                          maxlen=1024,
-                          default="")
-    filename_ext = ".mdl"
-    filter_glob = StringProperty(default="*.mdl", options={'HIDDEN'})
-
-    use_root_name = BoolProperty(name="Use Root Object Name",
-                                 description=("Use the name of the root object "
-                                 "as the model name and filename like "
-                                 "Neverwinter Nights expects, if false the "
-                                 "filename will be used as the model name in"
-                                 " the model file"),
-                                 default=True)
-    do_export_animations = BoolProperty(name="Export Animations",
-                                     description="Toggle whether animations "
-                                     "should be exported or not",
-                                     default=True)
-    force_tris = BoolProperty(name="Autotriangulate quad faces",
-                                       description="Automatically convert quad"
-                                       " faces to tris. The export will fail"
-                                       " if this is unchecked and there are"
-                                       " quad faces in any mesh",
-                                       default=True)
-
-    @classmethod
-    def poll(cls, context):
-        ## Check to see that the root object exists
-
-        return context.scene.nwn_props.root_object_name != None
-
-    def execute(self, context):
-        filepath = self.filepath
-        filepath = bpy.path.ensure_ext(filepath, self.filename_ext)
-
-        return export_nwn_mdl(context,
-                              **self.as_keywords(ignore=("check_existing",
-                                                         "filter_glob")))
+CHANNEL_ORDER = {"location": (0, 1, 2),
+                 "rotation_axis_angle": (1, 2, 3, 0)}
+""" The fcurve array indices of the exported data paths, in the order of the
+    values of position and orientation keys """
 
 
 def export_nwn_mdl(context, use_root_name=True,
-                   do_export_animations=True,
-                   **kwargs):
+                   do_export_animations=True, use_binary=False,
+                   reduce_keys=False, key_position_tolerance=0.0005,
+                   key_angle_tolerance=0.001, **kwargs):
     """ Exports an Object tree into a nwn mdl.
 
             Initiates the export of the Blender Object tree into a
@@ -119,9 +73,15 @@ def export_nwn_mdl(context, use_root_name=True,
                     of the Object set as root object of the mdl
                 export_animations - Whether to export animations or not. True
                     to export animations, False to only export geometry
+                use_binary - Write a compiled model instead of an ascii
+                    model
+                reduce_keys - Remove the animation keys which are
+                    reproduced by interpolation within key_position_tolerance
+                    and key_angle_tolerance (in radians)
     """
-    #We assume the first frame contains the static pose and change frame accordingly
-    context.scene.frame_current = 1
+    #We assume the first frame contains the static pose and change frame accordingly,
+    #frame_set also evaluates the animations so the objects are in that pose
+    context.scene.frame_set(1)
     scene_props = context.scene.nwn_props
     root_object = context.scene.objects[scene_props.root_object_name]
 
@@ -151,13 +111,17 @@ def export_nwn_mdl(context, use_root_name=True,
     if do_export_animations:
         export_animations(context.scene, mdl_object, root_object,
                           exported_objects, **kwargs)
+        if reduce_keys:
+            mdl_object.reduce_keys(key_position_tolerance, key_angle_tolerance)
 
 #    if os.path.exists(kwargs['filepath']):
 #        print("Path exists")
 #    else:
-    file = open(kwargs['filepath'], 'w')
-    file.write(str(mdl_object))
-    file.close()
+    if use_binary:
+        mdl_object.write_binary(kwargs['filepath'])
+    else:
+        with open(kwargs['filepath'], 'w') as file:
+            mdl_object.write(file)
 
     return {'FINISHED'}
 
@@ -206,8 +170,13 @@ def export_node(mdl_object, obj, parent, exported_objects, **kwargs):
             export_node(mdl_object, child, obj.name, exported_objects, **kwargs)
 
 
-def export_mesh(obj, node, force_tris=True, **kwargs):
-    """ Exports the mesh data of a Mesh object to a nwn node """
+def export_mesh(obj, node, force_tris=True,
+                uv_tolerance=mdl_mesh.DEFAULT_UV_TOLERANCE, **kwargs):
+    """ Exports the mesh data of a Mesh object to a nwn node.
+
+            Texture coordinates closer than `uv_tolerance` are merged into one
+            texture vertex.
+    """
     mesh = obj.data
     uv_faces = None
     image = None
@@ -230,14 +199,30 @@ def export_mesh(obj, node, force_tris=True, **kwargs):
         uv_faces = mesh.uv_textures.active.data
         image = uv_faces[0].image
 
-    vertices = [vert.co[:] for vert in mesh.vertices]
+    if mdl.numpy is not None:
+        #Read all coordinates in one call and hand the array to the node
+        vertices = mdl.numpy.empty(len(mesh.vertices) * 3, dtype=mdl.numpy.float32)
+        mesh.vertices.foreach_get("co", vertices)
+        vertices = vertices.reshape(-1, 3)
+    else:
+        vertices = [vert.co[:] for vert in mesh.vertices]
     node['verts'] = vertices
 
-    faces = []
+    #The texture coordinates of all face corners are gathered and
+    #deduplicated in one go
+    uv_indices = None
     uv_verts = []
-    uv_verts_dict = {}
+    if uv_faces:
+        if mdl.numpy is not None:
+            uv_raw = mdl.numpy.empty(len(uv_faces) * 8, dtype=mdl.numpy.float32)
+            uv_faces.foreach_get("uv_raw", uv_raw)
+            corner_uvs = uv_raw.reshape(-1, 4, 2)[:, :3]
+        else:
+            corner_uvs = [uv for uv_face in uv_faces
+                          for uv in (uv_face.uv1[:], uv_face.uv2[:], uv_face.uv3[:])]
+        uv_verts, uv_indices = mdl_mesh.unique_uvs(corner_uvs, uv_tolerance)
 
-    uv_verts
+    faces = []
     for i, face in enumerate(mesh.faces):
         v1, v2, v3 = face.vertices[:]
         smooth_group = 1
@@ -250,35 +235,8 @@ def export_mesh(obj, node, force_tris=True, **kwargs):
             if mat.name in mat_names:
                 mat_id = mat_names.index(mat.name)
 
-        if uv_faces:
-            uv_co1, uv_co2, uv_co3 = uv_faces[i].uv1, uv_faces[i].uv2, uv_faces[i].uv3
-
-            if uv_co1[0] not in uv_verts_dict:
-                uv_verts_dict[uv_co1[0]] = {}
-            if uv_co1[1] not in uv_verts_dict[uv_co1[0]]:
-                uv1 = len(uv_verts)
-                uv_verts.append(uv_co1[:])
-                uv_verts_dict[uv_co1[0]][uv_co1[1]] = uv1
-            else:
-                uv1 = uv_verts_dict[uv_co1[0]][uv_co1[1]]
-
-            if uv_co2[0] not in uv_verts_dict:
-                uv_verts_dict[uv_co2[0]] = {}
-            if uv_co2[1] not in uv_verts_dict[uv_co2[0]]:
-                uv2 = len(uv_verts)
-                uv_verts.append(uv_co2[:])
-                uv_verts_dict[uv_co2[0]][uv_co2[1]] = uv2
-            else:
-                uv2 = uv_verts_dict[uv_co2[0]][uv_co2[1]]
-
-            if uv_co3[0] not in uv_verts_dict:
-                uv_verts_dict[uv_co3[0]] = {}
-            if uv_co3[1] not in uv_verts_dict[uv_co3[0]]:
-                uv3 = len(uv_verts)
-                uv_verts.append(uv_co3[:])
-                uv_verts_dict[uv_co3[0]][uv_co3[1]] = uv3
-            else:
-                uv3 = uv_verts_dict[uv_co3[0]][uv_co3[1]]
+        if uv_indices:
+            uv1, uv2, uv3 = uv_indices[i * 3:i * 3 + 3]
         else:
             uv1, uv2, uv3 = 0, 0, 0
         face_line = [v1, v2, v3, smooth_group, uv1, uv2, uv3, mat_id]
@@ -348,109 +306,14 @@ def export_mesh(obj, node, force_tris=True, **kwargs):
         node["weights"] = weights
 
     elif node.type == "aabb":
-        root_node = build_aabb_tree(ob_dup)
-        node["aabb"] = root_node
+        tree = mdl_mesh.build_aabb_tree(node["verts"], node["faces"])
+        #A walkmesh without faces has no tree
+        if tree is not None:
+            node["aabb"] = tree
 
     bpy.ops.object.delete()
 
 
-def build_aabb_tree(obj):
-    """ Takes a object as an argument and returns a axis aligned bounding box tree """
-    faces = obj.data.faces
-
-    # Since the face-list in the mesh only contains the indices for the
-    # verts, we create our own facelist whith the verts coords directly
-    # available. For simplicity.
-    facelist = [{"verts": [obj.data.vertices[v].co for v in face.vertices],
-                 "index": index,
-                 "center": face.center} for index, face in enumerate(faces)]
-    level = 1
-    root_node = recursive_aabb(facelist, None, level)
-    return root_node
-
-
-def recursive_aabb(facelist, parent, level):
-    """ Recursively build a tree of aabb nodes, returns the root of the subtree.
-    """
-    # This code is heavily inspired by nwmax and Waylands original code
-    if level > 20:
-        raise RuntimeError("Max recursion depth reached when building aabb "
-                           "tree. Look for duplicate faces.")
-
-    bottom_left = Vector((10000, 10000, 10000))
-    top_right = Vector((-10000, -10000, -10000))
-    midpoints = Vector((0, 0, 0))
-    # First we calculate the bounding box
-    for face in facelist:
-        for x, y, z in face["verts"]:
-            if x < bottom_left.x:
-                bottom_left.x = x
-            if y < bottom_left.y:
-                bottom_left.y = y
-            if z < bottom_left.z:
-                bottom_left.z = z
-
-            if x > top_right.x:
-                top_right.x = x
-            if y > top_right.y:
-                top_right.y = y
-            if z > top_right.z:
-                top_right.z = z
-        midpoints += face["center"]
-
-    midpoint = midpoints / len(facelist)
-
-    bounding_box = {"co1": bottom_left[:], "co2": top_right[:],
-                    "index": -1, "left": None,
-                    "right": None, "parent": parent}
-
-    ## If this is a leaf we're done
-    if len(facelist) == 1:
-        bounding_box["index"] = facelist[0]["index"]
-        return bounding_box
-
-    ## Otherwise we have to decide how to do the splits
-    splits = {"x": {"left": [], "right": []},
-              "y": {"left": [], "right": []},
-              "z": {"left": [], "right": []}}
-
-    #find the best split, which is the split where the two sides are balanced
-    for face in facelist:
-        if face["center"].x < midpoint.x:
-            splits["x"]["left"].append(face)
-        else:
-            splits["x"]["right"].append(face)
-        if face["center"].y < midpoint.y:
-            splits["y"]["left"].append(face)
-        else:
-            splits["y"]["right"].append(face)
-        if face["center"].z < midpoint.z:
-            splits["z"]["left"].append(face)
-        else:
-            splits["z"]["right"].append(face)
-
-    split = None
-
-    #We calculate the difference between the two sides
-    delta_x = abs(len(splits["x"]["right"]) - len(splits["x"]["left"]))
-    delta_y = abs(len(splits["y"]["right"]) - len(splits["y"]["left"]))
-    delta_z = abs(len(splits["z"]["right"]) - len(splits["z"]["left"]))
-
-    # We pick the split where the difference between the splits are as small as possible
-    if delta_x < delta_y and delta_x < delta_z:
-        split = splits["x"]
-    elif delta_y < delta_z:
-        split = splits["y"]
-    else:
-        split = splits["z"]
-
-    if split["left"]:
-        bounding_box["left"] = recursive_aabb(split["left"], bounding_box, level + 1)
-    if split["right"]:
-        bounding_box["right"] = recursive_aabb(split["right"], bounding_box, level + 1)
-    return bounding_box
-
-
 def export_animations(scene, mdl_object, root_object, exported_objects, **kwargs):
     """ Exports the Blender animations of the model """
     animations = scene.nwn_props.animations
@@ -494,16 +357,13 @@ def export_animation_node(fps, animation_data, animation, nwn_anim, mdl_object,
     node = nwn_anim.new_node("dummy", obj.name)
     node['parent'] = parent
     start_frame = animation.start_frame
-    if obj.name in animation_data['nodes']:
-        if "location" in animation_data['nodes'][obj.name]:
-            locations = sorted(animation_data['nodes'][obj.name]["location"].items())
-            positionkeys = [[(time - start_frame) / fps, pos['x'], pos['y'], pos['z']] for time, pos in locations]
-            node['positionkey'] = positionkeys
-
-        if "rotation_axis_angle" in animation_data['nodes'][obj.name]:
-            rotations = sorted(animation_data['nodes'][obj.name]["rotation_axis_angle"].items())
-            orientationkey = [[(time - start_frame) / fps, ori['x'], ori['y'], ori['z'], ori['w']] for time, ori in rotations]
-            node['orientationkey'] = orientationkey
+    node_tracks = animation_data['nodes'].get(obj.name, {})
+    for data_path, key_name in [("location", "positionkey"),
+                                ("rotation_axis_angle", "orientationkey")]:
+        if data_path in node_tracks:
+            frames, rows = node_tracks[data_path]
+            node[key_name] = [[(frame - start_frame) / fps] + row
+                              for frame, row in zip(frames, rows)]
 
     for child in obj.children:
         if blend_props.get_nwn_props(child).is_nwn_object:
@@ -514,83 +374,146 @@ def build_animation_data(objects, animations):
     """ Creates a dictionary with the blender animation data suitable for nwn.
 
            The function builds a nested dictionary with a layout similar to how
-           animations are describe by the neverwinter nights ascii mdl.
+           animations are describe by the neverwinter nights ascii mdl. The
+           keys of every node are stored by data path as a tuple of the sorted
+           frames and the rows of values in the nwn order of the channels.
     """
 
     #The animation_list is a list of animations represented as dictionaries
     animation_list = [{"name": animation.name,
                        "start_frame": animation.start_frame,
                        "end_frame": animation.end_frame,
-                       "nodes": {}} for animation in animations]
+                       "nodes": {}} for animation in animations
+                      if not animation.use_actions]
+
+    #Animations in separate actions only read the keys of their actions
+    action_animations = [animation for animation in animations
+                         if animation.use_actions]
 
     #We sort the list in the order of the animations start frame
     animation_list.sort(key=lambda x: x["start_frame"])
 
-    #Times is a dictionary where the keys are different times. The values in
-    #turn are also dictionaries for all keyframes which occurs at the time
-    times = {}
-
-    # We go through all objects animation data and extract all their keyframes
-    # the keyframes are inserted into the times dict at the time they occur.
-    for object in objects:
-        if not object.animation_data:
-            continue
-        for fcurve in object.animation_data.action.fcurves:
-            if fcurve.data_path == "location":
-                if fcurve.array_index == 0:
-                    attribute_name = "x"
-                elif fcurve.array_index == 1:
-                    attribute_name = "y"
-                elif fcurve.array_index == 2:
-                    attribute_name = "z"
-            elif fcurve.data_path == "rotation_axis_angle":
-                if fcurve.array_index == 0:
-                    attribute_name = "w"
-                elif fcurve.array_index == 1:
-                    attribute_name = "x"
-                elif fcurve.array_index == 2:
-                    attribute_name = "y"
-                elif fcurve.array_index == 3:
-                    attribute_name = "z"
-
-            for point in fcurve.keyframe_points:
-                frame, value = point.co
-                if frame not in times:
-                    times[frame] = {}
-                if object.name not in times[frame]:
-                    times[frame][object.name] = {}
-                if fcurve.data_path not in times[frame][object.name]:
-                    times[frame][object.name][fcurve.data_path] = {}
-                times[frame][object.name][fcurve.data_path][attribute_name] = value
-
-    #We now extract the data as a list of tuples, and sort them according to
-    #the time they occur
-    times_list = sorted(times.items())
-
-    # We go through all the times in order, starting with the first and insert
-    # them into the right animation. The animation_list has to be sorted
-    # for this to work, which is done at the top
-    current_frame, key_nodes = times_list.pop(0)
-    done = False
+    # A keyframe belongs to the first animation which hasn't ended before it,
+    # so the animations are found by a binary search over the largest end
+    # frame so far
+    end_frames = []
     for animation in animation_list:
-        if done:
-            break
-        while(current_frame <= animation['end_frame']):
-            #The animation has to have a keyframe after the start frame,
-            #otherwise it won't get inserted into this animation
-            if current_frame >= animation['start_frame']:
-                for node, data_paths in key_nodes.items():
-                    if node not in animation['nodes']:
-                        animation['nodes'][node] = {}
-                    for path, attributes in data_paths.items():
-                        if path not in animation['nodes'][node]:
-                            animation['nodes'][node][path] = {}
-                        animation['nodes'][node][path][current_frame] = attributes
-            if times_list:
-                current_frame, key_nodes = times_list.pop(0)
-            else:
-                done = True
+        end_frame = animation["end_frame"]
+        if end_frames:
+            end_frame = max(end_frame, end_frames[-1])
+        end_frames.append(end_frame)
+
+    for object_name, tracks in gather_tracks(objects).items():
+        for data_path, (frames, rows) in tracks.items():
+            first = 0
+            for animation, end_frame in zip(animation_list, end_frames):
+                last = bisect.bisect_right(frames, end_frame, first)
+                #The keyframes before the start frame don't belong to any
+                #animation
+                start = bisect.bisect_left(frames, animation["start_frame"], first, last)
+                if start < last:
+                    node_tracks = animation["nodes"].setdefault(object_name, {})
+                    node_tracks[data_path] = (frames[start:last], rows[start:last])
+                first = last
+                if first == len(frames):
+                    break
 
     animation_dict = dict(zip([animation['name'] for animation in animation_list],
                                animation_list))
+    for animation in action_animations:
+        animation_dict[animation.name] = build_action_animation_data(objects, animation)
     return animation_dict
+
+
+def build_action_animation_data(objects, animation):
+    """ Creates the animation data of an animation imported as separate
+        actions, from the NLA strips named after the animation. The frames
+        of the keys are mapped to the frames of the strips """
+    nodes = {}
+    for object in objects:
+        strip = find_strip(object, animation.name)
+        if strip is None:
+            continue
+        tracks = action_tracks(strip.action, object)
+        if not tracks:
+            continue
+        node_tracks = nodes[object.name] = {}
+        for data_path, (frames, rows) in tracks.items():
+            node_tracks[data_path] = ([strip.frame_start + (frame - strip.action_frame_start) * strip.scale
+                                       for frame in frames], rows)
+    return {"name": animation.name,
+            "start_frame": animation.start_frame,
+            "end_frame": animation.end_frame,
+            "nodes": nodes}
+
+
+def find_strip(object, name):
+    """ Returns the NLA strip of an object called `name` which has an action,
+        or None """
+    if not object.animation_data:
+        return None
+    for track in object.animation_data.nla_tracks:
+        for strip in track.strips:
+            if strip.name == name and strip.action:
+                return strip
+    return None
+
+
+def gather_tracks(objects):
+    """ Collects the keyframes of the objects by object name and data path.
+
+            Every track is a tuple of the sorted frames where any channel of
+            the data path has a key and the rows of channel values at those
+            frames, ordered as in the nwn keys. Channels without a key at a
+            frame are evaluated there, channels without any keys keep the
+            current value of the object.
+    """
+    tracks = {}
+    for object in objects:
+        if not object.animation_data or not object.animation_data.action:
+            continue
+        object_tracks = action_tracks(object.animation_data.action, object)
+        if object_tracks:
+            tracks[object.name] = object_tracks
+    return tracks
+
+
+def action_tracks(action, object):
+    """ Returns the tracks of the keyframes of an action animating `object`
+        by data path, see gather_tracks """
+    channels = {}
+    for fcurve in action.fcurves:
+        if fcurve.data_path in CHANNEL_ORDER:
+            channels.setdefault(fcurve.data_path, {})[fcurve.array_index] = fcurve
+
+    tracks = {}
+    for data_path, fcurves in channels.items():
+        keys = {}
+        for array_index, fcurve in fcurves.items():
+            keys[array_index] = dict(keyframe_coordinates(fcurve))
+        frames = sorted(set().union(*keys.values()))
+        if not frames:
+            continue
+
+        columns = []
+        for array_index in CHANNEL_ORDER[data_path]:
+            fcurve = fcurves.get(array_index)
+            if fcurve is None:
+                value = getattr(object, data_path)[array_index]
+                columns.append([value] * len(frames))
+                continue
+            values = keys[array_index]
+            columns.append([values[frame] if frame in values else fcurve.evaluate(frame)
+                            for frame in frames])
+        tracks[data_path] = (frames, [list(row) for row in zip(*columns)])
+    return tracks
+
+
+def keyframe_coordinates(fcurve):
+    """ Returns the (frame, value) pairs of the keyframes of an fcurve """
+    points = fcurve.keyframe_points
+    if mdl.numpy is not None:
+        coordinates = mdl.numpy.empty(len(points) * 2, dtype=mdl.numpy.float32)
+        points.foreach_get("co", coordinates)
+        return coordinates.reshape(-1, 2).tolist()
+    return [point.co[:] for point in points]
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+'''
+Contains functions for computing content fingerprints of models.
+
+A fingerprint is a hash of the canonical content of a model, node or
+animation. Names and other strings are compared case insensitively, like the
+game does, floats are rounded to the precision they are written with and the
+properties are hashed in the order of the node schema. Two models with the
+same fingerprint produce the same ascii model, up to the case of the names.
+
+The values are hashed directly, numeric matrices as packed arrays, so no text
+is produced.
+
+@author: Erik Ylipää
+'''
+
+import hashlib
+import math
+import struct
+from collections.abc import Mapping
+
+try:
+    from . import mdl_diff
+except ValueError:
+    import mdl_diff
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FLOAT_DIGITS = 9
+""" The significant digits floats are written with, see FloatProperty """
+
+AABB_DECIMALS = 7
+""" The decimals AABB tree coordinates are written with """
+
+
+def fingerprint_model(model):
+    """ Returns the fingerprint of an mdl.Model, built from the fingerprints
+        of its nodes and animations """
+    digest = hashlib.sha1()
+    update_string(digest, model.name)
+    update_string(digest, model.supermodel)
+    update_string(digest, model.classification)
+    update_value(digest, float(model.setanimationscale))
+    for node in model.geometry.nodes:
+        update_string(digest, node.fingerprint())
+    for animation in model.animations:
+        update_string(digest, animation.fingerprint())
+    return digest.hexdigest()
+
+
+def fingerprint_node(node):
+    """ Returns the fingerprint of the type, name and written properties of
+        a node """
+    digest = hashlib.sha1()
+    update_string(digest, node.type)
+    update_string(digest, node.name)
+    values = node.values
+    for prop in node.schema.props:
+        if prop.name in values:
+            update_string(digest, prop.name)
+            value = values[prop.name]
+            if isinstance(value, Mapping):
+                update_numbers(digest, mdl_diff.flatten_tree(value),
+                               decimals=AABB_DECIMALS)
+            else:
+                update_value(digest, value)
+    return digest.hexdigest()
+
+
+def fingerprint_animation(animation):
+    """ Returns the fingerprint of an animation and its nodes """
+    digest = hashlib.sha1()
+    update_string(digest, animation.name)
+    update_value(digest, float(animation.length))
+    update_value(digest, float(animation.transtime))
+    update_string(digest, animation.animroot)
+    for time, event in animation.events:
+        update_value(digest, float(time))
+        update_string(digest, event)
+    for node in animation.nodes:
+        update_string(digest, node.fingerprint())
+    return digest.hexdigest()
+
+
+def update_string(digest, string):
+    data = str(string).lower().encode("utf-8")
+    digest.update(b"s" + struct.pack("<I", len(data)) + data)
+
+
+def update_value(digest, value):
+    """ Hashes a property value, numeric vectors and matrices are hashed as
+        arrays of rounded floats """
+    if isinstance(value, bool):
+        digest.update(b"b1" if value else b"b0")
+    elif isinstance(value, str):
+        update_string(digest, value)
+    elif isinstance(value, (int, float)):
+        update_numbers(digest, [value])
+    elif not update_numbers(digest, value):
+        # Values mixing strings and numbers, like skin weights
+        digest.update(b"l" + struct.pack("<I", len(value)))
+        for item in value:
+            update_value(digest, item)
+
+
+def update_numbers(digest, value, decimals=None):
+    """ Hashes the vector or matrix `value` as rounded floats. Returns False
+        without hashing anything if `value` isn't a numeric array.
+
+            Floats are rounded to FLOAT_DIGITS significant digits, or to
+            `decimals` decimals if it is given.
+    """
+    if numpy is not None:
+        try:
+            array = numpy.asarray(value)
+        except ValueError:
+            return False
+        # Only numbers, numpy would convert numeric strings to floats as well
+        if array.ndim > 2 or array.dtype.kind not in "iuf":
+            return False
+        array = array.astype(float)
+        if decimals is None:
+            array = round_significant(array)
+        else:
+            array = numpy.round(array, decimals)
+        # Adding zero turns negative zeros into zeros
+        array = (array + 0.0).astype("<f8")
+        shape = array.shape + (1,) * (2 - array.ndim)
+        if not array.size:
+            shape = (0, 1)
+        digest.update(b"a" + struct.pack("<II", *shape) + array.tobytes())
+        return True
+
+    if value and isinstance(value[0], (list, tuple)):
+        rows = value
+    else:
+        rows = [value]
+    columns = len(rows[0]) if rows else 0
+    numbers = []
+    for row in rows:
+        if len(row) != columns:
+            return False
+        for number in row:
+            if isinstance(number, bool) or not isinstance(number, (int, float)):
+                return False
+            if decimals is None:
+                numbers.append(round_float(float(number)) + 0.0)
+            else:
+                numbers.append(round(float(number), decimals) + 0.0)
+    if not numbers:
+        shape = (0, 1)
+    elif rows is not value:
+        shape = (columns, 1)
+    else:
+        shape = (len(rows), columns)
+    digest.update(b"a" + struct.pack("<II", *shape) +
+                  struct.pack("<%dd" % len(numbers), *numbers))
+    return True
+
+
+def round_float(number):
+    """ Rounds a float to FLOAT_DIGITS significant digits """
+    if number == 0 or math.isinf(number) or math.isnan(number):
+        return number
+    scale = 10.0 ** (FLOAT_DIGITS - 1 - math.floor(math.log10(abs(number))))
+    return round(number * scale) / scale
+
+
+def round_significant(array):
+    """ Rounds all floats of an array to FLOAT_DIGITS significant digits """
+    array = array.copy()
+    finite = numpy.isfinite(array) & (array != 0)
+    values = array[finite]
+    scale = 10.0 ** (FLOAT_DIGITS - 1 - numpy.floor(numpy.log10(numpy.abs(values))))
+    array[finite] = numpy.round(values * scale) / scale
+    return array
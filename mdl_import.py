@@ -30,58 +30,52 @@ properties for all Neverwinter specific settings.
 import os
 
 import bpy
-from bpy_extras.io_utils import ImportHelper
-from bpy.props import CollectionProperty, StringProperty, BoolProperty
 
 from . import mdl
+from . import mdl_binary
 from . import blend_props
 from . import basic_props
 
 IMAGE_EXTENSIONS = ["tga", "dds", "TGA", "DDS"]
 DEFAULT_IMG_SIZE = 128
 
+KEY_PATHS = [("positionkey", "location", [1, 2, 3]),
+             ("orientationkey", "rotation_axis_angle", [4, 1, 2, 3])]
+""" The nwn keys, the data paths they are imported to and the columns of
+    the key rows in the order of the array indices of the data path """
 
-class BorealisImport(bpy.types.Operator, ImportHelper):
-    '''
-    Import Neverwinter Nights model in ascii format
-    '''
-    bl_idname = "import_mesh.nwn_mdl"
-    bl_label = "Import NWN Mdl"
+KEYFRAME_LINEAR = 1
+""" The value of the LINEAR keyframe interpolation """
 
-    filename_ext = ".mdl"
+NLA_TRACK_NAME = "NWN animations"
+""" The NLA track holding the strips of animations imported as separate
+    actions """
 
-    filter_glob = StringProperty(default="*.mdl", options={'HIDDEN'})
-
-    files = CollectionProperty(name="File Path",
-                          description="File path used for importing "
-                                      "the MDL file",
-                          type=bpy.types.OperatorFileListElement)
-    directory = StringProperty(subtype='DIR_PATH')
-
-    do_import_animations = BoolProperty(name="Import animations", default=True,
-                                     description="Should the animations be"
-                                     "imported as well. If not selected, only"
-                                     " geometry will be imported.")
-
-    def execute(self, context):
-        kwargs = self.as_keywords(ignore=("check_existing", "filter_glob",
-                                          "files" "directory", "filename_ext"))
-        import_mdl(self.filepath, context, **kwargs)
-        return {'FINISHED'}
+NLA_REST_TRACK_NAME = "NWN rest pose"
+""" The lowest NLA track, holding the static pose of objects with animations
+    imported as separate actions """
 
 
 def import_mdl(filename, context, enforce_lowercase_names=True,
-               do_import_animations=True, **kwargs):
+               do_import_animations=True, weld_vertices=False,
+               weld_distance=0.0001, **kwargs):
     """
     Imports a Neverwinter Nights model
     """
     mdl_object = mdl.Model()
-    mdl_object.from_file(filename)
+    mdl_object.from_file(filename, ascii=not mdl_binary.is_binary(filename),
+                         use_arrays=mdl.numpy is not None,
+                         load_animations=do_import_animations)
 
-    objects = []
+    #The imported objects by node name. Blender renames objects whose name
+    #is taken, e.g. by an earlier import of the same model
+    objects_by_name = {}
 
     print("Import nwn model")
 
+    if weld_vertices:
+        mdl_object.weld_vertices(weld_distance)
+
     if enforce_lowercase_names:
         mdl_object.name = mdl_object.name.lower()
         for node in mdl_object.geometry.nodes:
@@ -104,9 +98,9 @@ def import_mdl(filename, context, enforce_lowercase_names=True,
     #Theres a bug here; if there are no objects in the scene we can't set the mode to OBJECT
     #bpy.ops.object.mode_set(mode='OBJECT')
 
-    import_geometry(mdl_object, filename, context, objects, **kwargs)
+    import_geometry(mdl_object, filename, context, objects_by_name, **kwargs)
     if mdl_object.animations and do_import_animations:
-        import_animations(mdl_object, context, objects,
+        import_animations(mdl_object, context, objects_by_name,
                           **kwargs)
 
     #the basic settings for the models are assigned to the active scene object
@@ -118,7 +112,7 @@ def import_mdl(filename, context, enforce_lowercase_names=True,
     scene.nwn_props.animationscale = float(mdl_object.setanimationscale)
 
 
-def import_geometry(mdl_object, filename, context, objects, **kwargs):
+def import_geometry(mdl_object, filename, context, objects_by_name, **kwargs):
     #create meshes from all nodes
     for node in mdl_object.geometry.nodes:
 
@@ -132,8 +126,8 @@ def import_geometry(mdl_object, filename, context, objects, **kwargs):
 
             ### set up geometry ###
 
-            verts = [[float(comp) for comp in vert] for vert in node.get_prop_value("verts")]
-            faces = [[int(vert) for vert in face[:3]] for face in node.get_prop_value("faces")]
+            verts = node.properties["verts"].get_rows()
+            faces = [face[:3] for face in node.properties["faces"].get_rows()]
             mesh.from_pydata(verts, [], faces)
 
             ### set up texture and uv-coords ###
@@ -174,7 +168,7 @@ def import_geometry(mdl_object, filename, context, objects, **kwargs):
                     ##add the hook modifier
                     hook_name = "nwn_skin_hook_" + bone
                     hook_mod = ob.modifiers.new(name=hook_name, type='HOOK')
-                    hook_mod.object = bpy.data.objects[bone]
+                    hook_mod.object = objects_by_name[bone]
                     hook_mod.vertex_group = vertex_group_name
 
             elif node.type == "aabb":
@@ -211,7 +205,7 @@ def import_geometry(mdl_object, filename, context, objects, **kwargs):
         #set up parent, we assume the parent node is already imported
         parent_name = node.get_prop_value("parent")
         try:
-            parent_ob = bpy.data.objects[parent_name]
+            parent_ob = objects_by_name[parent_name]
         except KeyError:
             print("No such parent: %s" % parent_name)
         else:
@@ -233,7 +227,7 @@ def import_geometry(mdl_object, filename, context, objects, **kwargs):
             ob.rotation_axis_angle = [angle] + axis
 
         bpy.context.scene.objects.link(ob)
-        objects.append(ob)
+        objects_by_name[node_name] = ob
 
         #this has to be done after the object has been linked to the scene
         if node.type == "skin":
@@ -288,7 +282,8 @@ def import_aabb(ob, node):
 
 def setup_texture(mesh, node, filename):
     #if the node has no texture vertices, do nothing
-    if not node.get_prop_value("tverts"):
+    tverts = node.properties["tverts"].get_rows()
+    if not tverts:
         return
 
     ##load image ###
@@ -315,10 +310,11 @@ def setup_texture(mesh, node, filename):
         image = bpy.data.images[image_name]
 
     #we slice the vert since tverts has one value too many
-    texture_verts = [[float(comp) for comp in vert[:2]] for vert in node.get_prop_value("tverts")]
+    texture_verts = [vert[:2] for vert in tverts]
 
     ## the face list points out which texture_verts to use
-    nwn_uv_faces = [[int(vert) for vert in face[4:7]] for face in node.get_prop_value("faces")]
+    faces = node.properties["faces"].get_rows()
+    nwn_uv_faces = [face[4:7] for face in faces]
 
     mesh.uv_textures.new()
     mesh_uv_faces = mesh.uv_textures.active.data[:]
@@ -333,7 +329,7 @@ def setup_texture(mesh, node, filename):
 
     #We also set up the smoothing groups as blender materials, since blender
     #doesn't really have the notion of smoothing groups in 2.5
-    smoothing_indices = [face[3] for face in node.get_prop_value("faces")]
+    smoothing_indices = [face[3] for face in faces]
     faces = mesh.faces
     for face, smoothing_index in enumerate(smoothing_indices):
         mat_name = "Smooth_" + str(smoothing_index)
@@ -345,104 +341,213 @@ def setup_texture(mesh, node, filename):
         faces[face].material_index = mesh.materials.keys().index(mat_name)
 
 
-def import_animations(mdl_object, context, objects, **kwargs):
+def import_animations(mdl_object, context, objects_by_name, use_actions=False,
+                      **kwargs):
     """
-    Imports all animations in a single action, as a long timestrip
-    """
-
-    static_poses = {}
-    object_paths = {}
-    animations_dict = {}
-    for ob in objects:
-        #save the location and rotation of the static pose for
-        poses = {}
-        poses['location'] = ob.location[:]
-        poses['rotation_axis_angle'] = ob.rotation_axis_angle[:]
-        static_poses[ob] = poses
-
-        #create animation data for the object
-        ob.animation_data_create()
-        ob.animation_data.action = bpy.data.actions.new(name="NWN" + ob.name)
-
-        #Simplify access to the important fcurves
-        object_paths[ob.name] = {}
-        object_paths[ob.name]['location'] = {}
-        object_paths[ob.name]['rotation_axis_angle'] = {}
+    Imports all animations in a single action, as a long timestrip.
 
-        object_paths[ob.name]['location']['x'] = ob.animation_data.action.fcurves.new(data_path="location", index=0)
-        object_paths[ob.name]['location']['y'] = ob.animation_data.action.fcurves.new(data_path="location", index=1)
-        object_paths[ob.name]['location']['z'] = ob.animation_data.action.fcurves.new(data_path="location", index=2)
+    If use_actions is True, every animation instead gets its own action for
+    every object it keys, placed on the timestrip as an NLA strip named after
+    the animation.
 
-        object_paths[ob.name]['rotation_axis_angle']['w'] = ob.animation_data.action.fcurves.new(data_path="rotation_axis_angle", index=0)
-        object_paths[ob.name]['rotation_axis_angle']['x'] = ob.animation_data.action.fcurves.new(data_path="rotation_axis_angle", index=1)
-        object_paths[ob.name]['rotation_axis_angle']['y'] = ob.animation_data.action.fcurves.new(data_path="rotation_axis_angle", index=2)
-        object_paths[ob.name]['rotation_axis_angle']['z'] = ob.animation_data.action.fcurves.new(data_path="rotation_axis_angle", index=3)
-
-        #set up the basic information in the animations_dict
-        animations_dict[ob.name] = {'location': {'x': [], 'y': [], 'z': []},
-                                    'rotation_axis_angle': {'x': [], 'y': [], 'z': [], 'w': []}}
+    objects_by_name maps the node names to the imported objects.
+    """
+    animations = list(mdl_object.animations)
+
+    #The keys are collected in animations_dict for the single action, it is
+    #None when the animations get separate actions
+    animations_dict = None
+    if not use_actions:
+        #Only the objects and data paths keyed by some animation get an action
+        #and fcurves. The keys are counted first, so the keys of every channel can
+        #be collected in arrays allocated once. Every animation keying a data
+        #path also gets the static pose in the frames before and after it
+        key_counts = {}
+        for animation in animations:
+            for node in animation.nodes:
+                #Found a model where some parts weren't in the geometry
+                if node.name not in objects_by_name:
+                    continue
+                for key_name, data_path, columns in KEY_PATHS:
+                    keys = node.get_prop_value(key_name)
+                    if keys is not None and len(keys):
+                        counts = key_counts.setdefault(node.name, {})
+                        counts[data_path] = counts.get(data_path, 0) + len(keys) + 2
+
+        animations_dict = {}
+        for ob_name, counts in key_counts.items():
+            ob = objects_by_name[ob_name]
+            animations_dict[ob_name] = dict((data_path, ChannelKeys(count, getattr(ob, data_path)[:]))
+                                            for data_path, count in counts.items())
 
     current_frame = 1
 
-    for animation in mdl_object.animations:
-        #set the static frame before every animation
-        current_frame = set_static_frame(static_poses, animations_dict, current_frame)
+    for animation in animations:
+        #the frame before every animation is left for the static pose
         current_frame += 1
         #import animation
-        current_frame = import_animation(animation, animations_dict, current_frame, context, **kwargs)
+        current_frame = import_animation(animation, animations_dict, current_frame, context,
+                                         objects_by_name=objects_by_name, **kwargs)
+        #as is the frame after the animation
         current_frame += 1
-        #set the static frame after the animation
-        current_frame = set_static_frame(static_poses, animations_dict, current_frame)
         current_frame += 10
 
-    #print(animations_dict)
     #go through the animations_dict and actually insert the data in the fcurves
-    apply_animations(animations_dict, object_paths)
-
+    if animations_dict is not None:
+        apply_animations(animations_dict, objects_by_name)
+
+
+class ChannelKeys(object):
+    """ The keys of a data path of an object, as frames and rows of channel
+        values in the order of the array indices of the data path. `pose` is
+        the value of the data path in the static pose. With numpy the arrays
+        are allocated for `count` keys up front """
+
+    def __init__(self, count, pose):
+        self.count = 0
+        self.pose = pose
+        if mdl.numpy is not None:
+            self.frames = mdl.numpy.zeros(count, dtype=mdl.numpy.float32)
+            self.values = mdl.numpy.zeros((count, len(pose)), dtype=mdl.numpy.float32)
+        else:
+            self.frames = []
+            self.values = []
 
-def apply_animations(animations_dict, object_paths):
+    def add_key(self, frame, values):
+        if mdl.numpy is not None:
+            self.frames[self.count] = frame
+            self.values[self.count] = values
+        else:
+            self.frames.append(frame)
+            self.values.append(list(values))
+        self.count += 1
+
+    def add_keys(self, rows, columns, fps, start_frame):
+        """ Adds nwn key rows, where the first column is the time in seconds
+            and `columns` are the columns of the channel values """
+        if mdl.numpy is not None:
+            rows = mdl.numpy.asarray(rows, dtype=float).reshape(len(rows), -1)
+            end = self.count + len(rows)
+            self.frames[self.count:end] = rows[:, 0] * fps + start_frame
+            self.values[self.count:end] = rows[:, columns]
+            self.count = end
+        else:
+            for row in rows:
+                self.add_key(row[0] * fps + start_frame, [row[column] for column in columns])
+
+    def coordinates(self, channel):
+        """ Returns the flat list of frame and value pairs of a channel, as
+            used by foreach_set on keyframe points """
+        if mdl.numpy is not None:
+            return mdl.numpy.column_stack((self.frames[:self.count],
+                                           self.values[:self.count, channel])).ravel()
+        coordinates = []
+        for frame, values in zip(self.frames, self.values):
+            coordinates.append(frame)
+            coordinates.append(values[channel])
+        return coordinates
+
+
+def apply_animations(animations_dict, objects_by_name):
     """
     Takes the information inserted in animations_dict and applies it to the fcurve
     of every object
     """
-    for ob, data_paths in animations_dict.items():
-        for data_path, components in data_paths.items():
-            for component, values in components.items():
-                fcurve = object_paths[ob][data_path][component]
-                fcurve.keyframe_points.add(len(values))
-                for i, value in enumerate(values):
-                    #print("Setting value %s for fcurve %s" % (str(value), str(data_path + component)))
-                    fcurve.keyframe_points[i].co = value
-                    #Setting the handles at the same coordinate as the point seems to be
-                    #the easiest way of dealing with them for the moment
-                    fcurve.keyframe_points[i].handle_right = value
-                    fcurve.keyframe_points[i].handle_left = value
-
-
-def set_static_frame(static_poses, animations_dict, current_frame):
-    """
-    Inserts the static pose for all objects for the current frame, and returns value of next frame.
-    """
-    for ob, poses in static_poses.items():
-        loc_x, loc_y, loc_z = poses['location']
-        rot_w, rot_x, rot_y, rot_z = poses['rotation_axis_angle']
+    for node_name, ob in objects_by_name.items():
+        if node_name not in animations_dict:
+            continue
+        #create animation data for the object
+        ob.animation_data_create()
+        action = bpy.data.actions.new(name="NWN" + ob.name)
+        ob.animation_data.action = action
+        add_fcurves(action, animations_dict[node_name])
+
+
+def add_fcurves(action, channel_keys):
+    """ Creates the fcurves of an action from a dictionary of ChannelKeys by
+        data path """
+    for data_path, keys in channel_keys.items():
+        for channel in range(len(keys.pose)):
+            fcurve = action.fcurves.new(data_path=data_path, index=channel)
+            coordinates = keys.coordinates(channel)
+            points = fcurve.keyframe_points
+            points.add(keys.count)
+            points.foreach_set("co", coordinates)
+            #Setting the handles at the same coordinate as the point seems to be
+            #the easiest way of dealing with them for the moment
+            points.foreach_set("handle_left", coordinates)
+            points.foreach_set("handle_right", coordinates)
+            #The game interpolates linearly between the keys
+            points.foreach_set("interpolation", [KEYFRAME_LINEAR] * keys.count)
+            fcurve.update()
+
+
+def import_animation_actions(animation, objects_by_name, start_frame, end_frame, fps):
+    """ Imports the keys of an animation as one action for every object it
+        keys. The actions are placed at the start frame as NLA strips named
+        after the animation """
+    for node in animation.nodes:
+        ob = objects_by_name.get(node.name)
+        if ob is None:
+            continue
+        channel_keys = {}
+        for key_name, data_path, columns in KEY_PATHS:
+            keys = node.get_prop_value(key_name)
+            if keys is not None and len(keys):
+                #The frames of the action start from 0 at the start of the animation
+                channel_keys[data_path] = ChannelKeys(len(keys), getattr(ob, data_path)[:])
+                channel_keys[data_path].add_keys(keys, columns, fps, 0)
+        if not channel_keys:
+            continue
 
-        animations_dict[ob.name]['location']['x'].append((current_frame, loc_x))
-        animations_dict[ob.name]['location']['y'].append((current_frame, loc_y))
-        animations_dict[ob.name]['location']['z'].append((current_frame, loc_z))
+        action = bpy.data.actions.new(name="%s.%s" % (animation.name, ob.name))
+        add_fcurves(action, channel_keys)
 
-        animations_dict[ob.name]['rotation_axis_angle']['w'].append((current_frame, rot_w))
-        animations_dict[ob.name]['rotation_axis_angle']['x'].append((current_frame, rot_x))
-        animations_dict[ob.name]['rotation_axis_angle']['y'].append((current_frame, rot_y))
-        animations_dict[ob.name]['rotation_axis_angle']['z'].append((current_frame, rot_z))
+        strip = animation_track(ob).strips.new(animation.name, start_frame, action)
+        strip.action_frame_start = 0
+        strip.action_frame_end = max(end_frame - start_frame, 1)
+        #Outside of its animation the rest pose below shows through
+        strip.extrapolation = 'NOTHING'
 
-    return current_frame
+
+def animation_track(ob):
+    """ Returns the NLA track of the animation strips of an object. The
+        first time, the track is created above a track holding the static
+        pose of the object """
+    if not ob.animation_data:
+        ob.animation_data_create()
+    tracks = ob.animation_data.nla_tracks
+    track = tracks.get(NLA_TRACK_NAME)
+    if track is None:
+        add_rest_pose(ob)
+        track = tracks.new()
+        track.name = NLA_TRACK_NAME
+    return track
+
+
+def add_rest_pose(ob):
+    """ Keys the current pose of an object in an action, held from frame 1 by
+        a strip on a new NLA track """
+    channel_keys = {}
+    for key_name, data_path, columns in KEY_PATHS:
+        pose = getattr(ob, data_path)[:]
+        channel_keys[data_path] = ChannelKeys(1, pose)
+        channel_keys[data_path].add_key(1, pose)
+    action = bpy.data.actions.new(name="rest.%s" % ob.name)
+    add_fcurves(action, channel_keys)
+
+    track = ob.animation_data.nla_tracks.new()
+    track.name = NLA_REST_TRACK_NAME
+    strip = track.strips.new(NLA_REST_TRACK_NAME, 1, action)
+    strip.extrapolation = 'HOLD'
 
 
 def import_animation(animation, animations_dict, current_frame,
-                     context, **kwargs):
+                     context, objects_by_name=None, **kwargs):
     """
     Parses a single animation and inserts channel data in animations_dict.
+    If animations_dict is None, the animation is imported in separate
+    actions for the objects in objects_by_name instead.
     Returns the frame number of the last frame in the animation
     """
     scene = context.scene
@@ -468,29 +573,23 @@ def import_animation(animation, animations_dict, current_frame,
         event.time = time
         event.update_name(None)
 
+    if animations_dict is None:
+        anim_ob.use_actions = True
+        import_animation_actions(animation, objects_by_name, start_frame,
+                                 end_frame, fps)
+        return end_frame
+
     for node in animation.nodes:
-        node_name = node.name
-        #Found a model where some parts weren't in the geometry
-        if node_name not in animations_dict:
+        #Only nodes with keys are in the animations_dict
+        if node.name not in animations_dict:
             continue
-        for property in node.properties.values():
-            if not property.value_written:
-                continue
-            if property.name == "positionkey":
-                for time, x, y, z in property.value:
-                    key_frame = time * fps + start_frame
-#                        print("adding position key to frame %i" % key_frame)
-                    animations_dict[node_name]['location']['x'].append((key_frame, x))
-                    animations_dict[node_name]['location']['y'].append((key_frame, y))
-                    animations_dict[node_name]['location']['z'].append((key_frame, z))
-
-            elif property.name == "orientationkey":
-                for time, x, y, z, w in property.value:
-                    key_frame = time * fps + start_frame
-
-#                        print("adding orientation key to frame %i" % key_frame)
-                    animations_dict[node_name]['rotation_axis_angle']['w'].append((key_frame, w))
-                    animations_dict[node_name]['rotation_axis_angle']['x'].append((key_frame, x))
-                    animations_dict[node_name]['rotation_axis_angle']['y'].append((key_frame, y))
-                    animations_dict[node_name]['rotation_axis_angle']['z'].append((key_frame, z))
+        for key_name, data_path, columns in KEY_PATHS:
+            keys = node.get_prop_value(key_name)
+            if keys is not None and len(keys):
+                #The static pose around the animation keeps the keys from
+                #blending into the neighbouring animations
+                channel_keys = animations_dict[node.name][data_path]
+                channel_keys.add_key(start_frame - 1, channel_keys.pose)
+                channel_keys.add_keys(keys, columns, fps, start_frame)
+                channel_keys.add_key(end_frame + 1, channel_keys.pose)
     return end_frame
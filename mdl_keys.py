@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+'''
+Contains functions for reducing the position and orientation keys of
+animations.
+
+A key is removed if the game reproduces it by interpolating between the
+remaining keys, within a tolerance. Positions are interpolated linearly and
+orientations, which are axis-angle rotations, are interpolated as quaternions
+with slerp. Tracks which keep the pose of the geometry node are removed, as
+are animation nodes which are left without keys.
+
+@author: Erik Ylipää
+'''
+
+import math
+
+try:
+    from . import mdl_mesh
+except ValueError:
+    import mdl_mesh
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_POSITION_TOLERANCE = 0.0005
+""" The largest distance between a removed position key and the interpolated
+    position, in model units """
+
+DEFAULT_ANGLE_TOLERANCE = 0.001
+""" The largest angle between a removed orientation key and the interpolated
+    orientation, in radians """
+
+KEY_TRACKS = [("positionkey", "position", False),
+              ("orientationkey", "orientation", True)]
+""" The reduced key properties, the geometry property with their pose and
+    whether they are orientations """
+
+
+def reduce_model(model, position_tolerance=DEFAULT_POSITION_TOLERANCE,
+                 angle_tolerance=DEFAULT_ANGLE_TOLERANCE):
+    """ Reduces the keys of all animations of `model`, returns the number of
+        removed keys """
+    return sum(reduce_animation(animation, model.geometry, position_tolerance,
+                                angle_tolerance)
+               for animation in model.animations)
+
+
+def reduce_animation(animation, geometry=None,
+                     position_tolerance=DEFAULT_POSITION_TOLERANCE,
+                     angle_tolerance=DEFAULT_ANGLE_TOLERANCE):
+    """ Reduces the keys of the nodes of an mdl.Animation, returns the number
+        of removed keys.
+
+            If the mdl.Geometry `geometry` is given, tracks which keep the
+            pose of the geometry node are removed, and so are the nodes left
+            without any values but the parent. The first node and the nodes
+            which are parents of other nodes are always kept.
+    """
+    removed = 0
+    for node in animation.nodes:
+        pose_node = geometry.get_node(node.name) if geometry is not None else None
+        removed += reduce_node(node, pose_node, position_tolerance,
+                               angle_tolerance)
+
+    if geometry is not None:
+        # Children follow their parents, so a node is known to be unused when
+        # it is reached in reverse
+        parents = set()
+        kept_nodes = []
+        for index in range(len(animation.nodes) - 1, -1, -1):
+            node = animation.nodes[index]
+            name = node.name.lower()
+            if (index == 0 or name in parents or
+                    name == str(animation.animroot).lower() or
+                    set(node.values) - set(["parent"])):
+                kept_nodes.append(node)
+                parents.add(str(node.values.get("parent", "")).lower())
+        kept_nodes.reverse()
+        animation.nodes[:] = kept_nodes
+    return removed
+
+
+def reduce_node(node, pose_node=None,
+                position_tolerance=DEFAULT_POSITION_TOLERANCE,
+                angle_tolerance=DEFAULT_ANGLE_TOLERANCE):
+    """ Reduces the position and orientation keys of an animation node,
+        returns the number of removed keys.
+
+            A constant track is reduced to a single key, or removed if it
+            equals the pose of the geometry node `pose_node`.
+    """
+    removed = 0
+    for name, pose_name, orientation in KEY_TRACKS:
+        if node.values.get(name) is None:
+            continue
+        rows = node.properties[name].get_rows()
+        if not rows or len(set(len(row) for row in rows)) != 1:
+            continue
+        tolerance = angle_tolerance if orientation else position_tolerance
+
+        pose = pose_node.get_prop_value(pose_name) if pose_node is not None else None
+        if pose is not None:
+            pose_row = [0.0] + [float(value) for value in pose]
+            if len(pose_row) == len(rows[0]) and max(key_errors(
+                    [pose_row, pose_row], rows, 0, 1, orientation)) <= tolerance:
+                del node.values[name]
+                removed += len(rows)
+                continue
+
+        kept = reduce_track(rows, tolerance, orientation)
+        if len(kept) < len(rows):
+            mdl_mesh.set_rows(node, name, [rows[index] for index in kept])
+            removed += len(rows) - len(kept)
+    return removed
+
+
+def reduce_track(rows, tolerance, orientation=False):
+    """ Returns the indices of the keys of a track to keep.
+
+            `rows` are position keys (time, x, y, z) or orientation keys
+            (time, x, y, z, angle). The track is simplified like a polyline:
+            starting from the first and last keys, the key which is furthest
+            from the interpolation between the kept keys is kept until all
+            keys are within `tolerance`. A constant track keeps its first key.
+    """
+    count = len(rows)
+    if count < 2:
+        return list(range(count))
+    if numpy is not None:
+        rows = numpy.asarray(rows, dtype=float)
+    else:
+        rows = [[float(value) for value in row] for row in rows]
+
+    if max(key_errors(rows, rows, 0, 0, orientation)) <= tolerance:
+        return [0]
+
+    kept = [0, count - 1]
+    segments = [(0, count - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        errors = key_errors(rows, rows[first + 1:last], first, last, orientation)
+        worst = max(range(len(errors)), key=errors.__getitem__)
+        if errors[worst] > tolerance:
+            middle = first + 1 + worst
+            kept.append(middle)
+            segments.append((first, middle))
+            segments.append((middle, last))
+    return sorted(kept)
+
+
+def key_errors(rows, keys, first, last, orientation):
+    """ Returns the distances or angles between the keys `keys` and the
+        interpolation between the keys `first` and `last` of `rows` at the
+        times of the keys """
+    if numpy is not None:
+        keys = numpy.asarray(keys, dtype=float)
+        rows = numpy.asarray(rows, dtype=float)
+        start = rows[first]
+        end = rows[last]
+        duration = end[0] - start[0]
+        if duration > 0:
+            factors = numpy.clip((keys[:, 0] - start[0]) / duration, 0, 1)
+        else:
+            factors = numpy.zeros(len(keys))
+
+        if not orientation:
+            positions = start[1:] + factors[:, None] * (end[1:] - start[1:])
+            return numpy.sqrt(((keys[:, 1:] - positions) ** 2).sum(axis=1)).tolist()
+
+        quaternions = axis_angle_quaternions(keys[:, 1:])
+        start, end = axis_angle_quaternions(numpy.array([start[1:], end[1:]]))
+        if numpy.dot(start, end) < 0:
+            end = -end
+        cosine = min(numpy.dot(start, end), 1.0)
+        angle = math.acos(cosine)
+        if angle < 1e-6:
+            interpolated = start + factors[:, None] * (end - start)
+        else:
+            interpolated = ((numpy.sin((1 - factors) * angle)[:, None] * start +
+                             numpy.sin(factors * angle)[:, None] * end) /
+                            math.sin(angle))
+        interpolated /= numpy.sqrt((interpolated ** 2).sum(axis=1))[:, None]
+        dots = numpy.minimum(numpy.abs((quaternions * interpolated).sum(axis=1)), 1.0)
+        return (2 * numpy.arccos(dots)).tolist()
+
+    start = rows[first]
+    end = rows[last]
+    duration = end[0] - start[0]
+    errors = []
+    if orientation:
+        start_quaternion = axis_angle_quaternion(start[1:])
+        end_quaternion = axis_angle_quaternion(end[1:])
+    for key in keys:
+        factor = min(max((key[0] - start[0]) / duration, 0), 1) if duration > 0 else 0
+        if not orientation:
+            errors.append(math.sqrt(sum((value - (a + factor * (b - a))) ** 2
+                                        for value, a, b in zip(key[1:], start[1:], end[1:]))))
+            continue
+        interpolated = slerp(start_quaternion, end_quaternion, factor)
+        dot = abs(sum(a * b for a, b in zip(axis_angle_quaternion(key[1:]), interpolated)))
+        errors.append(2 * math.acos(min(dot, 1.0)))
+    return errors
+
+
+def axis_angle_quaternions(rotations):
+    """ Converts rows of (x, y, z, angle) to unit quaternions (x, y, z, w) """
+    axes = rotations[:, :3]
+    lengths = numpy.sqrt((axes ** 2).sum(axis=1))
+    half_angles = numpy.where(lengths > 0, rotations[:, 3], 0) * 0.5
+    scales = numpy.sin(half_angles) / numpy.where(lengths > 0, lengths, 1)
+    return numpy.column_stack((axes * scales[:, None], numpy.cos(half_angles)))
+
+
+def axis_angle_quaternion(rotation):
+    x, y, z, angle = rotation
+    length = math.sqrt(x * x + y * y + z * z)
+    if length == 0:
+        return [0.0, 0.0, 0.0, 1.0]
+    scale = math.sin(angle * 0.5) / length
+    return [x * scale, y * scale, z * scale, math.cos(angle * 0.5)]
+
+
+def slerp(start, end, factor):
+    """ Interpolates between two unit quaternions along the shortest arc """
+    cosine = sum(a * b for a, b in zip(start, end))
+    if cosine < 0:
+        end = [-value for value in end]
+        cosine = -cosine
+    angle = math.acos(min(cosine, 1.0))
+    if angle < 1e-6:
+        result = [a + factor * (b - a) for a, b in zip(start, end)]
+    else:
+        start_weight = math.sin((1 - factor) * angle) / math.sin(angle)
+        end_weight = math.sin(factor * angle) / math.sin(angle)
+        result = [a * start_weight + b * end_weight for a, b in zip(start, end)]
+    length = math.sqrt(sum(value * value for value in result))
+    return [value / length for value in result]
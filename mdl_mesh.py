@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+'''
+Contains functions for processing the mesh data of model nodes.
+
+The functions work on the verts, faces and other mesh properties of
+`mdl.Node` objects, and don't depend on Blender.
+
+@author: Erik Ylipää
+'''
+
+import math
+
+try:
+    from . import props_classes
+except ValueError:
+    import props_classes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MESH_NODE_TYPES = ["trimesh", "danglymesh", "skin", "aabb"]
+
+VERTEX_PROPERTIES = ["colors", "constraints", "weights"]
+""" Mesh properties with one row per vertex """
+
+DEFAULT_WELD_DISTANCE = 0.0001
+
+DEFAULT_UV_TOLERANCE = 0.00001
+
+SAH_MIN_FACES = 32
+""" Nodes of an AABB tree with at most this many faces are split at the
+    median of the face centers instead of with the surface area heuristic """
+
+NEIGHBOR_CELLS = [(dx, dy, dz) for dx in (0, -1, 1) for dy in (0, -1, 1)
+                  for dz in (0, -1, 1)]
+""" Offsets of a cell and its neighbors in the spatial hash, the cell itself
+    first """
+
+
+def weld_vertices(verts, distance, vertex_keys=None):
+    """ Merges vertices closer to each other than `distance`.
+
+            The vertices are put in a spatial hash with cells the size of
+            `distance`, so every vertex is only compared with the vertices in
+            its own and the neighboring cells. If `vertex_keys` is given,
+            only vertices with equal keys are merged.
+
+            Returns a tuple (kept, remap) where `kept` is the list of indices
+            of the vertices which are kept, in order, and `remap` gives the
+            new index of every old vertex.
+    """
+    kept = []
+    remap = []
+
+    if distance <= 0:
+        # Only exact duplicates are merged
+        indices = {}
+        for index, vert in enumerate(verts):
+            key = (tuple(vert), vertex_keys[index] if vertex_keys else None)
+            if key not in indices:
+                indices[key] = len(kept)
+                kept.append(index)
+            remap.append(indices[key])
+        return kept, remap
+
+    inverse = 1.0 / distance
+    max_distance = distance * distance
+    cells = {}
+    floor = math.floor
+
+    for index, (x, y, z) in enumerate(verts):
+        key = vertex_keys[index] if vertex_keys else None
+        cell_x = floor(x * inverse)
+        cell_y = floor(y * inverse)
+        cell_z = floor(z * inverse)
+
+        found = None
+        for dx, dy, dz in NEIGHBOR_CELLS:
+            cell = cells.get((cell_x + dx, cell_y + dy, cell_z + dz))
+            if not cell:
+                continue
+            for new_index in cell:
+                kept_x, kept_y, kept_z = verts[kept[new_index]]
+                if ((x - kept_x) ** 2 + (y - kept_y) ** 2 + (z - kept_z) ** 2 <= max_distance and
+                        (not vertex_keys or vertex_keys[kept[new_index]] == key)):
+                    found = new_index
+                    break
+            if found is not None:
+                break
+
+        if found is None:
+            found = len(kept)
+            kept.append(index)
+            cells.setdefault((cell_x, cell_y, cell_z), []).append(found)
+        remap.append(found)
+
+    return kept, remap
+
+
+def weld_node(node, distance=DEFAULT_WELD_DISTANCE):
+    """ Merges the vertices of a mesh node closer to each other than
+        `distance` and remaps the faces.
+
+            Vertices are only merged if their colors, dangly constraints and
+            skin weights are equal. Texture vertices and the texture indices
+            of the faces are kept as they are. Faces which become degenerate
+            are removed, unless the node has an AABB tree refering to the
+            faces by index. Returns the number of removed vertices.
+    """
+    if node.type not in MESH_NODE_TYPES or node.get_prop_value("verts") is None:
+        return 0
+
+    properties = node.properties
+    verts = properties["verts"].get_rows()
+
+    vertex_properties = [name for name in VERTEX_PROPERTIES
+                         if name in properties and properties[name].value_written and
+                         len(properties[name].value) == len(verts)]
+    vertex_keys = None
+    if vertex_properties:
+        columns = [properties[name].get_rows() for name in vertex_properties]
+        vertex_keys = [tuple(tuple(column[index]) for column in columns)
+                       for index in range(len(verts))]
+
+    kept, remap = weld_vertices(verts, distance, vertex_keys)
+    if len(kept) == len(verts):
+        return 0
+
+    set_rows(node, "verts", [verts[index] for index in kept])
+    for name in vertex_properties:
+        rows = properties[name].get_rows()
+        set_rows(node, name, [rows[index] for index in kept])
+
+    if properties["faces"].value_written:
+        keep_degenerate = "aabb" in properties and properties["aabb"].value_written
+        faces = []
+        for face in properties["faces"].get_rows():
+            face = list(face)
+            face[0:3] = [remap[index] for index in face[0:3]]
+            if keep_degenerate or len(set(face[0:3])) == 3:
+                faces.append(face)
+        set_rows(node, "faces", faces)
+
+    return len(verts) - len(kept)
+
+
+def weld_model(model, distance=DEFAULT_WELD_DISTANCE):
+    """ Welds the vertices of all mesh nodes of the geometry of `model`,
+        returns the total number of removed vertices """
+    return sum(weld_node(node, distance) for node in model.geometry.nodes)
+
+
+def unique_uvs(uvs, tolerance=DEFAULT_UV_TOLERANCE):
+    """ Deduplicates texture coordinates in one pass.
+
+            `uvs` is a sequence or an array of (u, v) pairs, usually the
+            coordinates of all face corners. Coordinates which are equal when
+            quantized to steps of `tolerance` are merged, a tolerance of 0
+            only merges exact duplicates.
+
+            Returns a tuple (unique, indices) where `unique` is a list of the
+            unique coordinates in order of first use and `indices` gives the
+            index in `unique` of every input coordinate.
+    """
+    if numpy is not None:
+        uvs = numpy.asarray(uvs, dtype=float).reshape(-1, 2)
+        if not len(uvs):
+            return [], []
+        keys = numpy.round(uvs / tolerance) if tolerance > 0 else uvs
+        keys, first, inverse = numpy.unique(keys, axis=0, return_index=True,
+                                            return_inverse=True)
+        #numpy sorts the unique rows, they are put back in order of first use
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        return uvs[first[order]].tolist(), rank[inverse.ravel()].tolist()
+
+    unique = []
+    indices = []
+    index_by_key = {}
+    for u, v in uvs:
+        if tolerance > 0:
+            key = (round(u / tolerance), round(v / tolerance))
+        else:
+            key = (u, v)
+        if key not in index_by_key:
+            index_by_key[key] = len(unique)
+            unique.append([u, v])
+        indices.append(index_by_key[key])
+    return unique, indices
+
+
+def build_aabb_tree(verts, faces):
+    """ Builds an AABB tree over the triangles `faces` of a mesh, returns the
+        tree as an AABBTree property value.
+
+            `faces` are rows with the vertex indices in the first three
+            columns, like the rows of the faces property. The tree is built
+            top down without recursion. Every node is split along the axis
+            where the centers of its faces are spread the most, at the
+            position with the lowest surface area heuristic cost. Faces with
+            the same center, like duplicate faces, are split in halves, so
+            every inner node has two children and there is no depth limit.
+            Nodes with at most SAH_MIN_FACES faces are split at the median
+            instead, where the cost of the numpy calls outweighs the gain.
+            Returns None if there are no faces.
+    """
+    if not len(faces):
+        return None
+    if numpy is None:
+        return build_aabb_tree_lists(verts, faces)
+
+    verts = numpy.asarray(verts, dtype=float).reshape(-1, 3)
+    corners = numpy.asarray(faces).reshape(len(faces), -1)[:, :3].astype(int)
+    face_verts = verts[corners]
+    lows = face_verts.min(axis=1)
+    highs = face_verts.max(axis=1)
+    centers = (lows + highs) * 0.5
+    bounds = list(zip(lows.tolist(), highs.tolist(), centers.tolist()))
+
+    tree = props_classes.FlatAABBTree()
+    node_stack = [(numpy.arange(len(corners)), -1, False)]
+    while node_stack:
+        indices, parent, is_right = node_stack.pop()
+        if len(indices) <= SAH_MIN_FACES:
+            add_median_nodes(tree, bounds, indices.tolist(), parent, is_right)
+            continue
+        index = int(indices[0]) if len(indices) == 1 else -1
+        node = tree.add_node(lows[indices].min(axis=0).tolist(),
+                             highs[indices].max(axis=0).tolist(),
+                             index, parent, is_right)
+        if index == -1:
+            axis, left, right = split_sah(indices, lows, highs, centers)
+            tree.axis[node] = axis
+            node_stack.append((right, node, True))
+            node_stack.append((left, node, False))
+    return tree
+
+
+def split_sah(indices, lows, highs, centers):
+    """ Splits the faces `indices` in two non empty halves with the surface
+        area heuristic, returns the split axis and the face indices of the
+        left and right side """
+    count = len(indices)
+    spread = centers[indices].max(axis=0) - centers[indices].min(axis=0)
+    axis = int(spread.argmax())
+    if spread[axis] <= 0:
+        return axis, indices[:count // 2], indices[count // 2:]
+
+    indices = indices[numpy.argsort(centers[indices, axis], kind="stable")]
+    sorted_lows = lows[indices]
+    sorted_highs = highs[indices]
+
+    #Bounds of the first k faces and of the last count - k faces, k = 1..count-1
+    left_areas = box_areas(numpy.minimum.accumulate(sorted_lows)[:-1],
+                           numpy.maximum.accumulate(sorted_highs)[:-1])
+    right_areas = box_areas(numpy.minimum.accumulate(sorted_lows[::-1])[-2::-1],
+                            numpy.maximum.accumulate(sorted_highs[::-1])[-2::-1])
+    left_counts = numpy.arange(1, count)
+    costs = left_areas * left_counts + right_areas * (count - left_counts)
+    split = int(costs.argmin()) + 1
+    return axis, indices[:split], indices[split:]
+
+
+def box_areas(lows, highs):
+    """ Returns the surface areas of the boxes with the corners in the rows
+        of `lows` and `highs` """
+    size = highs - lows
+    return 2 * (size[:, 0] * size[:, 1] + size[:, 1] * size[:, 2] +
+                size[:, 2] * size[:, 0])
+
+
+def build_aabb_tree_lists(verts, faces):
+    """ Builds the AABB tree of build_aabb_tree without numpy, splitting
+        every node at the median of the face centers """
+    bounds = []
+    for face in faces:
+        face_verts = [verts[index] for index in face[0:3]]
+        low = [min(coordinates) for coordinates in zip(*face_verts)]
+        high = [max(coordinates) for coordinates in zip(*face_verts)]
+        bounds.append((low, high, [(l + h) * 0.5 for l, h in zip(low, high)]))
+
+    tree = props_classes.FlatAABBTree()
+    add_median_nodes(tree, bounds, list(range(len(faces))))
+    return tree
+
+
+def add_median_nodes(tree, bounds, indices, parent=-1, is_right=False):
+    """ Adds the nodes over the faces `indices` to `tree`, splitting every
+        node at the median of the face centers.
+
+            `bounds` holds the lowest corner, highest corner and center of
+            the bounding box of every face.
+    """
+    node_stack = [(indices, parent, is_right)]
+    while node_stack:
+        indices, parent, is_right = node_stack.pop()
+        if len(indices) == 1:
+            low, high = bounds[indices[0]][:2]
+            tree.add_node(low, high, indices[0], parent, is_right)
+            continue
+        face_bounds = [bounds[face] for face in indices]
+        node = tree.add_node(list(map(min, zip(*[low for low, high, center
+                                                 in face_bounds]))),
+                             list(map(max, zip(*[high for low, high, center
+                                                 in face_bounds]))),
+                             -1, parent, is_right)
+
+        centers = list(zip(*[center for low, high, center in face_bounds]))
+        spread = [max(values) - min(values) for values in centers]
+        axis = spread.index(max(spread))
+        tree.axis[node] = axis
+        indices = sorted(indices, key=lambda face: bounds[face][2][axis])
+        split = len(indices) // 2
+        node_stack.append((indices[split:], node, True))
+        node_stack.append((indices[:split], node, False))
+
+
+def set_rows(node, name, rows):
+    """ Sets a matrix property from a list of rows, keeping array values as
+        arrays """
+    value = node[name]
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        rows = numpy.array(rows, dtype=value.dtype).reshape(-1, value.shape[1])
+    node[name] = rows
@@ -35,6 +35,9 @@ class NodeProperties():
     props_dict = None
     gui_groups = None
     node_gui_groups = None
+    dispatch_tables = None
+    aliases = {}
+    """ Alternative tokens for properties, in the form {alias: name} """
 
     @classmethod
     def build_dictionary(cls):
@@ -53,6 +56,81 @@ class NodeProperties():
             cls.build_dictionary()
         return cls.props_dict[node_type]
 
+    @classmethod
+    def get_dispatch_table(cls, node_type):
+        """ Returns a dictionary from the tokens which start a property line
+            in a node of type `node_type` to tuples (property name, parse
+            function). Aliases of the properties are included """
+        if cls.dispatch_tables is None:
+            cls.dispatch_tables = {}
+        if node_type not in cls.dispatch_tables:
+            table = {}
+            for prop in cls.get_node_properties(node_type):
+                table[prop.name] = (prop.name, prop.get_parser())
+            for alias, name in cls.aliases.items():
+                if name in table:
+                    table[alias] = table[name]
+            cls.dispatch_tables[node_type] = table
+        return cls.dispatch_tables[node_type]
+
+    @classmethod
+    def get_blender_schema(cls, node_types):
+        """ Returns the Blender properties for the properties of the node
+            types `node_types`, as a list of (name, Blender property type,
+            keyword arguments). The list only contains plain data, so it can
+            be cached as json """
+        props = []
+        names = set()
+        for node_type in node_types:
+            for prop in cls.get_node_properties(node_type):
+                if prop.name not in names:
+                    names.add(prop.name)
+                    props.append(prop)
+
+        schema = []
+        for prop in props:
+            if prop.blender_ignore:
+                continue
+            kwargs = {}
+            kwargs["name"] = prop.name
+            if prop.get_default_value():
+                kwargs["default"] = prop.get_default_value()
+
+            if isinstance(prop, NumberProperty):
+                if prop.max:
+                    kwargs["max"] = prop.max
+                if prop.min:
+                    kwargs["min"] = prop.min
+
+            if isinstance(prop, VectorProperty):
+                if prop.size:
+                    kwargs["size"] = prop.size
+
+            ##The order of the cases are important since some properties are subtypes of other
+            if isinstance(prop, ColorProperty):
+                kwargs["subtype"] = 'COLOR'
+                blender_type = "FloatVectorProperty"
+            elif isinstance(prop, StringProperty):
+                blender_type = "StringProperty"
+            elif isinstance(prop, FloatVectorProperty):
+                blender_type = "FloatVectorProperty"
+            elif isinstance(prop, BooleanProperty):
+                blender_type = "BoolProperty"
+            elif isinstance(prop, EnumProperty):
+                kwargs["items"] = prop.get_blender_items()
+                blender_type = "EnumProperty"
+            elif isinstance(prop, IntProperty):
+                blender_type = "IntProperty"
+            elif isinstance(prop, FloatProperty):
+                blender_type = "FloatProperty"
+            else:
+                #Matrices and other properties without a Blender counterpart
+                #are only kept in the mdl
+                continue
+
+            schema.append((prop.name, blender_type, kwargs))
+        return schema
+
     @classmethod
     def get_properties(cls):
         return cls.props_list
@@ -117,6 +195,7 @@ class NodeProperties():
 class GeometryNodeProperties(NodeProperties):
     """ Class for collecting all geometry-node properties
     """
+    aliases = {"setfillumcolor": "selfillumcolor"}
     props_list = [StringProperty(name="parent", nodes=["dummy", "trimesh", "danglymesh", "skin", "emitter", "light", "aabb", "reference"], blender_ignore=True),
                 FloatVectorProperty(name="position", nodes=["dummy", "trimesh", "danglymesh", "skin", "aabb", "emitter", "light", "reference"], blender_ignore=True),
                 FloatVectorProperty(name="orientation", nodes=["dummy", "trimesh", "danglymesh", "skin", "aabb", "emitter", "light", "reference"], blender_ignore=True),
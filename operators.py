@@ -27,12 +27,17 @@ with Neverwinter Nights specific data in Blender.
 @author: Erik Ylipää
 '''
 import bpy
+from bpy.props import (CollectionProperty, StringProperty, BoolProperty,
+                       FloatProperty)
+from bpy_extras.io_utils import ExportHelper, ImportHelper
 import mathutils
 from mathutils import Color
 
 from . import basic_props
 from . import blend_props
-from . import animation_names
+
+# The import, export and animation name modules are imported when the
+# operators using them run, so they don't slow down the start of Blender
 
 ANIMATION_FRAME_GAP = 10
 
@@ -104,6 +109,7 @@ class SCENE_OT_add_nwn_animation(bpy.types.Operator):
     def invoke(self, context, event):
         wm = context.window_manager
         classification = context.scene.nwn_props.classification
+        from . import animation_names
         names = animation_names.get_names()[classification]
         if classification.lower() == "character":
             new_names = []
@@ -253,6 +259,7 @@ class SCENE_OT_add_nwn_anim_set(bpy.types.Operator):
 
     def get_categories(self, context):
         classification = context.scene.nwn_props.classification.lower()
+        from . import animation_names
         names = animation_names.get_names()[classification]
         if isinstance(names, dict):
             items = [(item, item, item) for item in names.keys()]
@@ -284,6 +291,7 @@ class SCENE_OT_add_nwn_anim_set(bpy.types.Operator):
         last_frame = start_frame + self.length
 
         classification = context.scene.nwn_props.classification.lower()
+        from . import animation_names
         names = animation_names.get_names()[classification]
         if classification.lower() == "character":
             new_names = []
@@ -369,3 +377,114 @@ class SCENE_OT_nwn_recreate_end_marker(bpy.types.Operator):
         animation = context.scene.nwn_props.animations[self.animation]
         animation.create_end_marker()
         return {'FINISHED'}
+
+
+class BorealisImport(bpy.types.Operator, ImportHelper):
+    '''
+    Import Neverwinter Nights model in ascii or compiled format
+    '''
+    bl_idname = "import_mesh.nwn_mdl"
+    bl_label = "Import NWN Mdl"
+
+    filename_ext = ".mdl"
+
+    filter_glob = StringProperty(default="*.mdl", options={'HIDDEN'})
+
+    files = CollectionProperty(name="File Path",
+                          description="File path used for importing "
+                                      "the MDL file",
+                          type=bpy.types.OperatorFileListElement)
+    directory = StringProperty(subtype='DIR_PATH')
+
+    do_import_animations = BoolProperty(name="Import animations", default=True,
+                                     description="Should the animations be"
+                                     "imported as well. If not selected, only"
+                                     " geometry will be imported.")
+    use_actions = BoolProperty(name="Separate actions", default=False,
+                               description="Import every animation in its "
+                               "own actions, placed as NLA strips, instead of "
+                               "one action with all animations")
+    weld_vertices = BoolProperty(name="Weld vertices", default=False,
+                                 description="Merge vertices closer to each "
+                                 "other than the weld distance")
+    weld_distance = FloatProperty(name="Weld distance", default=0.0001,
+                                  min=0, precision=5)
+
+    def execute(self, context):
+        kwargs = self.as_keywords(ignore=("check_existing", "filter_glob",
+                                          "files" "directory", "filename_ext"))
+        from . import mdl_import
+        mdl_import.import_mdl(self.filepath, context, **kwargs)
+        return {'FINISHED'}
+
+
+class BorealisExport(bpy.types.Operator, ExportHelper):
+    """ Exports a Blender Object hierarchy to a Neverwinter Nights mdl model.
+
+            This class is the Blender Operator which initiates the export.
+
+    """
+
+    bl_idname = "export_mesh.nwn_mdl"
+    bl_label = "Export NWN .mdl"
+
+    filepath = bpy.props.StringProperty(name="File Path",
+                          description="File path used for exporting "
+                                      "the NWN model",
+                          maxlen=1024,
+                          default="")
+    filename_ext = ".mdl"
+    filter_glob = StringProperty(default="*.mdl", options={'HIDDEN'})
+
+    use_root_name = BoolProperty(name="Use Root Object Name",
+                                 description=("Use the name of the root object "
+                                 "as the model name and filename like "
+                                 "Neverwinter Nights expects, if false the "
+                                 "filename will be used as the model name in"
+                                 " the model file"),
+                                 default=True)
+    do_export_animations = BoolProperty(name="Export Animations",
+                                     description="Toggle whether animations "
+                                     "should be exported or not",
+                                     default=True)
+    force_tris = BoolProperty(name="Autotriangulate quad faces",
+                                       description="Automatically convert quad"
+                                       " faces to tris. The export will fail"
+                                       " if this is unchecked and there are"
+                                       " quad faces in any mesh",
+                                       default=True)
+    uv_tolerance = FloatProperty(name="UV merge tolerance",
+                                 description="Texture coordinates closer "
+                                 "than this are written as one texture vertex",
+                                 default=0.00001, min=0, precision=6)
+    reduce_keys = BoolProperty(name="Reduce animation keys",
+                               description="Remove position and orientation "
+                               "keys which the game reproduces by "
+                               "interpolation, and keys which keep the pose "
+                               "of the geometry",
+                               default=False)
+    key_position_tolerance = FloatProperty(name="Position tolerance",
+                                           default=0.0005, min=0, precision=5)
+    key_angle_tolerance = FloatProperty(name="Angle tolerance",
+                                        description="In radians",
+                                        default=0.001, min=0, precision=5)
+    use_binary = BoolProperty(name="Compile model",
+                              description="Write the model in the compiled "
+                              "(binary) format used by the game instead of "
+                              "as an ascii model",
+                              default=False)
+
+    @classmethod
+    def poll(cls, context):
+        ## Check to see that the root object exists
+
+        return context.scene.nwn_props.root_object_name != None
+
+    def execute(self, context):
+        filepath = self.filepath
+        filepath = bpy.path.ensure_ext(filepath, self.filename_ext)
+
+        from . import mdl_export
+        return mdl_export.export_nwn_mdl(context,
+                                         **self.as_keywords(ignore=("check_existing",
+                                                                    "filter_glob")))
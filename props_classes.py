@@ -31,8 +31,29 @@ blender.
 @author: Erik Ylipää
 '''
 
+import array
+from collections.abc import Mapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 TAB_SPACE = 2
 
+BULK_FORMAT_SIZE = 256
+""" Matrices with more values than this are formatted as one block of text
+    with a single format operation, instead of value by value """
+
+
+def parse_int(token):
+    """ Parses an integer token. Integers written as floats are accepted,
+        but only tried when the token isn't a plain integer """
+    try:
+        return int(token)
+    except ValueError:
+        return int(float(token))
+
 
 class Property:
     nodes = []
@@ -69,19 +90,42 @@ class Property:
         return self.default
 
     def read_value(self, current_line, model_data):
-        self.value = self.format_input(current_line[1])
+        self.value = self.parse_value(current_line, model_data)
         self.value_written = True
 
     def output_values(self):
-        yield " " * TAB_SPACE + "%s %s" % (self.name, str(self.value))
+        return self.format_value(self.value)
 
     def __str__(self):
         return "\n".join(line for line in self.output_values())
 
     def update_value(self, value):
-        self.value = self.format_input(value)
+        self.value = self.convert_value(value)
         self.value_written = True
 
+    # The methods below don't use the state of the property, so a single
+    # property object can be shared by all nodes holding their own values
+
+    def parse_value(self, current_line, model_data):
+        """ Returns the value read from the tokenized line `current_line`,
+            and from the following lines of `model_data` if the value spans
+            several lines """
+        return self.format_input(current_line[1])
+
+    def convert_value(self, value):
+        """ Returns `value` converted to the type used by the property """
+        return self.format_input(value)
+
+    def get_parser(self):
+        """ Returns a function parsing the value of the property from a
+            tokenized line and the stream, with the signature of parse_value.
+            Simple properties return specialized functions """
+        return self.parse_value
+
+    def format_value(self, value):
+        """ Yields the lines of the property with the value `value` """
+        yield " " * TAB_SPACE + "%s %s" % (self.name, str(value))
+
     def format_input(self, input):
         return self.data_type(input)
 
@@ -105,63 +149,127 @@ class VectorProperty(Property):
         self.size = size
         super().__init__(**kwargs)
 
-    def read_value(self, current_line, model_data):
-        self.value = [self.format_input(val) for val in current_line[1:]]
-        self.value_written = True
+    def parse_value(self, current_line, model_data):
+        return [self.format_input(val) for val in current_line[1:]]
 
-    def update_value(self, value):
-        self.value = [self.format_input(val) for val in value]
-        self.value_written = True
+    def convert_value(self, value):
+        return [self.format_input(val) for val in value]
 
-    def output_values(self):
-        yield " " * TAB_SPACE + "%s %s" % (self.name, " ".join([str(val) for val in self.value]))
+    def format_value(self, value):
+        yield " " * TAB_SPACE + "%s %s" % (self.name, " ".join([str(val) for val in value]))
 
 
 #matrix properties are properties that have values on multiple rows
 class MatrixProperty(Property):
     data_type = str
+    array_dtype = None
+    """ The numpy dtype used for the value in array mode, None if the property
+        can't be stored as an array """
 
-    def read_value(self, current_line, model_data):
-        self.value = []
+    def parse_value(self, current_line, model_data):
+        rows = []
         #if the current line has less than two tokens, the list is terminated with an endlist
         #token instead of a given number of rows
         if len(current_line) < 2:
-            done_reading = False
-            while not done_reading:
-                line = model_data.pop(0)
+            for line in model_data:
                 if not line:  # skip empty lines
                     continue
                 if line[0] == "endlist":
                     break
-                self.value.append([self.format_input(value) for value in line])
+                rows.append(line)
         else:
             lines = int(current_line[-1])
             while lines:
-                line = model_data.pop(0)
+                line = next(model_data)
                 if not line:  # skip empty lines
                     continue
-                self.value.append([self.format_input(value) for value in line])
+                rows.append(line)
 
                 lines -= 1
 
-        self.value_written = True
-
-    def update_value(self, value):
+        if self.array_dtype and getattr(model_data, "use_arrays", False):
+            return self.rows_to_array(rows)
+        return [[self.format_input(value) for value in row] for row in rows]
+
+    def rows_to_array(self, rows):
+        """ Converts all the token rows of a block to an array in one go.
+            Ragged blocks can't be stored as arrays and are kept as lists """
+        try:
+            # The values are parsed as floats first, since some exporters
+            # write integer values as floats
+            array = numpy.array(rows, dtype=float)
+        except ValueError:
+            return [[self.format_input(value) for value in row] for row in rows]
+        if not rows:
+            array = array.reshape(0, 0)
+        return numpy.ascontiguousarray(array, dtype=self.array_dtype)
+
+    def convert_value(self, value):
         """
-        Updates the value of the matrix. value must be a matrix, a sequence of sequences
+        Converts a value of the matrix. value must be a matrix, a sequence of sequences
+        or a two-dimensional array
         """
-        self.value = [[self.format_input(val) for val in row] for row in value]
-        self.value_written = True
-
-    def output_values(self):
-        yield " " * TAB_SPACE + "%s %i" % (self.name, len(self.value))
-        for row in self.value:
+        if self.array_dtype and numpy is not None and isinstance(value, numpy.ndarray):
+            # Arrays of the right kind are kept as they are, so views into a
+            # file buffer aren't copied
+            if value.dtype.kind != numpy.dtype(self.array_dtype).kind:
+                value = value.astype(self.array_dtype)
+            return value
+        return [[self.format_input(val) for val in row] for row in value]
+
+    def get_parser(self):
+        return self.parse_value
+
+    def get_rows(self):
+        """ Returns the value as a list of rows of python values """
+        return self.value_rows(self.value)
+
+    def value_rows(self, value):
+        """ Returns the matrix `value` as a list of rows of python values """
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            return value.tolist()
+        return value
+
+    def format_value(self, value):
+        yield " " * TAB_SPACE + "%s %i" % (self.name, len(value))
+        for row in self.value_rows(value):
             yield " " * TAB_SPACE * 2 + " ".join([str(val) for val in row])
 
+    def format_rows(self, value, value_format):
+        """ Yields the rows of the matrix `value` with every value formatted
+            with `value_format`.
+
+                Large matrices with rows of equal length are yielded as a
+                single block of newline separated rows, built with one format
+                operation for the whole matrix.
+        """
+        indent = " " * TAB_SPACE * 2
+
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            if value.ndim == 2 and value.size > BULK_FORMAT_SIZE:
+                row_count, columns = value.shape
+                row_format = indent + " ".join([value_format] * columns)
+                yield "\n".join([row_format] * row_count) % tuple(value.ravel().tolist())
+                return
+            value = value.tolist()
+
+        elif value and len(value) * len(value[0]) > BULK_FORMAT_SIZE:
+            columns = len(value[0])
+            if all(len(row) == columns for row in value):
+                row_format = indent + " ".join([value_format] * columns)
+                yield "\n".join([row_format] * len(value)) % tuple(val for row in value for val in row)
+                return
+
+        for row in value:
+            yield indent + " ".join([value_format % val for val in row])
+
 
 class StringProperty(Property):
     data_type = str
 
+    def get_parser(self):
+        return lambda current_line, model_data: current_line[1]
+
 
 class BooleanProperty(Property):
     data_type = bool
@@ -172,11 +280,11 @@ class BooleanProperty(Property):
         # a bool value was written as 0.0 in the ascii file
         return bool(int(float(input)))
 
-    def output_values(self):
-        value = "0"
-        if self.value:
-            value = "1"
-        yield " " * TAB_SPACE + "%s %s" % (self.name, value)
+    def format_value(self, value):
+        output = "0"
+        if value:
+            output = "1"
+        yield " " * TAB_SPACE + "%s %s" % (self.name, output)
 
 
 class EnumProperty(Property):
@@ -212,33 +320,24 @@ class EnumProperty(Property):
 
         super().__init__(**kwargs)
 
-    def update_value(self, value):
+    def convert_value(self, value):
         # Make sure the value is saved as the name, which is what blender expects
         value = str(value)
         if value in self.enums:
-            self.value = value
+            return value
         elif value in self.inverse_enums:
-            self.value = self.inverse_enums[value]
+            return self.inverse_enums[value]
         else:
-            raise ValueError("Not a valid Enum: %s for %s, valid enums: %s" % (val, self.name, self.enums))
-        self.value_written = True
-
-    def read_value(self, current_line, model_data):
-        val = str(current_line[1])
-        if val in self.enums:
-            self.value = val
-        elif val in self.inverse_enums:
-            self.value = self.inverse_enums[val]
-        else:
-            raise ValueError("Not a valid Enum: %s for %s, valid enums: %s" % (val, self.name, self.enums))
+            raise ValueError("Not a valid Enum: %s for %s, valid enums: %s" % (value, self.name, self.enums))
 
-        self.value_written = True
+    def parse_value(self, current_line, model_data):
+        return self.convert_value(current_line[1])
 
-    def output_values(self):
-        if self.value in self.enums:
-            val = self.enums[self.value]
+    def format_value(self, value):
+        if value in self.enums:
+            val = self.enums[value]
         else:
-            val = self.value
+            val = value
         yield " " * TAB_SPACE + "%s %s" % (self.name, val)
 
     def get_blender_items(self):
@@ -254,108 +353,260 @@ class IntProperty(NumberProperty):
         # therefore we first cast the string to a float, then an int
         return int(float(input))
 
+    def get_parser(self):
+        return lambda current_line, model_data: parse_int(current_line[1])
+
 
 class IntVectorProperty(IntProperty, VectorProperty):
     data_type = int
 
+    def get_parser(self):
+        return lambda current_line, model_data: list(map(parse_int, current_line[1:]))
+
 
 class IntMatrixProperty(IntProperty, MatrixProperty):
     data_type = int
+    array_dtype = int
+
+    def get_parser(self):
+        return self.parse_value
+
+    def format_value(self, value):
+        yield " " * TAB_SPACE + "%s %i" % (self.name, len(value))
+        for rows in self.format_rows(value, "%d"):
+            yield rows
 
 
 class FloatProperty(NumberProperty):
     data_type = float
 
-    def output_values(self):
+    def get_parser(self):
+        return lambda current_line, model_data: float(current_line[1])
+
+    def format_value(self, value):
         # This tidies values, like the max export script seems to do
-        yield " " * TAB_SPACE + "%s %.9g" % (self.name, self.value)
+        yield " " * TAB_SPACE + "%s %.9g" % (self.name, value)
 
 
 class FloatVectorProperty(VectorProperty, FloatProperty):
     data_type = float
 
-    def output_values(self):
-        yield " " * TAB_SPACE + "%s %s" % (self.name, " ".join(["%.9g" % val for val in self.value]))
+    def get_parser(self):
+        return lambda current_line, model_data: list(map(float, current_line[1:]))
+
+    def format_value(self, value):
+        yield " " * TAB_SPACE + "%s %s" % (self.name, " ".join(["%.9g" % val for val in value]))
 
 
 class FloatMatrixProperty(MatrixProperty, FloatProperty):
     data_type = float
+    array_dtype = float
 
-    def output_values(self):
-        yield " " * TAB_SPACE + "%s %i" % (self.name, len(self.value))
-        for row in self.value:
-            yield " " * TAB_SPACE * 2 + " ".join(["%.9g" % val for val in row])
+    def format_value(self, value):
+        yield " " * TAB_SPACE + "%s %i" % (self.name, len(value))
+        for rows in self.format_rows(value, "%.9g"):
+            yield rows
 
 
 class ColorProperty(FloatVectorProperty):
     data_type = float
 
 
-class AABBTree(MatrixProperty):
-    def read_value(self, current_line, model_data):
-        def new_node(x1, y1, z1, x2, y2, z2, index, parent=None):
-            tree_node = {"co1": [float(x1), float(y1), float(z1)],
-                         "co2": [float(x2), float(y2), float(z2)],
-                         "left": None,
-                         "right": None,
-                         "index": int(index),
-                         "parent": parent}
-            return tree_node
+AABB_NODE_KEYS = ("co1", "co2", "left", "right", "index", "parent")
+""" The keys of the nodes of AABBTree values """
+
 
+class AABBTree(MatrixProperty):
+    def parse_value(self, current_line, model_data):
         aabb, x1, y1, z1, x2, y2, z2, index = current_line
-        root_node = new_node(x1, y1, z1, x2, y2, z2, index)
-        node_stack = [root_node]
-        self.value = root_node
-        done = False
+        tree = FlatAABBTree()
+        root = tree.add_node((float(x1), float(y1), float(z1)),
+                             (float(x2), float(y2), float(z2)), int(index))
+        #the inner nodes still waiting for children
+        node_stack = [root] if tree.face[root] == -1 else []
 
-        while(not done):
+        while node_stack:
             #Peek ahead to see if the next line is also a node in the tree
-            if len(model_data[0]) == 7:
-                current_line = model_data.pop(0)
-                x1, y1, z1, x2, y2, z2, index = current_line
-                parent = node_stack[-1]
-                current_node = new_node(x1, y1, z1, x2, y2, z2,
-                                         index, parent)
-                if not parent["left"]:
-                    parent["left"] = current_node
-                else:
-                    parent["right"] = current_node
-                    node_stack.pop()
-
-                if current_node["index"] == -1:
-                    node_stack.append(current_node)
+            next_line = model_data.peek()
+            if next_line is None or len(next_line) != 7:
+                break
+            x1, y1, z1, x2, y2, z2, index = next(model_data)
+            parent = node_stack[-1]
+            is_right = tree.left[parent] != -1
+            if is_right:
+                node_stack.pop()
+            current_node = tree.add_node((float(x1), float(y1), float(z1)),
+                                         (float(x2), float(y2), float(z2)),
+                                         int(index), parent, is_right)
+            if tree.face[current_node] == -1:
+                node_stack.append(current_node)
+        return tree
+
+    def convert_value(self, value):
+        if isinstance(value, dict):
+            return FlatAABBTree.from_dict(value)
+        return value
+
+    def value_rows(self, value):
+        return value.rows()
+
+    def format_value(self, value):
+        # The nodes are listed depth first with their indentation levels and
+        # formatted as one block with a single format operation
+        node_format = "%.7f %.7f %.7f %.7f %.7f %.7f %d"
+        line_formats = []
+        values = []
+        if not value.node_count():
+            return
+        level_formats = {0: " " * TAB_SPACE + "aabb " + node_format}
+        bounds = value.bounds
+        face = value.face
+
+        for level, node in value.walk():
+            if level not in level_formats:
+                level_formats[level] = " " * TAB_SPACE * (level + 1) + node_format
+            line_formats.append(level_formats[level])
+            values.extend(bounds[node * 6:node * 6 + 6])
+            values.append(face[node])
+        yield "\n".join(line_formats) % tuple(values)
+
+
+class FlatAABBTree(Mapping):
+    """ An AABB tree stored in flat arrays, the value of AABBTree properties.
+
+            Node i has the bounding box corners bounds[6 * i:6 * i + 3] and
+            bounds[6 * i + 3:6 * i + 6], the children left[i] and right[i],
+            the parent parent[i] and the face index face[i], which is -1 for
+            inner nodes. Missing nodes are -1 and the root is node 0.
+            axis[i] is the axis (0, 1 or 2) an inner node was split along by
+            the tree builder or in the compiled model it was read from, or -1
+            if it isn't known, as for trees read from ascii models.
+
+            For compatibility with code written for the old dictionary nodes,
+            the tree is also a read only mapping with the keys "co1", "co2",
+            "left", "right", "index" and "parent" of its root, and the child
+            nodes are returned as AABBNodeView mappings.
+    """
+    __slots__ = ("bounds", "left", "right", "parent", "face", "axis")
+
+    def __init__(self):
+        self.bounds = array.array("d")
+        self.left = array.array("i")
+        self.right = array.array("i")
+        self.parent = array.array("i")
+        self.face = array.array("i")
+        self.axis = array.array("b")
+
+    @classmethod
+    def from_dict(cls, root_node):
+        """ Returns the flat tree of a tree of dictionary nodes """
+        tree = cls()
+        node_stack = [(root_node, -1, False)]
+        while node_stack:
+            tree_node, parent, is_right = node_stack.pop()
+            node = tree.add_node(tree_node["co1"], tree_node["co2"],
+                                 int(tree_node["index"]), parent, is_right)
+            if tree_node["right"]:
+                node_stack.append((tree_node["right"], node, True))
+            if tree_node["left"]:
+                node_stack.append((tree_node["left"], node, False))
+        return tree
+
+    def add_node(self, co1, co2, index=-1, parent=-1, is_right=False, axis=-1):
+        """ Appends a node as the left or right child of `parent`, returns
+            the index of the new node """
+        node = len(self.face)
+        self.bounds.extend(co1)
+        self.bounds.extend(co2)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.parent.append(parent)
+        self.face.append(index)
+        self.axis.append(axis)
+        if parent != -1:
+            if is_right:
+                self.right[parent] = node
             else:
-                done = True
-        self.value_written = True
-
-    def update_value(self, value):
-        self.value = value
-        self.value_written = True
-
-    def output_values(self):
-        root_node = self.value
-        x1, y1, z1 = root_node["co1"]
-        x2, y2, z2 = root_node["co2"]
-        index = root_node["index"]
-        yield " " * TAB_SPACE + "aabb %.7f %.7f %.7f %.7f %.7f %.7f %d" % (x1, y1, z1,
-                                                         x2, y2, z2, index)
-        level = 2
-        node_stack = []
-        node_stack.append((level, root_node["right"],))
-        node_stack.append((level, root_node["left"],))
-
+                self.left[parent] = node
+        return node
+
+    def node_count(self):
+        return len(self.face)
+
+    def node(self, index):
+        """ Returns a mapping view of node `index`, None for -1 """
+        if index == -1:
+            return None
+        return AABBNodeView(self, index)
+
+    def walk(self):
+        """ Yields the level and index of all nodes depth first, left child
+            first, starting with the root at level 0 """
+        node_stack = [(0, 0)] if self.face else []
+        left = self.left
+        right = self.right
         while node_stack:
-            level, current_node = node_stack.pop()
-            x1, y1, z1 = current_node["co1"]
-            x2, y2, z2 = current_node["co2"]
-            index = current_node["index"]
-            yield (" " * TAB_SPACE * level +
-                   "%.7f %.7f %.7f %.7f %.7f %.7f %d" %
-                   (x1, y1, z1, x2, y2, z2, index))
-
-            left = current_node["left"]
-            right = current_node["right"]
-            if right:
-                node_stack.append((level + 1, current_node["right"],))
-            if left:
-                node_stack.append((level + 1, current_node["left"],))
+            level, node = node_stack.pop()
+            yield level, node
+            if right[node] != -1:
+                node_stack.append((level + 1, right[node]))
+            if left[node] != -1:
+                node_stack.append((level + 1, left[node]))
+
+    def rows(self):
+        """ Returns the nodes as rows of bounding box corners and face index,
+            depth first """
+        bounds = self.bounds
+        return [bounds[node * 6:node * 6 + 6].tolist() + [self.face[node]]
+                for level, node in self.walk()]
+
+    def __getitem__(self, key):
+        return AABBNodeView(self, 0)[key]
+
+    def __iter__(self):
+        return iter(AABB_NODE_KEYS)
+
+    def __len__(self):
+        return len(AABB_NODE_KEYS)
+
+    def __eq__(self, other):
+        if isinstance(other, FlatAABBTree):
+            return self.rows() == other.rows()
+        return NotImplemented
+
+    __hash__ = None
+
+
+class AABBNodeView(Mapping):
+    """ A node of a FlatAABBTree seen as a dictionary node """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __getitem__(self, key):
+        tree = self.tree
+        index = self.index
+        if key == "co1":
+            return tree.bounds[index * 6:index * 6 + 3].tolist()
+        elif key == "co2":
+            return tree.bounds[index * 6 + 3:index * 6 + 6].tolist()
+        elif key == "index":
+            return tree.face[index]
+        elif key in ("left", "right", "parent"):
+            return tree.node(getattr(tree, key)[index])
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(AABB_NODE_KEYS)
+
+    def __len__(self):
+        return len(AABB_NODE_KEYS)
+
+    def __eq__(self, other):
+        if isinstance(other, AABBNodeView):
+            return self.tree is other.tree and self.index == other.index
+        return NotImplemented
+
+    __hash__ = None
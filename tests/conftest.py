@@ -0,0 +1,25 @@
+""" Makes the modules of the add-on which don't need Blender importable as
+    the package borealis, without running the __init__ module which
+    registers the add-on with bpy """
+
+import os
+import sys
+import types
+
+import pytest
+
+ADDON_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+if "borealis" not in sys.modules:
+    package = types.ModuleType("borealis")
+    package.__path__ = [ADDON_DIRECTORY]
+    sys.modules["borealis"] = package
+
+
+@pytest.fixture
+def model_path():
+    """ The path of an ascii model with a mesh, a walkmesh, a danglymesh and
+        two animations """
+    return os.path.join(DATA_DIRECTORY, "testmdl.mdl")
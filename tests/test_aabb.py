@@ -0,0 +1,163 @@
+""" Tests the flat AABB trees and the AABB tree queries, which are checked
+    against brute force over all faces """
+
+import random
+
+import pytest
+
+from borealis import mdl, mdl_aabb, mdl_mesh, props_classes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@pytest.fixture(scope="module")
+def walkmesh():
+    """ A bumpy grid of 800 triangles and its query """
+    pytest.importorskip("numpy")
+    generator = random.Random(4)
+    size = 20
+    verts = [[x, y, generator.uniform(0, 0.5)]
+             for y in range(size + 1) for x in range(size + 1)]
+    faces = []
+    for y in range(size):
+        for x in range(size):
+            corner = y * (size + 1) + x
+            faces.append([corner, corner + 1, corner + size + 2, 1])
+            faces.append([corner, corner + size + 2, corner + size + 1, 1])
+    tree = mdl_mesh.build_aabb_tree(verts, faces)
+    query = mdl_aabb.AABBQuery(tree, verts, faces)
+    return query, generator
+
+
+def test_read_flat_tree(model_path):
+    tree = mdl.load_model(model_path).geometry.get_node("walk")["aabb"]
+    assert isinstance(tree, props_classes.FlatAABBTree)
+    assert tree.node_count() == 3
+    assert list(tree.face) == [-1, 0, 1]
+    assert list(tree.axis) == [-1, -1, -1]
+    assert [level for level, node in tree.walk()] == [0, 1, 1]
+
+    #The old dictionary nodes are still readable
+    assert tree["co2"] == [1, 1, 0]
+    assert tree["index"] == -1
+    assert tree["left"]["index"] == 0
+    assert tree["right"]["parent"]["co1"] == [0, 0, 0]
+    assert tree["left"]["left"] is None
+
+
+def test_flat_tree_from_dict(model_path):
+    tree = mdl.load_model(model_path).geometry.get_node("walk")["aabb"]
+
+    def to_dict(node):
+        if node is None:
+            return None
+        return {"co1": node["co1"], "co2": node["co2"], "index": node["index"],
+                "left": to_dict(node["left"]), "right": to_dict(node["right"])}
+
+    assert props_classes.FlatAABBTree.from_dict(to_dict(tree)) == tree
+
+
+def test_empty_flat_tree(model_path, tmp_path):
+    model = mdl.load_model(model_path)
+    node = model.geometry.get_node("walk")
+    node["aabb"] = props_classes.FlatAABBTree()
+    assert list(node.properties["aabb"].format_value(node["aabb"])) == []
+    assert "  aabb " not in str(model)
+
+    path = str(tmp_path / "compiled.mdl")
+    model.write_binary(path)
+    assert mdl.load_model(path).geometry.get_node("walk").values.get("aabb") is None
+
+
+def all_pairs(query, count):
+    """ Every query paired with every face """
+    face_count = len(query.triangles)
+    return (numpy.repeat(numpy.arange(count), face_count),
+            numpy.tile(numpy.arange(face_count), count))
+
+
+def test_locate_points(walkmesh):
+    query, generator = walkmesh
+    points = numpy.array([[generator.uniform(-1, 21), generator.uniform(-1, 21)]
+                          for point in range(300)])
+    faces, heights = query.locate_points(points)
+
+    queries, all_faces = all_pairs(query, len(points))
+    inside, all_heights = mdl_aabb.project_to_triangles(
+        points[queries], query.triangles[all_faces])
+    expected_faces, expected_heights = mdl_aabb.pick_best(
+        len(points), queries[inside], all_faces[inside], all_heights[inside],
+        all_heights[inside], numpy.nan)
+
+    outside = (points < 0).any(axis=1) | (points > 20).any(axis=1)
+    assert (faces[outside] == -1).all()
+    assert (faces[~outside] != -1).all()
+    assert numpy.allclose(heights, expected_heights, equal_nan=True)
+
+
+def test_raycast(walkmesh):
+    query, generator = walkmesh
+    origins = numpy.array([[generator.uniform(-1, 21), generator.uniform(-1, 21), 2]
+                           for ray in range(300)])
+    directions = numpy.array([[generator.uniform(-1, 1), generator.uniform(-1, 1), -1]
+                              for ray in range(300)])
+    faces, distances = query.raycast(origins, directions)
+
+    queries, all_faces = all_pairs(query, len(origins))
+    all_distances = mdl_aabb.intersect_triangles(origins[queries], directions[queries],
+                                                 query.triangles[all_faces])
+    expected = all_distances.reshape(len(origins), -1).min(axis=1)
+    assert numpy.allclose(distances, expected)
+    assert ((faces == -1) == numpy.isinf(expected)).all()
+
+    fractions = query.intersect_segments(origins, origins + directions)[1]
+    assert numpy.allclose(fractions[expected <= 1], expected[expected <= 1])
+    assert numpy.isinf(fractions[expected > 1]).all()
+
+
+def test_nearest_faces(walkmesh):
+    query, generator = walkmesh
+    points = numpy.array([[generator.uniform(-5, 25), generator.uniform(-5, 25),
+                           generator.uniform(-3, 3)] for point in range(200)])
+    faces, distances, closest = query.nearest_faces(points)
+
+    queries, all_faces = all_pairs(query, len(points))
+    all_closest = mdl_aabb.closest_points(points[queries], query.triangles[all_faces])
+    all_distances = numpy.sqrt(((all_closest - points[queries]) ** 2).sum(axis=1))
+    expected = all_distances.reshape(len(points), -1).min(axis=1)
+    assert numpy.allclose(distances, expected)
+    assert numpy.allclose(numpy.sqrt(((closest - points) ** 2).sum(axis=1)), expected)
+
+
+def test_overlapping_faces(walkmesh):
+    query, generator = walkmesh
+    lows = numpy.array([[generator.uniform(-2, 20), generator.uniform(-2, 20), 0]
+                        for box in range(100)])
+    highs = lows + numpy.array([generator.uniform(0, 3), generator.uniform(0, 3), 1])
+    boxes, faces = query.overlapping_faces(lows, highs)
+
+    face_lows = query.triangles.min(axis=1)
+    face_highs = query.triangles.max(axis=1)
+    overlaps = ((face_lows[None] <= highs[:, None]).all(axis=2) &
+                (lows[:, None] <= face_highs[None]).all(axis=2))
+    expected_boxes, expected_faces = numpy.nonzero(overlaps)
+    assert boxes.tolist() == expected_boxes.tolist()
+    assert faces.tolist() == expected_faces.tolist()
+
+
+def test_tree_stays_resizable(walkmesh):
+    verts = [[0, 0, 0], [1, 0, 0], [0, 1, 0]]
+    tree = mdl_mesh.build_aabb_tree(verts, [[0, 1, 2, 1]])
+    mdl_aabb.AABBQuery(tree, verts, [[0, 1, 2, 1]])
+    tree.add_node((0, 0, 0), (1, 1, 0))
+    assert tree.node_count() == 2
+
+def test_queries_without_numpy(monkeypatch):
+    verts = [[0, 0, 0], [1, 0, 0], [0, 1, 0]]
+    tree = mdl_mesh.build_aabb_tree(verts, [[0, 1, 2, 1]])
+    monkeypatch.setattr(mdl_aabb, "numpy", None)
+    with pytest.raises(ImportError, match="require numpy"):
+        mdl_aabb.AABBQuery(tree, verts, [[0, 1, 2, 1]])
@@ -0,0 +1,97 @@
+""" Tests reading and writing compiled models """
+
+import math
+
+import pytest
+
+from borealis import mdl, mdl_binary, mdl_diff, mdl_mesh
+
+
+@pytest.fixture
+def compiled_path(model_path, tmp_path):
+    """ The sample model compiled to the binary format """
+    path = str(tmp_path / "compiled.mdl")
+    mdl_binary.write_model(mdl.load_model(model_path), path)
+    return path
+
+
+def test_read_compiled_model(compiled_path):
+    assert mdl_binary.is_binary(compiled_path)
+    model = mdl.load_model(compiled_path)
+    assert model.name == "testmdl"
+    assert mdl.item_names(model.geometry.nodes) == ["testmdl", "body", "walk", "cape"]
+    assert [animation.name for animation in model.animations] == ["walk", "idle"]
+
+    body = model.geometry.get_node("body")
+    assert body["verts"] == [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]]
+    assert [row[:3] for row in body["faces"]] == [[0, 1, 2], [0, 2, 3]]
+
+    body_keys = mdl.find_named(model.get_animation("walk").nodes, "body")
+    expected = [[0, 0, 0, 1.5], [0.5, 0, 0.5, 1.5], [1.0, 0, 1, 1.5]]
+    for row, expected_row in zip(body_keys["positionkey"], expected):
+        assert row == pytest.approx(expected_row)
+
+
+def test_compiled_arrays_match_lists(compiled_path):
+    pytest.importorskip("numpy")
+    assert (str(mdl.load_model(compiled_path, use_arrays=True)) ==
+            str(mdl.load_model(compiled_path)))
+
+
+def test_load_selected_animations(compiled_path):
+    model = mdl.load_model(compiled_path, load_animations=["idle"])
+    assert [animation.name for animation in model.animations] == ["idle"]
+
+
+def test_binary_round_trip(model_path, compiled_path, tmp_path):
+    model = mdl.load_model(model_path)
+    compiled = mdl.load_model(compiled_path)
+
+    #Compiling adds the default values of unwritten properties, the
+    #geometry and keys are kept
+    for name in ["body", "walk", "cape"]:
+        node = model.geometry.get_node(name)
+        compiled_node = compiled.geometry.get_node(name)
+        assert not mdl_diff.diff_values(node["verts"], compiled_node["verts"], 1e-6)
+
+    #Compiling a compiled model gives the same file
+    second_path = str(tmp_path / "second.mdl")
+    compiled.write_binary(second_path)
+    with open(compiled_path, "rb") as first, open(second_path, "rb") as second:
+        assert first.read() == second.read()
+    assert str(mdl.load_model(second_path)) == str(compiled)
+
+
+def test_quaternion_to_axis_angle():
+    assert mdl_binary.quaternion_to_axis_angle(0, 0, 0, 1) == [0, 0, 0, 0]
+    x, y, z, angle = mdl_binary.quaternion_to_axis_angle(0, 0, 2 * math.sin(0.25),
+                                                         2 * math.cos(0.25))
+    assert (x, y, z) == (0, 0, 1)
+    assert angle == pytest.approx(0.5)
+
+
+def test_quaternions_to_axis_angles():
+    numpy = pytest.importorskip("numpy")
+    quaternions = numpy.array([[0, 0, 0, 1], [0, math.sin(0.5), 0, math.cos(0.5)]],
+                              dtype=numpy.float32)
+    rotations = mdl_binary.quaternions_to_axis_angles(quaternions)
+    assert rotations.dtype == numpy.float64
+    assert rotations.tolist()[0] == [0, 0, 0, 0]
+    assert rotations[1] == pytest.approx([0, 1, 0, 1])
+
+
+def test_aabb_planes_are_the_split_axes(model_path, tmp_path):
+    model = mdl.load_model(model_path)
+    walk = model.geometry.get_node("walk")
+    #Two faces side by side along x, the box is longest along y
+    walk["verts"] = [[0, 0, 0], [0.1, 0, 0], [0, 10, 0],
+                     [1, 0, 0], [1.1, 0, 0], [1, 10, 0]]
+    walk["faces"] = [[0, 1, 2, 1, 0, 0, 0, 1], [3, 4, 5, 1, 0, 0, 0, 1]]
+    walk["aabb"] = mdl_mesh.build_aabb_tree(walk["verts"], walk["faces"])
+    assert walk["aabb"].axis[0] == 0
+
+    path = str(tmp_path / "compiled.mdl")
+    model.write_binary(path)
+    tree = mdl.load_model(path).geometry.get_node("walk")["aabb"]
+    assert tree.axis.tolist() == [0, -1, -1]
+    assert tree.face.tolist() == walk["aabb"].face.tolist()
@@ -0,0 +1,103 @@
+""" Tests the on-disk model cache """
+
+import os
+import shutil
+
+import pytest
+
+from borealis import mdl, mdl_cache
+
+
+@pytest.fixture
+def parse_count(monkeypatch):
+    """ Counts the models parsed from files """
+    count = [0]
+    from_file = mdl.Model.from_file
+
+    def counting_from_file(self, *args, **kwargs):
+        count[0] += 1
+        return from_file(self, *args, **kwargs)
+
+    monkeypatch.setattr(mdl.Model, "from_file", counting_from_file)
+    return count
+
+
+def test_cache_hit_and_miss(model_path, tmp_path, parse_count):
+    cache = mdl_cache.ModelCache(str(tmp_path / "cache"))
+    model = cache.load(model_path)
+    assert parse_count[0] == 1
+    assert len(cache.entries()) == 1
+
+    cached = cache.load(model_path)
+    assert parse_count[0] == 1
+    assert str(cached) == str(model)
+
+    #Other options are other entries
+    cache.load(model_path, load_animations=["walk"])
+    assert parse_count[0] == 2
+    assert len(cache.entries()) == 2
+
+    cache.clear()
+    assert not cache.entries()
+    cache.load(model_path)
+    assert parse_count[0] == 3
+
+
+def test_changed_file_is_parsed_again(model_path, tmp_path, parse_count):
+    path = str(tmp_path / "model.mdl")
+    shutil.copy(model_path, path)
+    cache = mdl_cache.ModelCache(str(tmp_path / "cache"))
+    cache.load(path)
+
+    with open(path, "a") as model_file:
+        model_file.write("\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    cache.load(path)
+    assert parse_count[0] == 2
+
+
+def test_hash_keys_find_copies(model_path, tmp_path, parse_count):
+    path = str(tmp_path / "copy.mdl")
+    shutil.copy(model_path, path)
+    cache = mdl_cache.ModelCache(str(tmp_path / "cache"), use_hash=True)
+    cache.load(model_path)
+    cache.load(path)
+    assert parse_count[0] == 1
+
+
+def test_least_recently_used_entries_are_evicted(model_path, tmp_path):
+    paths = []
+    for name in ["a.mdl", "b.mdl", "c.mdl"]:
+        paths.append(str(tmp_path / name))
+        shutil.copy(model_path, paths[-1])
+
+    cache = mdl_cache.ModelCache(str(tmp_path / "cache"))
+    cache.load(paths[0])
+    entry_size = cache.entries()[0][1]
+    cache.max_size = entry_size * 2
+
+    cache.load(paths[1])
+    first_entry = cache.entry_path(cache.key(paths[0], {}))
+    os.utime(first_entry, (1, 1))
+    cache.load(paths[2])
+
+    entries = cache.entries()
+    assert len(entries) == 2
+    assert first_entry not in [path for last_use, size, path in entries]
+
+
+@pytest.mark.parametrize("content", [b"", b"not a pickle",
+                                     #A class of a module which doesn't exist
+                                     b"cmissing_module\nModel\n."])
+def test_unreadable_entries_are_parsed_again(model_path, tmp_path, parse_count, content):
+    cache = mdl_cache.ModelCache(str(tmp_path / "cache"))
+    cache.load(model_path)
+    entry = cache.entry_path(cache.key(model_path, {}))
+    with open(entry, "wb") as entry_file:
+        entry_file.write(content)
+
+    model = cache.load(model_path)
+    assert parse_count[0] == 2
+    assert str(cache.load(model_path)) == str(model)
+    assert parse_count[0] == 2
@@ -0,0 +1,48 @@
+""" Tests comparing models """
+
+from borealis import mdl, mdl_diff, mdl_mesh, props_classes
+
+
+def move_vertex(model, offset):
+    node = model.geometry.get_node("body")
+    rows = [list(row) for row in node.properties["verts"].get_rows()]
+    rows[0][0] += offset
+    mdl_mesh.set_rows(node, "verts", rows)
+
+
+def test_equal_models_have_no_diff(model_path):
+    diff = mdl_diff.diff_models(mdl.load_model(model_path), mdl.load_model(model_path))
+    assert not diff
+    assert str(diff) == ""
+
+
+def test_changed_vertex(model_path):
+    model = mdl.load_model(model_path)
+    move_vertex(model, 0.01)
+    diff = mdl_diff.diff_models(mdl.load_model(model_path), model)
+    assert diff
+    assert "body" in str(diff)
+    assert "verts" in str(diff)
+
+
+def test_tolerances_by_name_and_type(model_path):
+    model = mdl.load_model(model_path)
+    move_vertex(model, 0.01)
+    original = mdl.load_model(model_path)
+    assert not mdl_diff.diff_models(original, model, tolerance=0.1)
+    assert not mdl_diff.diff_models(original, model, tolerances={"verts": 0.1})
+    assert not mdl_diff.diff_models(original, model,
+                                    tolerances={props_classes.FloatMatrixProperty: 0.1})
+    assert not mdl_diff.diff_models(original, model,
+                                    tolerances={"MatrixProperty": 0.1})
+    #Names take precedence over types
+    assert mdl_diff.diff_models(original, model,
+                                tolerances={"MatrixProperty": 0.1, "verts": 0})
+
+
+def test_added_and_removed_animations(model_path):
+    model = mdl.load_model(model_path)
+    del model.animations[1]
+    diff = mdl_diff.diff_models(mdl.load_model(model_path), model)
+    assert diff
+    assert "idle" in str(diff)
@@ -0,0 +1,42 @@
+""" Tests the content fingerprints of models """
+
+import hashlib
+
+import pytest
+
+from borealis import mdl, mdl_fingerprint, mdl_mesh
+
+
+def test_fingerprint_is_the_same_in_all_modes(model_path):
+    pytest.importorskip("numpy")
+    fingerprint = mdl.load_model(model_path).fingerprint()
+    assert mdl.load_model(model_path, use_arrays=True).fingerprint() == fingerprint
+    assert mdl.load_model(model_path, lazy=True).fingerprint() == fingerprint
+
+
+def test_fingerprint_follows_the_content(model_path):
+    model = mdl.load_model(model_path)
+    fingerprint = model.fingerprint()
+    #Names are compared case insensitively, like the game does
+    model.name = model.name.upper()
+    assert model.fingerprint() == fingerprint
+    node = model.geometry.get_node("body")
+    rows = [list(row) for row in node.properties["verts"].get_rows()]
+    rows[0][0] += 0.01
+    mdl_mesh.set_rows(node, "verts", rows)
+    assert model.fingerprint() != fingerprint
+
+
+@pytest.mark.parametrize("value", [["1", "2"], [["1", "2"], ["3", "4"]], [1, [2]]])
+def test_only_numbers_are_hashed_as_arrays(monkeypatch, value):
+    assert not mdl_fingerprint.update_numbers(hashlib.sha1(), value)
+    monkeypatch.setattr(mdl_fingerprint, "numpy", None)
+    assert not mdl_fingerprint.update_numbers(hashlib.sha1(), value)
+
+
+def test_fingerprint_does_not_depend_on_numpy(model_path, monkeypatch):
+    pytest.importorskip("numpy")
+    model = mdl.load_model(model_path)
+    fingerprint = model.fingerprint()
+    monkeypatch.setattr(mdl_fingerprint, "numpy", None)
+    assert model.fingerprint() == fingerprint
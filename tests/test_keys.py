@@ -0,0 +1,85 @@
+""" Tests reducing animation keys """
+
+import math
+import random
+
+import pytest
+
+from borealis import mdl, mdl_keys
+
+
+@pytest.fixture(params=["numpy", "lists"])
+def keys_numpy(request, monkeypatch):
+    """ Runs a test with and without numpy """
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(mdl_keys, "numpy", None)
+    return request.param
+
+
+def removed_key_errors(rows, kept, orientation):
+    """ Returns the errors of the removed keys against the kept keys """
+    errors = []
+    for first, last in zip(kept, kept[1:]):
+        if last - first > 1:
+            errors.extend(mdl_keys.key_errors(rows, rows[first + 1:last], first,
+                                              last, orientation))
+    return errors
+
+
+def test_linear_positions_keep_the_ends(keys_numpy):
+    rows = [[time * 0.1, time, 2 * time, 0] for time in range(20)]
+    assert mdl_keys.reduce_track(rows, 0.0005) == [0, 19]
+
+
+def test_constant_track_keeps_one_key(keys_numpy):
+    rows = [[time * 0.1, 0, 0, 1, 0.5] for time in range(10)]
+    assert mdl_keys.reduce_track(rows, 0.001, orientation=True) == [0]
+
+
+@pytest.mark.parametrize("tolerance", [0.001, 0.01, 0.1])
+def test_positions_within_tolerance(keys_numpy, tolerance):
+    generator = random.Random(5)
+    rows = [[time * 0.1, math.sin(time * 0.2), generator.uniform(0, 0.01), 0]
+            for time in range(60)]
+    kept = mdl_keys.reduce_track(rows, tolerance)
+    assert kept[0] == 0 and kept[-1] == 59
+    assert max(removed_key_errors(rows, kept, False), default=0) <= tolerance
+
+
+@pytest.mark.parametrize("tolerance", [0.001, 0.05])
+def test_orientations_within_tolerance(keys_numpy, tolerance):
+    rows = [[time * 0.1, 0, math.sin(time * 0.05), 1, time * 0.05]
+            for time in range(60)]
+    kept = mdl_keys.reduce_track(rows, tolerance, orientation=True)
+    assert len(kept) < len(rows)
+    assert max(removed_key_errors(rows, kept, True)) <= tolerance
+
+
+def test_slerp_between_axis_angles():
+    start = mdl_keys.axis_angle_quaternion([0, 0, 1, 0])
+    end = mdl_keys.axis_angle_quaternion([0, 0, 1, 1])
+    middle = mdl_keys.slerp(start, end, 0.5)
+    assert middle == pytest.approx(mdl_keys.axis_angle_quaternion([0, 0, 1, 0.5]))
+
+
+def test_reduce_model(model_path, keys_numpy):
+    model = mdl.load_model(model_path)
+    assert model.reduce_keys() == 1
+
+    walk = model.get_animation("walk")
+    body = mdl.find_named(walk.nodes, "body")
+    assert [row[0] for row in body.properties["positionkey"].get_rows()] == [0, 1.0]
+    assert len(body.properties["orientationkey"].get_rows()) == 2
+
+
+def test_pose_tracks_are_removed(model_path, keys_numpy):
+    model = mdl.load_model(model_path)
+    walk = model.get_animation("walk")
+    body = mdl.find_named(walk.nodes, "body")
+    body["positionkey"] = [[0, 0, 0, 1.5], [1.0, 0, 0, 1.5]]
+    body["orientationkey"] = [[0, 0, 0, 1, 0.5], [1.0, 0, 0, 1, 0.5]]
+
+    assert model.reduce_keys() == 4
+    assert [node.name for node in walk.nodes] == ["testmdl"]
@@ -0,0 +1,93 @@
+""" Tests reading and writing ascii models """
+
+import pickle
+
+import pytest
+
+from borealis import mdl
+
+
+def test_read_ascii_model(model_path):
+    model = mdl.load_model(model_path)
+    assert model.name == "testmdl"
+    assert model.classification == "character"
+    assert mdl.item_names(model.geometry.nodes) == ["testmdl", "body", "walk", "cape"]
+
+    #Comments and empty lines inside a matrix are skipped
+    body = model.geometry.get_node("body")
+    assert body["verts"] == [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]]
+    assert body["bitmap"] == "tex"
+
+    walk = model.get_animation("walk")
+    assert walk.length == 1.0
+    assert walk.events == [(0.5, "hit")]
+    body_keys = mdl.find_named(walk.nodes, "body")
+    assert len(body_keys["positionkey"]) == 3
+    assert [animation.name for animation in model.animations] == ["walk", "idle"]
+
+
+def test_ascii_output_reads_back_the_same(model_path, tmp_path):
+    output = str(mdl.load_model(model_path))
+    path = str(tmp_path / "written.mdl")
+    with open(path, "w") as model_file:
+        model_file.write(output)
+    assert str(mdl.load_model(path)) == output
+
+
+
+def test_array_mode_stores_matrices_as_arrays(model_path):
+    numpy = pytest.importorskip("numpy")
+    model = mdl.load_model(model_path, use_arrays=True)
+    body = model.geometry.get_node("body")
+    assert isinstance(body["verts"], numpy.ndarray)
+    assert body["verts"].dtype.kind == "f"
+    assert body["faces"].dtype.kind == "i"
+    assert body["verts"].tolist() == [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]]
+
+
+def test_array_mode_output_is_the_same(model_path):
+    pytest.importorskip("numpy")
+    assert (str(mdl.load_model(model_path, use_arrays=True)) ==
+            str(mdl.load_model(model_path)))
+
+
+def test_lazy_mode_parses_blocks_on_access(model_path):
+    model = mdl.load_model(model_path, lazy=True)
+    nodes = model.geometry.nodes
+    assert nodes.names() == ["testmdl", "body", "walk", "cape"]
+    assert nodes.items == [None] * 4
+
+    assert model.geometry.get_node("body")["bitmap"] == "tex"
+    assert [item is not None for item in nodes.items] == [False, True, False, False]
+    assert mdl.load_model(model_path, summary=True)["animations"] == ["walk", "idle"]
+
+
+def test_lazy_mode_output_is_the_same(model_path):
+    output = str(mdl.load_model(model_path))
+    assert str(mdl.load_model(model_path, lazy=True)) == output
+    if mdl.numpy is not None:
+        assert str(mdl.load_model(model_path, lazy=True, use_arrays=True)) == output
+
+
+def test_pickled_lazy_model_stays_lazy(model_path):
+    model = mdl.load_model(model_path, lazy=True)
+    model.geometry.get_node("body")
+    copy = pickle.loads(pickle.dumps(model))
+    assert [item is not None for item in copy.geometry.nodes.items] == [False, True, False, False]
+    assert str(copy) == str(mdl.load_model(model_path))
+
+
+def test_load_many_keeps_lazy_mode(model_path):
+    result, = mdl.load_many([model_path], workers=2, lazy=True)
+    assert result.error is None
+    assert result.model.animations.items == [None, None]
+    assert str(result.model) == str(mdl.load_model(model_path))
+
+
+def test_write_matches_str(model_path, tmp_path):
+    model = mdl.load_model(model_path)
+    path = str(tmp_path / "written.mdl")
+    with open(path, "w") as model_file:
+        model.write(model_file)
+    with open(path) as model_file:
+        assert model_file.read() == str(model)
@@ -0,0 +1,137 @@
+""" Tests welding vertices, deduplicating texture coordinates and building
+    AABB trees """
+
+import math
+import random
+
+import pytest
+
+from borealis import mdl, mdl_mesh
+
+
+@pytest.fixture(params=["numpy", "lists"])
+def mesh_numpy(request, monkeypatch):
+    """ Runs a test with and without numpy """
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(mdl_mesh, "numpy", None)
+    return request.param
+
+
+def random_mesh(vert_count, face_count, seed=1):
+    generator = random.Random(seed)
+    verts = [[generator.uniform(0, 10) for axis in range(3)]
+             for vert in range(vert_count)]
+    faces = [generator.sample(range(vert_count), 3) + [0]
+             for face in range(face_count)]
+    return verts, faces
+
+
+def distance(a, b):
+    return math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b)))
+
+
+def test_weld_vertices():
+    verts, faces = random_mesh(400, 0)
+    generator = random.Random(2)
+    verts += [[value + generator.uniform(-0.01, 0.01) for value in vert]
+              for vert in verts[:100]]
+    weld_distance = 0.05
+    kept, remap = mdl_mesh.weld_vertices(verts, weld_distance)
+
+    assert len(remap) == len(verts)
+    for index, new_index in enumerate(remap):
+        assert distance(verts[index], verts[kept[new_index]]) <= weld_distance
+    for index, first in enumerate(kept):
+        for second in kept[index + 1:]:
+            assert distance(verts[first], verts[second]) > weld_distance
+    assert len(kept) <= 400
+
+
+def test_weld_vertices_with_keys():
+    verts = [[0, 0, 0], [0, 0, 0.001], [0, 0, 0.002]]
+    kept, remap = mdl_mesh.weld_vertices(verts, 0.01, ["a", "b", "a"])
+    assert kept == [0, 1]
+    assert remap == [0, 1, 0]
+
+
+def test_weld_exact_duplicates():
+    kept, remap = mdl_mesh.weld_vertices([[0, 0, 0], [1, 0, 0], [0, 0, 0]], 0)
+    assert kept == [0, 1]
+    assert remap == [0, 1, 0]
+
+
+def test_weld_node(model_path):
+    model = mdl.load_model(model_path)
+    node = model.geometry.get_node("body")
+    verts = [list(row) for row in node.properties["verts"].get_rows()]
+    mdl_mesh.set_rows(node, "verts", verts + [verts[2]])
+    mdl_mesh.set_rows(node, "faces", [[0, 1, 4, 1, 0, 1, 2, 1],
+                                      [0, 2, 3, 1, 0, 2, 3, 1]])
+
+    assert mdl_mesh.weld_node(node) == 1
+    assert len(node.properties["verts"].get_rows()) == 4
+    assert [row[:3] for row in node.properties["faces"].get_rows()] == [[0, 1, 2], [0, 2, 3]]
+
+
+def test_unique_uvs(mesh_numpy):
+    generator = random.Random(3)
+    uvs = [[generator.random(), generator.random()] for uv in range(200)]
+    uvs += uvs[:50]
+    tolerance = 0.001
+    unique, indices = mdl_mesh.unique_uvs(uvs, tolerance)
+
+    assert len(unique) == 200
+    for uv, index in zip(uvs, indices):
+        assert distance(uv, unique[index]) <= tolerance * 2
+
+    unique, indices = mdl_mesh.unique_uvs([[0.5, 0.5], [0.5, 0.5000001], [0.5, 0.5]], 0)
+    assert len(unique) == 2
+    assert list(indices) == [0, 1, 0]
+
+
+def check_tree(tree, verts, faces):
+    """ Checks that every face is in one leaf, the leaves bound their faces
+        exactly and the inner nodes bound their children """
+    bounds = tree.bounds
+    leaves = []
+    for node in range(tree.node_count()):
+        low = bounds[node * 6:node * 6 + 3].tolist()
+        high = bounds[node * 6 + 3:node * 6 + 6].tolist()
+        face = tree.face[node]
+        if face != -1:
+            leaves.append(face)
+            assert tree.left[node] == tree.right[node] == -1
+            assert tree.axis[node] == -1
+            face_verts = [verts[index] for index in faces[face][:3]]
+            assert low == [min(values) for values in zip(*face_verts)]
+            assert high == [max(values) for values in zip(*face_verts)]
+            continue
+        assert tree.axis[node] in (0, 1, 2)
+        for child in (tree.left[node], tree.right[node]):
+            assert child != -1
+            assert tree.parent[child] == node
+            child_low = bounds[child * 6:child * 6 + 3]
+            child_high = bounds[child * 6 + 3:child * 6 + 6]
+            assert all(a <= b for a, b in zip(low, child_low))
+            assert all(a <= b for a, b in zip(child_high, high))
+    assert sorted(leaves) == list(range(len(faces)))
+
+
+@pytest.mark.parametrize("face_count", [1, 2, 31, 500])
+def test_build_aabb_tree(mesh_numpy, face_count):
+    verts, faces = random_mesh(300, face_count)
+    tree = mdl_mesh.build_aabb_tree(verts, faces)
+    assert tree.node_count() == 2 * face_count - 1
+    check_tree(tree, verts, faces)
+
+
+def test_build_aabb_tree_with_duplicate_faces(mesh_numpy):
+    verts, faces = random_mesh(10, 1)
+    faces = faces * 40
+    check_tree(mdl_mesh.build_aabb_tree(verts, faces), verts, faces)
+
+
+def test_build_aabb_tree_without_faces(mesh_numpy):
+    assert mdl_mesh.build_aabb_tree([[0, 0, 0]], []) is None